@@ -0,0 +1,376 @@
+"""Versioned JSON API for Flask Cafe (mobile clients): /api/v1.
+
+Every response is JSON, errors included:
+
+    {"data": ...}                              success
+    {"data": [...], "next": CURSOR or null}    a page of a list
+    {"error": {"status": 404, "code": "not_found", "message": "..."}}
+
+Sparse fieldsets: list and detail endpoints take ?fields=id,name,... to get
+only those fields, and only the columns behind them are read from the
+database. Lists are serialized as a stream, a chunk of rows at a time, so
+a long page doesn't have to be built as one string. Rows are all fetched
+before the first byte goes out, so a slow client never holds a database
+connection.
+
+Reads need no login. Likes use the session cookie of a logged-in user, and
+writes need its CSRF token in an X-CSRFToken header, like the site's own
+JavaScript.
+"""
+
+import json
+from collections import namedtuple
+
+from flask import (
+    Blueprint, Response, current_app, g, jsonify, request, abort)
+from werkzeug.exceptions import HTTPException
+
+from models import db, Cafe, Like, city_registry
+from pagination import keyset_page, coerce_cursor, decode_cursor
+from instrumentation import query_budget
+
+api = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+MAX_PAGE_SIZE = 1000
+MAX_SEARCH_RESULTS = 50
+MAX_BULK_LIKES = 100
+
+# rows serialized per chunk of a streamed list
+STREAM_CHUNK = 100
+
+
+# A field of an API object: the columns it's made from, and how to get its
+# value from a row (or model instance) with those columns.
+Field = namedtuple("Field", ["columns", "get"])
+
+
+def _city_state(city_code):
+    city = city_registry.get(city_code)
+    return f"{city.name}, {city.state}" if city else None
+
+
+CAFE_FIELDS = {
+    "id": Field([Cafe.id], lambda cafe: cafe.id),
+    "name": Field([Cafe.name], lambda cafe: cafe.name),
+    "description": Field([Cafe.description], lambda cafe: cafe.description),
+    "website": Field([Cafe.url], lambda cafe: cafe.url),
+    "address": Field([Cafe.address], lambda cafe: cafe.address),
+    "city_code": Field([Cafe.city_code], lambda cafe: cafe.city_code),
+    "city": Field([Cafe.city_code], lambda cafe: _city_state(cafe.city_code)),
+    "image_url": Field([Cafe.image_url], lambda cafe: cafe.image_url),
+    "like_count": Field([Cafe.like_count], lambda cafe: cafe.like_count),
+    "latitude": Field([Cafe.latitude], lambda cafe: cafe.latitude),
+    "longitude": Field([Cafe.longitude], lambda cafe: cafe.longitude),
+    "url": Field([Cafe.id], lambda cafe: f"/cafes/{cafe.id}"),
+}
+
+CITY_FIELDS = {
+    "code": Field([], lambda city: city.code),
+    "name": Field([], lambda city: city.name),
+    "state": Field([], lambda city: city.state),
+}
+
+# ?sort= for cafe lists: (key columns, row -> key, descending)
+CAFE_SORTS = {
+    "name": ([Cafe.name, Cafe.id], lambda row: (row.name, row.id), False),
+    "popular": ([Cafe.like_count, Cafe.id],
+                lambda row: (row.like_count, row.id), True),
+}
+
+
+##############################################################################
+# errors
+
+def is_api_request():
+    """Is this request for a URL under /api/v1 (routed or not)?"""
+
+    return request.path.startswith(f"{api.url_prefix}/")
+
+
+def json_error(e):
+    """Turn an HTTPException into the API's JSON error response."""
+
+    code = (e.name or "error").lower().replace(" ", "_")
+    response = jsonify(
+        {"error": {"status": e.code, "code": code, "message": e.description}})
+    response.status_code = e.code
+    return response
+
+
+@api.app_errorhandler(HTTPException)
+def handle_http_error(e):
+    """JSON errors for API URLs (including ones with no route, or the wrong
+    method); anything else is left as it was."""
+
+    if is_api_request():
+        return json_error(e)
+    return e
+
+
+##############################################################################
+# helpers
+
+def _int_arg(name, default, low, high):
+    """Integer query string argument, between low and high; 400 if not."""
+
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        abort(400, f"{name} must be an integer")
+
+    if not low <= value <= high:
+        abort(400, f"{name} must be between {low} and {high}")
+
+    return value
+
+
+def _fields(available):
+    """Names of the fields asked for with ?fields= (default: all of them);
+    400 if any don't exist."""
+
+    asked = request.args.get("fields")
+    if not asked:
+        return list(available)
+
+    names = list(dict.fromkeys(
+        name.strip() for name in asked.split(",") if name.strip()))
+    unknown = [name for name in names if name not in available]
+
+    if unknown or not names:
+        abort(400, f"Unknown field(s) {', '.join(unknown) or '(none)'}; "
+                   f"choose from {', '.join(available)}")
+
+    return names
+
+
+def _columns(available, names, *extra):
+    """Columns needed for these fields (and the extra columns), once each."""
+
+    columns = {}
+    for column in [*(c for name in names for c in available[name].columns),
+                   *extra]:
+        columns.setdefault(column.key, column)
+    return list(columns.values())
+
+
+def _render(available, names, obj):
+    return {name: available[name].get(obj) for name in names}
+
+
+def _stream_list(items, next_cursor=None):
+    """Streamed {"data": [...], "next": ...} response of already-rendered
+    items."""
+
+    def generate():
+        yield '{"data":['
+        for start in range(0, len(items), STREAM_CHUNK):
+            chunk = ",".join(
+                json.dumps(item, separators=(",", ":"))
+                for item in items[start:start + STREAM_CHUNK])
+            yield f",{chunk}" if start else chunk
+        yield f'],"next":{json.dumps(next_cursor)}}}'
+
+    return Response(generate(), mimetype="application/json")
+
+
+def _likes_changed():
+    """Tell the in-memory rankings (trending, recommendations) to sync."""
+
+    for name in ("trending", "recommender"):
+        extension = current_app.extensions.get(name)
+        if extension is not None:
+            extension.mark_stale()
+
+
+##############################################################################
+# cafes
+
+@api.get("/cafes")
+@query_budget(3)
+def list_cafes():
+    """A page of cafes (in a city, with ?city_code=), by name or by likes
+    (?sort=popular). Follow the "next" cursor with ?after= for the next
+    page; a cursor that can't be read, or is from the other sort, is a
+    400."""
+
+    sort = request.args.get("sort", "name")
+    if sort not in CAFE_SORTS:
+        abort(400, f"sort must be one of {', '.join(CAFE_SORTS)}")
+    sort_columns, key, descending = CAFE_SORTS[sort]
+
+    after = request.args.get("after")
+    if after:
+        after = coerce_cursor(decode_cursor(after, sort=sort), sort_columns)
+        if after is None:
+            abort(400, "bad cursor")
+
+    limit = _int_arg(
+        "limit", current_app.config['CAFES_PER_PAGE'], 1, MAX_PAGE_SIZE)
+    names = _fields(CAFE_FIELDS)
+
+    query = db.session.query(*_columns(CAFE_FIELDS, names, *sort_columns))
+
+    city_code = request.args.get("city_code")
+    if city_code:
+        query = query.filter(Cafe.city_code == city_code)
+
+    page = keyset_page(
+        query, sort_columns, key=key, per_page=limit,
+        after=after or None, descending=descending, sort=sort)
+
+    return _stream_list(
+        [_render(CAFE_FIELDS, names, row) for row in page.items],
+        page.next_cursor)
+
+
+@api.get("/cafes/<int:cafe_id>")
+@query_budget(3)
+def get_cafe(cafe_id):
+    """One cafe."""
+
+    names = _fields(CAFE_FIELDS)
+
+    row = (db.session.query(*_columns(CAFE_FIELDS, names))
+           .filter(Cafe.id == cafe_id)
+           .first())
+    if row is None:
+        abort(404, f"No cafe {cafe_id}")
+
+    return jsonify({"data": _render(CAFE_FIELDS, names, row)})
+
+
+@api.get("/cafes/search")
+@query_budget(3)
+def search_cafes():
+    """Full-text search of cafes, best match first (see Cafe.search)."""
+
+    limit = _int_arg("limit", 20, 1, MAX_SEARCH_RESULTS)
+    names = _fields(CAFE_FIELDS)
+
+    cafes = Cafe.search(
+        request.args.get("q", ""),
+        city_code=request.args.get("city_code") or None,
+        limit=limit,
+        columns=_columns(CAFE_FIELDS, names),
+    )
+
+    return _stream_list([_render(CAFE_FIELDS, names, cafe) for cafe in cafes])
+
+
+##############################################################################
+# cities
+
+@api.get("/cities")
+@query_budget(2)
+def list_cities():
+    """Every city, by name. (There are few, so this isn't paged.)"""
+
+    names = _fields(CITY_FIELDS)
+
+    return _stream_list(
+        [_render(CITY_FIELDS, names, city) for city in city_registry.all()])
+
+
+@api.get("/cities/<code>")
+@query_budget(2)
+def get_city(code):
+    """One city."""
+
+    names = _fields(CITY_FIELDS)
+
+    city = city_registry.get(code)
+    if city is None:
+        abort(404, f"No city {code!r}")
+
+    return jsonify({"data": _render(CITY_FIELDS, names, city)})
+
+
+@api.get("/cities/search")
+@query_budget(2)
+def search_cities():
+    """Cities whose name contains ?q= (ignoring case), by name."""
+
+    q = request.args.get("q", "").strip().casefold()
+    limit = _int_arg("limit", 20, 1, MAX_SEARCH_RESULTS)
+    names = _fields(CITY_FIELDS)
+
+    cities = [city for city in city_registry.all()
+              if q and q in city.name.casefold()][:limit]
+
+    return _stream_list([_render(CITY_FIELDS, names, city) for city in cities])
+
+
+##############################################################################
+# likes
+
+def _require_login():
+    if not g.user:
+        abort(401, "Log in first")
+
+
+def _cafe_ids(values, name):
+    """List of cafe ids from a query string or JSON value; 400 if it isn't
+    one (or is too long)."""
+
+    if (not isinstance(values, list) or
+            not all(type(value) is int for value in values)):
+        abort(400, f"{name} must be a list of cafe ids")
+
+    if len(values) > MAX_BULK_LIKES:
+        abort(400, f"At most {MAX_BULK_LIKES} cafe ids in {name}")
+
+    return set(values)
+
+
+@api.get("/likes")
+@query_budget(2)
+def get_likes():
+    """Which of ?cafe_ids=1,2,3 the current user likes:
+    {"data": {"1": true, "2": false, "3": false}}."""
+
+    _require_login()
+
+    raw_ids = ",".join(request.args.getlist("cafe_ids")).split(",")
+    try:
+        values = [int(value) for value in raw_ids if value.strip()]
+    except ValueError:
+        abort(400, "cafe_ids must be a list of cafe ids")
+    cafe_ids = _cafe_ids(values, "cafe_ids")
+
+    liked = Like.liked_cafe_ids(g.user.id, cafe_ids)
+
+    return jsonify(
+        {"data": {str(cafe_id): cafe_id in liked for cafe_id in cafe_ids}})
+
+
+@api.post("/likes")
+@query_budget(3)
+def change_likes():
+    """Like and unlike many cafes at once, in one transaction.
+
+    Takes JSON {"like": [1, 2], "unlike": [3]}; returns the ids whose like
+    actually changed: {"data": {"liked": [1], "unliked": [3]}} (cafes that
+    were already liked, or don't exist, aren't in "liked").
+    """
+
+    _require_login()
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, 'Send JSON like {"like": [1, 2], "unlike": [3]}')
+
+    like = _cafe_ids(body.get("like", []), "like")
+    unlike = _cafe_ids(body.get("unlike", []), "unlike")
+
+    if like & unlike:
+        abort(400, "Can't like and unlike the same cafe")
+
+    liked = Like.add_many(g.user.id, like)
+    unliked = Like.remove_many(g.user.id, unlike)
+    db.session.commit()
+
+    if liked or unliked:
+        _likes_changed()
+
+    return jsonify(
+        {"data": {"liked": sorted(liked), "unliked": sorted(unliked)}})
@@ -1,36 +1,92 @@
 """Flask App for Flask Cafe."""
 
-from flask import Flask, render_template, redirect, flash, session, g, request, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Blueprint, Flask, current_app, render_template, redirect, flash, session,
+    g, request, jsonify, abort)
+from flask_wtf.csrf import CSRFProtect
 from sqlalchemy.exc import IntegrityError
-import os
-from dotenv import load_dotenv
-load_dotenv()
-
-from models import db, connect_db, Cafe, City, User, DEFAULT_USER_IMAGE_URL, Like, save_map
+import click
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from config import load_config
+from models import (
+    db, Cafe, City, User, DEFAULT_USER_IMAGE_URL, Like, LikeEvent, city_registry)
 from forms import CafeAddUpdateForm, UserAddForm, LoginForm, CSRFOnlyForm, ProfileEditForm
 from helpers import get_choices_vocab
+from pagination import keyset_page, decode_cursor
+from map_jobs import MapJobQueue, backfill_maps
+from principal import PrincipalCache
+from passwords import passwords, PasswordCheckBusy
+import mapping
+from mapping import evict_maps, MAP_FETCHERS
+from http_cache import cafe_page, apply_cache_policy
+from fragment_cache import FragmentCache
+from geocoding import GEOCODERS
+from instrumentation import Instrumentation, query_budget
+from api import api, is_api_request, json_error
+from trending import Trending
+from recommend import Recommender
+import migrations
+
+
+# routes, hooks and commands all live on this blueprint; create_app()
+# registers it (commands are top-level: `flask backfill-maps`, not
+# `flask cafe backfill-maps`)
+bp = Blueprint("cafe", __name__, cli_group=None)
+
+map_queue = MapJobQueue()
+principals = PrincipalCache()
+fragments = FragmentCache()
+trending = Trending()
+recommender = Recommender()
+instrumentation = Instrumentation()
 
+#necessary for token in base.html: axios.defaults.headers.common["X-CSRFToken"] = "{{ csrf_token() }}";
+#for how to use csrf_token with axios
+csrf = CSRFProtect()
 
-app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///flaskcafe'
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['MAPQUEST_API_KEY'] = os.environ['MAPQUEST_API_KEY']
+def create_app(profile=None, config=None):
+    """Make the Flask Cafe app.
 
+    `profile` is a config profile name from config.py (default: the
+    FLASK_CAFE_PROFILE environment variable, else "dev"); `config` is a dict
+    of settings to override on top of it (e.g. from tests).
 
-toolbar = DebugToolbarExtension(app)
+    Nothing touches the database here: use the app inside an app context
+    (requests and `flask` commands have one).
+    """
 
-connect_db(app)
+    app = Flask(__name__)
 
+    load_config(app, profile)
+    if config:
+        app.config.update(config)
+
+    # first, so its timings cover every other hook
+    instrumentation.init_app(app)
+    db.init_app(app)
+    passwords.init_app(app)
+    csrf.init_app(app)
+    map_queue.init_app(app)
+    principals.init_app(app)
+    fragments.init_app(app)
+    trending.init_app(app)
+    recommender.init_app(app)
+
+    # imported here so the prod profile doesn't load it at all
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+
+    return app
 
-#necessary for token in base.html: axios.defaults.headers.common["X-CSRFToken"] = "{{ csrf_token() }}";
-#for how to use csrf_token with axios
-from flask_wtf.csrf import CSRFProtect
-csrf = CSRFProtect(app)
 
 ######################################################################################
 # auth & auth routes
@@ -39,21 +95,41 @@ CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached Principal (id, username, admin, name), not a full
+    User; routes that need the whole row load it with User.query.get.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = principals.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
-@app.before_request
+@bp.before_app_request
+def start_map_queue():
+    """Make sure map workers are running (and resume any journaled jobs)."""
+
+    map_queue.start()
+
+@bp.before_app_request
+def start_recommender():
+    """Make sure the recommender's background thread is running."""
+
+    recommender.start()
+
+@bp.before_app_request
 def add_csrf_only_form():
-    """Add a CSRF-only form so that every route can use it."""
+    """Add a CSRF-only form (logout, like buttons) for logged-in users.
+
+    Only for them: making the form puts a CSRF token in the session, and a
+    response that sets a cookie can't be cached publicly (see http_cache).
+    """
 
-    g.csrf_form = CSRFOnlyForm()
+    g.csrf_form = CSRFOnlyForm() if g.user else None
 
 
 def do_login(user):
@@ -66,6 +142,7 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        principals.invalidate(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
@@ -74,7 +151,7 @@ def do_logout():
 # Show registration form.
 # POST /signup
 # Process registration; if valid, adds user and then log them in. Redirects to cafe list with flashed message “You are signed up and logged in.”
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -107,6 +184,12 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('auth/signup-form.html', form=form)
 
+        except PasswordCheckBusy:
+            db.session.rollback()
+            flash("Too many people logging in right now; please try again.",
+                  'danger')
+            return render_template('auth/signup-form.html', form=form), 503
+
         do_login(user)
         flash("You are signed up and logged in.", "success")
 
@@ -119,18 +202,25 @@ def signup():
 # Show login form.
 # POST /login
 # Process login; if valid, logs user in and redirects to wcafe list with flashed message “Hello, USERNAME!”
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(
-            form.username.data,
-            form.password.data)
+        try:
+            user = User.authenticate(
+                form.username.data,
+                form.password.data)
+        except PasswordCheckBusy:
+            flash("Too many people logging in right now; please try again.",
+                  'danger')
+            return render_template('auth/login-form.html', form=form), 503
 
         if user:
+            # saves password rehashed at a new cost, if any
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -142,13 +232,11 @@ def login():
 
 # POST /logout
 # Process logout. Redirects to homepage with flashed message “You should have successfully logged out.”
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
-    form = g.csrf_form
-
-    if not form.validate_on_submit() or not g.user:
+    if not g.user or not g.csrf_form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -162,7 +250,8 @@ def logout():
 
 # GET /profile
     # Show profile page.
-@app.get('/profile')
+@bp.get('/profile')
+@query_budget(5)
 def user_detail_page():
     """Shows user's profile page"""
 
@@ -170,16 +259,26 @@ def user_detail_page():
         flash("Access unauthorized. NOT_LOGGED_IN", "danger")
         return redirect("/login")
 
-    user = g.user
+    user = User.query.get_or_404(g.user.id)
+
+    liked = Like.liked_cafes_page(
+        user.id,
+        current_app.config['LIKED_CAFES_PER_PAGE'],
+        after=decode_cursor(request.args.get("after")),
+    )
 
-    return render_template("/users/detail.html", user=user)
+    suggestions = load_ranked_cafes(recommender.for_user(
+        user.id, current_app.config['RECOMMENDED_CAFES']))
+
+    return render_template(
+        "/users/detail.html", user=user, liked=liked, suggestions=suggestions)
 
 
 # GET /profile/edit
     # Show profile edit form.
 # POST /profile/edit
     # Process profile edit. On success, this should redirect to the profile page with the flashed message “Profile edited.”
-@app.route('/profile/edit', methods=["GET", "POST"])
+@bp.route('/profile/edit', methods=["GET", "POST"])
 def edit_profile():
     """Form editing a user's profile page"""
 
@@ -187,7 +286,7 @@ def edit_profile():
         flash("Access unauthorized. NOT_LOGGED_IN", "danger")
         return redirect("/login")
 
-    user = g.user
+    user = User.query.get_or_404(g.user.id)
     form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
@@ -198,6 +297,7 @@ def edit_profile():
         user.image_url = form.image_url.data or DEFAULT_USER_IMAGE_URL
 
         db.session.commit()
+        principals.invalidate(user.id)
         flash("Profile edited.", "success")
         return redirect(f"/profile")
 
@@ -209,7 +309,8 @@ def edit_profile():
 ######################################################################################
 # homepage
 
-@app.get("/")
+@bp.get("/")
+@query_budget(1)
 def homepage():
     """Show homepage."""
 
@@ -219,28 +320,152 @@ def homepage():
 ##############################################################################################
 # cafes
 
-@app.get('/cafes')
+CAFE_SORTS = {
+    # sort name: (keyset columns, cursor key, descending?)
+    "name": ([Cafe.name, Cafe.id], lambda cafe: (cafe.name, cafe.id), False),
+    "popular": ([Cafe.like_count, Cafe.id],
+                lambda cafe: (cafe.like_count, cafe.id), True),
+}
+
+
+def cafe_list_page(query):
+    """Return (sort name, KeysetPage) of `query` for the cafe list page this
+    request's ?sort=, ?after= and ?before= ask for.
+
+    `query` selects Cafes, or rows with the sort's columns (see CAFE_SORTS).
+    """
+
+    sort = request.args.get("sort", "name")
+    if sort not in CAFE_SORTS:
+        sort = "name"
+    columns, key, descending = CAFE_SORTS[sort]
+
+    page = keyset_page(
+        query,
+        columns,
+        key=key,
+        per_page=current_app.config['CAFES_PER_PAGE'],
+        after=decode_cursor(request.args.get("after"), sort=sort),
+        before=decode_cursor(request.args.get("before"), sort=sort),
+        descending=descending,
+        sort=sort,
+    )
+
+    return sort, page
+
+
+@bp.get('/cafes')
+@query_budget(3)
 def cafe_list():
-    """Return list of all cafes."""
+    """Return one page of cafes, ordered by name (or by likes with
+    ?sort=popular).
+
+    Pages are addressed by keyset cursors on the sort key: ?after=CURSOR for
+    the next page, ?before=CURSOR for the previous one. A cursor from the
+    other sort is ignored (first page).
+    """
+
+    sort, page = cafe_list_page(Cafe.query)
+
+    return cafe_page(
+        lambda: render_template(
+            'cafe/list.html', cafes=page.items, page=page, sort=sort),
+        "list", sort, page.next_cursor, page.prev_cursor,
+        city_registry.version,
+        *((cafe.id, cafe.revision, cafe.like_count) for cafe in page.items),
+    )
+
+
+MAX_SEARCH_RESULTS = 50
+
+# GET /cafes/search?q=TEXT&city_code=CODE
+# Show cafes matching the search text (optionally only in one city), best match first.
+@bp.get('/cafes/search')
+@query_budget(3)
+def search_cafes():
+    """Full-text search of cafes (see Cafe.search)."""
+
+    q = request.args.get("q", "").strip()
+    city_code = request.args.get("city_code") or None
 
-    cafes = Cafe.query.order_by('name').all()
+    cafes = Cafe.search(q, city_code=city_code, limit=MAX_SEARCH_RESULTS)
 
-    return render_template('cafe/list.html', cafes=cafes)
+    return render_template(
+        'cafe/search.html',
+        cafes=cafes,
+        q=q,
+        city_code=city_code,
+        cities=city_registry.choices(),
+    )
 
 
-@app.get('/cafes/<int:cafe_id>')
+def load_ranked_cafes(ranked):
+    """Turn [(cafe id, score), ...] into [(cafe, score), ...], in one
+    query."""
+
+    cafes = {
+        cafe.id: cafe
+        for cafe in Cafe.query.filter(
+            Cafe.id.in_([cafe_id for cafe_id, _ in ranked]))
+    } if ranked else {}
+
+    # (a cafe deleted since it was liked is skipped)
+    return [(cafes[cafe_id], score)
+            for cafe_id, score in ranked if cafe_id in cafes]
+
+
+def trending_cafes(limit, city_code=None):
+    """[(cafe, score), ...] of the most-trending cafes (in this city, if
+    given), best first; see trending.py."""
+
+    return load_ranked_cafes(trending.top(limit, city_code=city_code))
+
+
+# GET /cafes/trending?city_code=CODE
+# Show the cafes liked most lately (optionally only in one city), most first.
+@bp.get('/cafes/trending')
+@query_budget(4)
+def trending_cafes_page():
+    """Show the trending cafes."""
+
+    city_code = request.args.get("city_code") or None
+
+    return render_template(
+        'cafe/trending.html',
+        trending=trending_cafes(
+            current_app.config['TRENDING_CAFES'], city_code),
+        city_code=city_code,
+        cities=city_registry.choices(),
+    )
+
+
+@bp.get('/cafes/<int:cafe_id>')
+@query_budget(4)
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe, and cafes liked by the same people."""
 
     cafe = Cafe.query.get_or_404(cafe_id)
-
-    return render_template('cafe/detail.html', cafe=cafe)
+    map_url = cafe.map_url()
+    similar = load_ranked_cafes(recommender.similar(
+        cafe.id, current_app.config['SIMILAR_CAFES']))
+
+    # missing (or evicted) map: fetch it for next time
+    if map_url is None:
+        map_queue.enqueue(*cafe.map_location())
+
+    return cafe_page(
+        lambda: render_template(
+            'cafe/detail.html', cafe=cafe, map_url=map_url, similar=similar),
+        "detail", cafe.id, cafe.revision, cafe.like_count, map_url,
+        city_registry.version,
+        *((other.id, other.revision) for other, _ in similar),
+    )
 
 # GET /cafes/add
 # Show form for adding a cafe
 # POST /cafes/add
 # Handle adding new cafe. On success, redirect to new cafe detail page with flash message “CAFENAME added.”
-@app.route('/cafes/add', methods=["GET", "POST"])
+@bp.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe():
     """Form for adding a cafe"""
 
@@ -266,7 +491,8 @@ def add_cafe():
             db.session.add(cafe)
             db.session.commit()
 
-            save_map(cafe.id, cafe.address, cafe.city.name, cafe.city.state)
+            fragments.invalidate(cafe.id)
+            map_queue.enqueue(*cafe.map_location())
 
             flash(f"{cafe.name} added!")
 
@@ -284,7 +510,7 @@ def add_cafe():
 # Show form for editing cafe
 # POST /cafes/[cafe-id]/edit
 # Handle editing cafe. On success, redirect to cafe detail page with flash message “CAFENAME edited.”
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe(cafe_id):
     """Shows form for editing cafe info"""
 
@@ -297,6 +523,8 @@ def edit_cafe(cafe_id):
 
     if form.validate_on_submit():
 
+        old_location = (cafe.address, cafe.city_code)
+
         cafe.name = form.data.get("name", cafe.name)
         cafe.description = form.data.get("description", cafe.description)
         cafe.url = form.data.get("url", cafe.url)
@@ -304,8 +532,18 @@ def edit_cafe(cafe_id):
         cafe.city_code = form.data.get("city_code", cafe.city_code)
         cafe.image_url = form.data.get("image_url", cafe.image_url)
 
+        if (cafe.address, cafe.city_code) != old_location:
+            # no longer where we thought; geocode-cafes will find it again
+            cafe.latitude = cafe.longitude = None
+
         db.session.commit()
 
+        fragments.invalidate(cafe.id)
+        trending.move_cafe(cafe.id, cafe.city_code)
+
+        if (cafe.address, cafe.city_code) != old_location:
+            map_queue.enqueue(*cafe.map_location())
+
         flash(f"{cafe.name} edited")
         return redirect(f"/cafes/{cafe.id}")
 
@@ -314,7 +552,8 @@ def edit_cafe(cafe_id):
 
 # GET /api/likes
 # Given cafe_id in the URL query string, figure out if the current user likes that cafe, and return JSON: {"likes": true|false}
-@app.get('/api/likes')
+@bp.get('/api/likes')
+@query_budget(2)
 def get_likes():
     """checks to like status of cafe for the user"""
 
@@ -322,65 +561,428 @@ def get_likes():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.args['cafe_id'])
-    cafe = Cafe.query.get_or_404(cafe_id)
 
-    like = Like.query.filter_by(user_id=g.user.id, cafe_id=cafe.id).first()
-    likes = like is not None
+    likes = cafe_id in Like.liked_cafe_ids(g.user.id, [cafe_id])
 
     return jsonify({"likes": likes})
 
 
+MAX_LIKES_BATCH = 100
+
+# GET /api/likes/batch
+# Given cafe_ids=1,2,3 in the URL query string, return JSON: {"likes": {"1": true, "2": false, "3": false}}
+# Without cafe_ids, do the same for every cafe on a /cafes page: pass that page's sort/after/before.
+@bp.get('/api/likes/batch')
+@query_budget(2)
+def get_likes_batch():
+    """checks the like status of many cafes for the user at once"""
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    if "cafe_ids" not in request.args:
+        # the page's cafes, left joined to this user's likes: one query
+        _, page = cafe_list_page(
+            db.session.query(Cafe.id, Cafe.name, Cafe.like_count,
+                             Like.user_id)
+            .outerjoin(Like, db.and_(Like.cafe_id == Cafe.id,
+                                     Like.user_id == g.user.id)))
+
+        return jsonify({"likes": {
+            str(row.id): row.user_id is not None for row in page}})
+
+    raw_ids = ",".join(request.args.getlist("cafe_ids")).split(",")
+
+    try:
+        cafe_ids = {int(cafe_id) for cafe_id in raw_ids if cafe_id.strip()}
+    except ValueError:
+        return jsonify({"error": "cafe_ids must be integers"}), 400
+
+    if len(cafe_ids) > MAX_LIKES_BATCH:
+        return jsonify(
+            {"error": f"At most {MAX_LIKES_BATCH} cafe_ids per request"}), 400
+
+    liked = Like.liked_cafe_ids(g.user.id, cafe_ids)
+
+    return jsonify(
+        {"likes": {str(cafe_id): cafe_id in liked for cafe_id in cafe_ids}})
+
+
+MAX_NEARBY_RADIUS_KM = 50
+MAX_NEARBY_RESULTS = 50
+
+# GET /cafes/nearby?lat=37.79&lng=-122.40&radius=2&limit=10
+# Return JSON {"cafes": [{"id": 1, ..., "distance_km": 0.4}, ...]}, nearest first (radius in km).
+@bp.get('/cafes/nearby')
+@query_budget(2)
+def nearby_cafes():
+    """Find the cafes nearest a point (see Cafe.nearby)."""
+
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        radius = float(request.args.get("radius", 2))
+        limit = int(request.args.get("limit", 10))
+    except (KeyError, ValueError):
+        return jsonify(
+            {"error": "lat and lng are required; lat, lng, radius and "
+                      "limit must be numbers"}), 400
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"error": "lat/lng out of range"}), 400
+
+    if not 0 < radius <= MAX_NEARBY_RADIUS_KM:
+        return jsonify(
+            {"error": f"radius must be between 0 and {MAX_NEARBY_RADIUS_KM} km"}
+        ), 400
+
+    if not 1 <= limit <= MAX_NEARBY_RESULTS:
+        return jsonify(
+            {"error": f"limit must be between 1 and {MAX_NEARBY_RESULTS}"}), 400
+
+    nearest = Cafe.nearby(lat, lng, radius, limit=limit)
+
+    return jsonify({"cafes": [
+        dict(cafe.serialize(), distance_km=round(distance, 3))
+        for cafe, distance in nearest
+    ]})
+
+
+# GET /api/cafes/search?q=TEXT&city_code=CODE&limit=N
+# Return JSON {"cafes": [{"id": 1, "name": ..., "city": "San Francisco, CA", ...}, ...]}, best match first.
+@bp.get('/api/cafes/search')
+@query_budget(3)
+def search_cafes_api():
+    """Full-text search of cafes, as JSON (for autocomplete)."""
+
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    if not 1 <= limit <= MAX_SEARCH_RESULTS:
+        return jsonify(
+            {"error": f"limit must be between 1 and {MAX_SEARCH_RESULTS}"}), 400
+
+    cafes = Cafe.search(
+        request.args.get("q", ""),
+        city_code=request.args.get("city_code") or None,
+        limit=limit,
+    )
+
+    return jsonify({"cafes": [cafe.serialize() for cafe in cafes]})
+
+
+MAX_TRENDING_CAFES = 100
+
+# GET /api/cafes/trending?city_code=CODE&limit=N
+# Return JSON {"cafes": [{"id": 1, "name": ..., "score": 12.5, ...}, ...]}, most trending first.
+@bp.get('/api/cafes/trending')
+@query_budget(4)
+def trending_cafes_api():
+    """The trending cafes, as JSON. A cafe's score is roughly how many
+    likes it got lately: each counts for less the older it is."""
+
+    try:
+        limit = int(request.args.get(
+            "limit", current_app.config['TRENDING_CAFES']))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    if not 1 <= limit <= MAX_TRENDING_CAFES:
+        return jsonify(
+            {"error": f"limit must be between 1 and {MAX_TRENDING_CAFES}"}
+        ), 400
+
+    top = trending_cafes(limit, request.args.get("city_code") or None)
+
+    return jsonify({
+        "cafes": [{**cafe.serialize(), "score": round(score, 3)}
+                  for cafe, score in top],
+    })
+
+
+MAX_LIKED_CAFES_PAGE = 100
+
+# GET /api/profile/likes?after=CURSOR&limit=N
+# Return JSON {"cafes": [{"id": 1, "name": ..., "city": "San Francisco, CA", "url": "/cafes/1", "liked_at": "2023-..."}, ...], "next": CURSOR or null}, most recently liked first.
+@bp.get('/api/profile/likes')
+@query_budget(3)
+def get_liked_cafes():
+    """One page of the current user's liked cafes (for infinite scroll)."""
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    try:
+        limit = int(request.args.get(
+            "limit", current_app.config['LIKED_CAFES_PER_PAGE']))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    if not 1 <= limit <= MAX_LIKED_CAFES_PAGE:
+        return jsonify(
+            {"error": f"limit must be between 1 and {MAX_LIKED_CAFES_PAGE}"}
+        ), 400
+
+    page = Like.liked_cafes_page(
+        g.user.id, limit, after=decode_cursor(request.args.get("after")))
+
+    return jsonify({
+        "cafes": [
+            {"id": cafe.id, "name": cafe.name, "city": cafe.city,
+             "url": f"/cafes/{cafe.id}", "liked_at": cafe.liked_at.isoformat()}
+            for cafe in page
+        ],
+        "next": page.next_cursor,
+    })
+
+
 # POST /api/like
 # Given JSON {"cafe_id": 1}, make the current user like cafe #1. Return JSON {"liked": 1}.
 # POST /api/unlike
 # Given JSON {"cafe_id": 1}, make the current user unlike cafe #1. Return JSON {"unliked": 1}.
 
-@app.post('/api/toggle_like/<int:cafe_id>')
+@bp.post('/api/toggle_like/<int:cafe_id>')
+@query_budget(2)
 def toggle_like(cafe_id):
     """Toggle a cafe like status for the currently-logged-in user.
+
+    One statement (see Like.toggle) that neither loads the cafe nor its
+    other likers, so this costs the same for a cafe with one like as for
+    one with 100k.
     """
 
     if not g.user:
         return jsonify({"error": "Not logged in"})
 
-    cafe = Cafe.query.get_or_404(cafe_id)
-
-    form = g.csrf_form
-
-    if not form.validate_on_submit() or not g.user:
+    if not g.csrf_form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    if g.user in cafe.liking_users:
-        cafe.unlike_cafe(g.user)
-        status = {"unliked": cafe_id}
-        db.session.commit()
-        return jsonify(status)
+    liked = Like.toggle(g.user.id, cafe_id)
+    if liked is None:
+        db.session.rollback()
+        abort(404)
+
+    status = {"liked": cafe_id} if liked else {"unliked": cafe_id}
+
+    db.session.commit()
+    trending.mark_stale()
+    recommender.mark_stale()
+    return jsonify(status)
+
+##############################################################################
+# maintenance commands
+
+@bp.cli.command("reconcile-like-counts")
+def reconcile_like_counts():
+    """Recompute every cafe's and user's like_count from the likes table."""
+
+    fixed_cafes = Cafe.reconcile_like_counts()
+    fixed_users = User.reconcile_like_counts()
+    db.session.commit()
+
+    click.echo(f"Reconciled like counts: {fixed_cafes} cafe(s) corrected, "
+               f"{fixed_users} user(s) corrected.")
+
+
+@bp.cli.command("evict-maps")
+def evict_maps_command():
+    """Trim the map cache to its configured size and age limits."""
+
+    removed, freed = evict_maps()
+
+    click.echo(f"Evicted {removed} map(s), freeing {freed / 2**20:.1f} MB.")
+
+
+@bp.cli.command("prune-fragments")
+def prune_fragments_command():
+    """Trim the file fragment cache to its configured size and age limits."""
+
+    removed = fragments.prune()
+
+    click.echo(f"Pruned {removed} fragment(s).")
+
+
+@bp.cli.command("backfill-maps")
+@click.option("--workers", default=16, show_default=True,
+              help="Maps to fetch at once.")
+@click.option("--batch-size", default=500, show_default=True,
+              help="Cafes to read from the database at a time.")
+@click.option("--after-id", default=0, show_default=True,
+              help="Skip cafes up to this id (to resume a previous run).")
+def backfill_maps_command(workers, batch_size, after_id):
+    """Fetch maps for every cafe whose map is missing or stale."""
+
+    mapping.configure(max_concurrency=workers)
+
+    stats = backfill_maps(
+        Cafe.iter_map_locations(after_id=after_id, batch_size=batch_size),
+        fetch=MAP_FETCHERS[current_app.config['MAP_FETCHER']],
+        workers=workers,
+        max_age=mapping.MAP_CACHE_MAX_AGE,
+        progress=lambda stats: click.echo(str(stats)),
+    )
+
+    click.echo(f"Done: {stats}")
+
+    for cafe_id, error in stats.failed[:20]:
+        click.echo(f"  cafe {cafe_id}: {error}", err=True)
+
+    if stats.failed:
+        click.echo(
+            "Re-run to retry failed maps (cached maps are skipped).", err=True)
+        raise SystemExit(1)
+
+
+@bp.cli.command("geocode-cafes")
+@click.option("--workers", default=8, show_default=True,
+              help="Addresses to look up at once.")
+@click.option("--batch-size", default=500, show_default=True,
+              help="Cafes to read (and save) at a time.")
+def geocode_cafes_command(workers, batch_size):
+    """Fill in latitude/longitude of every cafe that doesn't have them."""
+
+    geocode = GEOCODERS[current_app.config['GEOCODER']]
+    found = missing = 0
+
+    def lookup(row):
+        cafe_id, address, city, state = row
+        try:
+            return cafe_id, geocode(address, city, state)
+        except Exception as exc:
+            click.echo(f"  cafe {cafe_id}: {exc}", err=True)
+            return cafe_id, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in Cafe.iter_map_locations(
+                batch_size=batch_size, not_geocoded=True):
+            locations = []
+            for cafe_id, location in pool.map(lookup, batch):
+                if location is None:
+                    missing += 1
+                else:
+                    locations.append((cafe_id, *location))
+
+            Cafe.set_locations(locations)
+            db.session.commit()
+
+            found += len(locations)
+            click.echo(f"{found} cafe(s) geocoded, {missing} not found...")
+
+    click.echo(f"Done: {found} cafe(s) geocoded, {missing} not found.")
+
+
+@bp.cli.group("db")
+def db_commands():
+    """Database schema migrations (see migrations.py)."""
+
+
+@db_commands.command("status")
+def db_status_command():
+    """List migrations, and whether each has been run."""
+
+    applied = migrations.applied_versions()
+
+    for migration in migrations.MIGRATIONS:
+        state = "applied" if migration.version in applied else "PENDING"
+        click.echo(f"{migration.version}  {state:8} {migration.description}")
+
+
+@db_commands.command("upgrade")
+def db_upgrade_command():
+    """Run every migration that hasn't been run yet."""
+
+    ran = migrations.upgrade(
+        progress=lambda m: click.echo(f"Running {m.version}: {m.description}"))
+
+    click.echo(f"Done: {len(ran)} migration(s) run.")
+
+
+@db_commands.command("stamp")
+def db_stamp_command():
+    """Mark every migration as run (for a database made by create_all)."""
+
+    stamped = migrations.stamp()
+
+    click.echo(f"Marked {len(stamped)} migration(s) as run.")
+
+
+@bp.cli.group("like-events")
+def like_event_commands():
+    """The like event log (see models.LikeEvent)."""
+
+
+@like_event_commands.command("partitions")
+@click.option("--months-ahead", default=2, show_default=True,
+              help="make partitions this many months past the current one")
+def like_events_partitions_command(months_ahead):
+    """Make monthly partitions for upcoming events (run this from cron)."""
+
+    made = LikeEvent.create_partitions(months_ahead=months_ahead)
+    db.session.commit()
+
+    click.echo(f"Made {len(made)} partition(s). {' '.join(made)}")
+
+
+@like_event_commands.command("prune")
+@click.option("--keep-days", default=90, show_default=True,
+              help="keep at least this many days of events")
+def like_events_prune_command(keep_days):
+    """Drop monthly partitions of events older than --keep-days."""
+
+    dropped = LikeEvent.drop_partitions(
+        date.today() - timedelta(days=keep_days))
+    db.session.commit()
+
+    click.echo(f"Dropped {len(dropped)} partition(s). {' '.join(dropped)}")
+
+
+@like_event_commands.command("tail")
+@click.option("--cursor", help="start after this cursor (from an earlier run)")
+@click.option("--limit", default=1000, show_default=True,
+              help="events per batch")
+@click.option("--follow", is_flag=True, help="keep waiting for new events")
+@click.option("--interval", default=1.0, show_default=True,
+              help="seconds between checks when following")
+def like_events_tail_command(cursor, limit, follow, interval):
+    """Print events as JSON lines, oldest first, then the cursor to carry on
+    from (on stderr)."""
+
+    try:
+        while True:
+            events, cursor = LikeEvent.tail(cursor, limit=limit)
+            # don't hold a snapshot open while waiting
+            db.session.commit()
+
+            for event in events:
+                click.echo(json.dumps(event.serialize()))
+
+            if len(events) < limit:
+                if not follow:
+                    break
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        click.echo(f"cursor: {cursor or ''}", err=True)
 
-    else:
-        cafe.like_cafe(g.user)
-        status = {"liked": cafe_id}
-        db.session.commit()
-        return jsonify(status)
 
 ######################404Page ###################
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_note_found(e):
     """ Show a custom 404 page """
+    if is_api_request():
+        return json_error(e)
     return render_template("404.html")
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
-
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
\ No newline at end of file
+# HTTP caching (see http_cache.py)
+
+@bp.after_app_request
+def add_cache_headers(response):
+    """Mark responses as cacheable (or not); see http_cache.py."""
+
+    return apply_cache_policy(response)
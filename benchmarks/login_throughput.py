@@ -0,0 +1,71 @@
+"""Benchmark: how many password checks (logins) per second per core, at
+different bcrypt costs.
+
+Run from the app directory:
+
+    python -m benchmarks.login_throughput --costs 10,11,12,13 --seconds 3
+
+For each cost this checks passwords on one thread, then on a pool of one
+thread per core (the way passwords.PasswordHasher runs them), and reports
+logins/second overall and per core. Use it to pick BCRYPT_LOG_ROUNDS: each
+extra round doubles the time per login.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+PASSWORD = b"correct horse battery staple"
+
+
+def checks_per_second(hashed, threads, seconds):
+    """Check PASSWORD against hashed on `threads` threads for about
+    `seconds`; return checks per second."""
+
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        count = 0
+        while time.perf_counter() < deadline:
+            assert bcrypt.checkpw(PASSWORD, hashed)
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        total = sum(pool.map(lambda _: worker(), range(threads)))
+    elapsed = time.perf_counter() - start
+
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--costs", default="10,11,12,13",
+                        help="comma-separated bcrypt costs to try")
+    parser.add_argument("--seconds", type=float, default=3,
+                        help="how long to run each measurement")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1,
+                        help="threads for the parallel measurement")
+    args = parser.parse_args()
+
+    print(f"{'cost':>4}  {'ms/login':>8}  {'1 thread/s':>10}  "
+          f"{args.threads} threads/s  per core/s")
+
+    for cost in [int(cost) for cost in args.costs.split(",")]:
+        hashed = bcrypt.hashpw(PASSWORD, bcrypt.gensalt(rounds=cost))
+
+        single = checks_per_second(hashed, 1, args.seconds)
+        parallel = checks_per_second(hashed, args.threads, args.seconds)
+
+        print(f"{cost:>4}  {1000 / single:>8.1f}  {single:>10.1f}  "
+              f"{parallel:>{len(str(args.threads)) + 11}.1f}  "
+              f"{parallel / args.threads:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
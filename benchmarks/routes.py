@@ -0,0 +1,282 @@
+"""Benchmark: latency and throughput of the core routes.
+
+Seed the bench database with synthetic data, then run from the app
+directory:
+
+    FLASK_CAFE_PROFILE=bench python seed.py --synthetic \
+        --cafes 10000 --users 5000 --likes 100000
+    python -m benchmarks.routes --requests 500 --concurrency 4 \
+        --output results.json --baseline benchmarks/baseline.json
+
+Each scenario (see SCENARIOS) sends --requests requests from --concurrency
+threads through Flask's test client, after --warmup untimed ones. That
+measures the app and the database, not the network or a WSGI server.
+For each scenario this reports p50/p95/p99 latency and requests/second,
+and can save the results as JSON.
+
+With --baseline, each scenario is compared with the same scenario in an
+earlier results file. It has regressed if its p95 latency grew, or its
+requests/second fell, by more than --threshold (default 20%); the command
+then exits 1. Refresh the baseline with --output benchmarks/baseline.json
+when a change is meant to move the numbers. Only compare runs from the
+same machine and data sizes: the results record both, along with the
+Python and PostgreSQL versions.
+
+benchmarks/baseline.json is the committed baseline, from the seed command
+above on the machine it names. On other hardware, make a local baseline
+from a clean checkout first and compare against that instead.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from app import create_app, CURR_USER_KEY
+from models import db, Cafe, User
+from seed import SYNTHETIC_PASSWORD
+
+
+# `request(client, rng, dataset)` sends one request; `status` is the status
+# code it should get. Logged-in scenarios run as one random user per thread.
+Scenario = namedtuple("Scenario", ["request", "status", "logged_in"])
+
+Dataset = namedtuple("Dataset", ["cafes", "users"])
+
+
+def _cafe_id(rng, dataset):
+    return rng.randint(1, dataset.cafes)
+
+
+SCENARIOS = {
+    "cafe_list": Scenario(
+        lambda client, rng, dataset: client.get(
+            rng.choice(["/cafes", "/cafes?sort=popular"])),
+        200, False),
+    "cafe_detail": Scenario(
+        lambda client, rng, dataset: client.get(
+            f"/cafes/{_cafe_id(rng, dataset)}"),
+        200, False),
+    "likes": Scenario(
+        lambda client, rng, dataset: client.get(
+            f"/api/likes?cafe_id={_cafe_id(rng, dataset)}"),
+        200, True),
+    "toggle_like": Scenario(
+        lambda client, rng, dataset: client.post(
+            f"/api/toggle_like/{_cafe_id(rng, dataset)}"),
+        200, True),
+    "login": Scenario(
+        lambda client, rng, dataset: client.post("/login", data={
+            "username": f"user{rng.randint(1, dataset.users)}",
+            "password": SYNTHETIC_PASSWORD,
+        }),
+        302, False),
+}
+
+
+def load_dataset():
+    """Return sizes of the synthetic data in the database (see seed.py)."""
+
+    return Dataset(
+        cafes=db.session.query(db.func.max(Cafe.id)).scalar() or 0,
+        users=db.session.query(db.func.max(User.id)).scalar() or 0,
+    )
+
+
+def percentile(values, pct):
+    """pct-th percentile of sorted values (nearest rank)."""
+
+    if not values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """Return stats for one scenario, from its request latencies in
+    seconds, how many requests failed, and wall-clock seconds taken."""
+
+    latencies = sorted(latencies)
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+    }
+
+
+def run_scenario(app, scenario, dataset, requests, concurrency, warmup=0,
+                 random_seed=0):
+    """Run scenario `requests` times across `concurrency` threads; return
+    its stats (see summarize)."""
+
+    def worker(i, n):
+        rng = random.Random(random_seed * 1000 + i)
+        client = app.test_client()
+
+        if scenario.logged_in:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = rng.randint(1, dataset.users)
+
+        latencies = []
+        errors = 0
+
+        for _ in range(n):
+            start = time.perf_counter()
+            resp = scenario.request(client, rng, dataset)
+            latencies.append(time.perf_counter() - start)
+
+            if resp.status_code != scenario.status:
+                errors += 1
+
+        return latencies, errors
+
+    # one thread's worth, unmeasured, to fill caches and the connection pool
+    if warmup:
+        worker(-1, warmup)
+
+    shares = [requests // concurrency + (i < requests % concurrency)
+              for i in range(concurrency)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, range(concurrency), shares))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for result, _ in results for latency in result]
+    errors = sum(errors for _, errors in results)
+
+    return summarize(latencies, errors, elapsed)
+
+
+def compare(results, baseline, threshold=0.2):
+    """Compare results with an earlier run.
+
+    Returns list of (scenario, metric, baseline value, current value,
+    change as a fraction, regressed?) for p95_ms and rps of every scenario
+    in both runs.
+    """
+
+    rows = []
+
+    for name, now in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+
+        for metric, higher_is_worse in [("p95_ms", True), ("rps", False)]:
+            old, new = before.get(metric), now.get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) / old
+            worse = change if higher_is_worse else -change
+            rows.append((name, metric, old, new, change, worse > threshold))
+
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--profile", default="bench",
+                        help="config profile (see config.py)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma-separated scenarios to run")
+    parser.add_argument("--requests", type=int, default=500,
+                        help="timed requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="threads sending requests")
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="untimed requests per scenario, first")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="regression threshold, as a fraction")
+    args = parser.parse_args()
+
+    app = create_app(args.profile)
+    app.app_context().push()
+
+    dataset = load_dataset()
+    if not dataset.cafes or not dataset.users:
+        parser.error("no data; seed it first: python seed.py --synthetic")
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "machine": {"platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "python": platform.python_version(),
+                    "postgres": db.session.execute(
+                        db.text("SHOW server_version")).scalar()},
+        "profile": args.profile,
+        "dataset": dataset._asdict(),
+        "settings": {"requests": args.requests,
+                     "concurrency": args.concurrency,
+                     "warmup": args.warmup},
+        "scenarios": {},
+    }
+
+    print(f"{'scenario':<12} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>6}")
+
+    for name in args.scenarios.split(","):
+        stats = run_scenario(
+            app, SCENARIOS[name], dataset, args.requests, args.concurrency,
+            warmup=args.warmup, random_seed=args.random_seed)
+        results["scenarios"][name] = stats
+
+        print(f"{name:<12} {stats['rps']:>9.1f} {stats['p50_ms']:>8.2f} "
+              f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+              f"{stats['errors']:>6}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline.get("dataset") != results["dataset"]:
+            print("\nwarning: baseline was run on different data sizes")
+
+        rows = compare(results, baseline, args.threshold)
+
+        print(f"\nvs {args.baseline} ({baseline.get('git_commit')}):")
+        for name, metric, old, new, change, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:<12} {metric:<7} {old:>9.2f} -> {new:>9.2f} "
+                  f"({change:+.0%}){flag}")
+
+        if any(row[-1] for row in rows):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
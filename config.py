@@ -0,0 +1,248 @@
+"""Configuration profiles for Flask Cafe.
+
+create_app() (in app.py) loads one of these, picked by name or by the
+FLASK_CAFE_PROFILE environment variable ("dev" if unset):
+
+- dev:  local development; SQL echo and the debug toolbar.
+- test: the test database, cheap bcrypt, no CSRF, no external calls.
+- prod: no echo or toolbar, a sized connection pool with pre-ping, and a
+        statement timeout so a runaway query can't hold a worker forever.
+- bench: prod, but on its own database and without CSRF (for the
+        benchmarks in benchmarks/).
+
+The classes only hold defaults. Settings that can come from the
+environment (see load_config) are read when the app is created, not when
+this module is imported.
+"""
+
+import os
+import time
+
+from dotenv import load_dotenv
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///flaskcafe'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # environment variable holding the database URL for this profile
+    DATABASE_URL_ENV = "DATABASE_URL"
+
+    SECRET_KEY = "shhhh"
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    MAPQUEST_API_KEY = None
+    CAFES_PER_PAGE = 24
+    LIKED_CAFES_PER_PAGE = 20
+
+    # static maps are fetched in the background; see map_jobs.py
+    # (MAP_JOBS_DIR defaults to <instance path>/map_jobs)
+    MAP_FETCHER = "mapquest"
+    MAP_JOBS_DIR = None
+    MAP_JOBS_WORKERS = 2
+    MAP_JOBS_MAX_ATTEMPTS = 5
+    MAP_JOBS_BACKOFF = 2.0
+    # a location given up on isn't fetched again for this many seconds
+    MAP_JOBS_FAILURE_TTL = 3600
+
+    # how `flask geocode-cafes` finds cafe locations; see geocoding.py
+    GEOCODER = "mapquest"
+
+    # bcrypt cost, and how many hashes may run at once (see passwords.py)
+    BCRYPT_LOG_ROUNDS = 12
+    BCRYPT_MAX_WORKERS = os.cpu_count() or 1
+    BCRYPT_QUEUE_TIMEOUT = 10
+
+    # who's logged in is cached per process for up to this many seconds
+    CURRENT_USER_CACHE_TTL = 60
+    CURRENT_USER_CACHE_SIZE = 10000
+
+    # anonymous cafe pages may be cached (by browsers and the CDN) this many
+    # seconds; after that they're revalidated with their ETag (see
+    # http_cache.py). Set RELEASE_ID per deploy so ETags survive restarts
+    # without outliving template changes (prod requires it; elsewhere each
+    # process makes up its own).
+    PUBLIC_PAGE_MAX_AGE = 60
+    ETAG_SALT = None
+
+    # rendered cafe cards / detail bodies (see fragment_cache.py); use "file"
+    # to share them between workers (FRAGMENT_CACHE_DIR defaults to
+    # <instance path>/fragments, and is trimmed to FRAGMENT_CACHE_SIZE and
+    # FRAGMENT_CACHE_MAX_AGE seconds by `flask prune-fragments`)
+    FRAGMENT_CACHE_BACKEND = "memory"
+    FRAGMENT_CACHE_DIR = None
+    FRAGMENT_CACHE_SIZE = 10000
+    FRAGMENT_CACHE_MAX_AGE = 7 * 24 * 3600
+
+    # per-request timings (see instrumentation.py): a Server-Timing header on
+    # every response, and Prometheus metrics at /metrics. Both are off in
+    # prod: turn METRICS_ENABLED on only where /metrics is kept off the
+    # public internet.
+    SERVER_TIMING = True
+    METRICS_ENABLED = True
+
+    # /cafes/trending ranks cafes by recent likes, each worth half as much
+    # every TRENDING_HALF_LIFE seconds; each process picks up other
+    # processes' likes every TRENDING_SYNC_INTERVAL seconds (see trending.py)
+    TRENDING_HALF_LIFE = 2 * 24 * 3600
+    TRENDING_SYNC_INTERVAL = 10
+    TRENDING_CAFES = 20
+
+    # "similar cafes" and "cafes you may like" (see recommend.py): each
+    # cafe's RECOMMENDER_NEIGHBORS most similar cafes are kept, and a
+    # background thread brings them up to date after likes, or every
+    # RECOMMENDER_REFRESH_INTERVAL seconds (0: no thread; call sync())
+    RECOMMENDER_NEIGHBORS = 20
+    RECOMMENDER_REFRESH_INTERVAL = 60
+    SIMILAR_CAFES = 4
+    RECOMMENDED_CAFES = 6
+
+
+class DevConfig(Config):
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+
+
+class TestConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///flaskcafe_test'
+    DATABASE_URL_ENV = "TEST_DATABASE_URL"
+
+    TESTING = True
+
+    # Don't req CSRF for testing
+    WTF_CSRF_ENABLED = False
+
+    # Cheapest bcrypt cost, so tests don't spend their time hashing
+    BCRYPT_LOG_ROUNDS = 4
+
+    # Don't call MapQuest
+    MAP_FETCHER = "stub"
+    GEOCODER = "stub"
+
+    # Tests sync the recommender themselves
+    RECOMMENDER_REFRESH_INTERVAL = 0
+
+
+class ProdConfig(Config):
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+    # milliseconds; 0 turns the timeout off
+    DB_STATEMENT_TIMEOUT = 5000
+
+    # don't hand timings or metrics to the public (see Config)
+    SERVER_TIMING = False
+    METRICS_ENABLED = False
+
+
+class BenchConfig(ProdConfig):
+    """Prod settings on a throwaway database, for benchmarks/routes.py."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///flaskcafe_bench'
+    DATABASE_URL_ENV = "BENCH_DATABASE_URL"
+
+    # the benchmark posts forms without fetching them first
+    WTF_CSRF_ENABLED = False
+
+    MAP_FETCHER = "stub"
+    GEOCODER = "stub"
+
+
+PROFILES = {
+    "dev": DevConfig,
+    "test": TestConfig,
+    "prod": ProdConfig,
+    "bench": BenchConfig,
+}
+
+
+def _env(name, cast=str):
+    value = os.environ.get(name)
+    return None if value in (None, "") else cast(value)
+
+
+def _flag(value):
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def load_config(app, profile=None):
+    """Load a profile into app.config, then apply environment overrides.
+
+    Raises ValueError for an unknown profile, and RuntimeError if prod is
+    missing a setting it can't run safely without.
+    """
+
+    load_dotenv()
+
+    profile = profile or os.environ.get("FLASK_CAFE_PROFILE", "dev")
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown config profile {profile!r}")
+
+    config = app.config
+    config.from_object(PROFILES[profile])
+    config['PROFILE'] = profile
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+    overrides = {
+        config['DATABASE_URL_ENV']: ('SQLALCHEMY_DATABASE_URI', str),
+        "FLASK_SECRET_KEY": ('SECRET_KEY', str),
+        "MAPQUEST_API_KEY": ('MAPQUEST_API_KEY', str),
+        "CAFES_PER_PAGE": ('CAFES_PER_PAGE', int),
+        "LIKED_CAFES_PER_PAGE": ('LIKED_CAFES_PER_PAGE', int),
+        "MAP_FETCHER": ('MAP_FETCHER', str),
+        "GEOCODER": ('GEOCODER', str),
+        "BCRYPT_LOG_ROUNDS": ('BCRYPT_LOG_ROUNDS', int),
+        "BCRYPT_MAX_WORKERS": ('BCRYPT_MAX_WORKERS', int),
+        "PUBLIC_PAGE_MAX_AGE": ('PUBLIC_PAGE_MAX_AGE', int),
+        "RELEASE_ID": ('ETAG_SALT', str),
+        "FRAGMENT_CACHE_BACKEND": ('FRAGMENT_CACHE_BACKEND', str),
+        "FRAGMENT_CACHE_DIR": ('FRAGMENT_CACHE_DIR', str),
+        "DB_STATEMENT_TIMEOUT": ('DB_STATEMENT_TIMEOUT', int),
+        "SERVER_TIMING": ('SERVER_TIMING', _flag),
+        "METRICS_ENABLED": ('METRICS_ENABLED', _flag),
+        "TRENDING_HALF_LIFE": ('TRENDING_HALF_LIFE', int),
+        "TRENDING_SYNC_INTERVAL": ('TRENDING_SYNC_INTERVAL', int),
+        "RECOMMENDER_REFRESH_INTERVAL": ('RECOMMENDER_REFRESH_INTERVAL', int),
+    }
+
+    for env_name, (key, cast) in overrides.items():
+        value = _env(env_name, cast)
+        if value is not None:
+            config[key] = value
+
+    engine_options = config['SQLALCHEMY_ENGINE_OPTIONS']
+    for env_name, option in [("DB_POOL_SIZE", "pool_size"),
+                             ("DB_MAX_OVERFLOW", "max_overflow")]:
+        value = _env(env_name, int)
+        if value is not None:
+            engine_options[option] = value
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if timeout:
+        engine_options['connect_args'] = {
+            "options": f"-c statement_timeout={timeout}"}
+
+    if config['ETAG_SALT'] is None and profile != "prod":
+        config['ETAG_SALT'] = str(time.time())
+    if config['MAP_JOBS_DIR'] is None:
+        config['MAP_JOBS_DIR'] = os.path.join(app.instance_path, "map_jobs")
+    if config['FRAGMENT_CACHE_DIR'] is None:
+        config['FRAGMENT_CACHE_DIR'] = os.path.join(
+            app.instance_path, "fragments")
+
+    if profile == "prod" and config['SECRET_KEY'] == Config.SECRET_KEY:
+        raise RuntimeError("Set FLASK_SECRET_KEY for the prod profile")
+    if profile == "prod" and config['ETAG_SALT'] is None:
+        # a per-process salt would give every worker different ETags
+        raise RuntimeError("Set RELEASE_ID for the prod profile")
@@ -0,0 +1,245 @@
+"""Cache of rendered cafe fragments (list cards, detail bodies).
+
+A cafe's markup only changes when the cafe is edited, so the parts of the
+cafe pages that don't depend on the viewer or on likes are rendered once and
+reused. Each entry is stamped with what it was rendered from -- the cafe's
+revision, its city, and the partial template's source -- so a stale entry
+is never served even if an invalidation is missed; views still invalidate
+explicitly after adding or editing a cafe.
+
+Backends (FRAGMENT_CACHE_BACKEND):
+
+- "memory" (default): an LRU dict per process.
+- "file": one file per fragment in FRAGMENT_CACHE_DIR, shared by every worker
+  on the host. Point it at a tmpfs like /dev/shm to keep it in memory.
+  Nothing is dropped as fragments are written, so run `flask
+  prune-fragments` from cron: it deletes fragments not rendered for
+  FRAGMENT_CACHE_MAX_AGE seconds (e.g. of deleted cafes), then the least
+  recently rendered beyond FRAGMENT_CACHE_SIZE.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+
+class MemoryBackend:
+    """Thread-safe LRU dict of up to `maxsize` fragments."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def prune(self):
+        """Nothing to do: set() already keeps it to maxsize. Returns 0."""
+
+        return 0
+
+
+class FileBackend:
+    """Fragments stored as files in `directory` (shared between processes).
+
+    Bounded only by prune(): up to `max_entries` files, none older than
+    `max_age` seconds (either may be None for no limit).
+    """
+
+    def __init__(self, directory, max_entries=None, max_age=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("UTF-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.html")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="UTF-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".html"):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+
+    def prune(self):
+        """Delete fragments last written over max_age seconds ago, then the
+        oldest until there are no more than max_entries (and any temp
+        files left by a crashed write). Returns how many were deleted."""
+
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+
+        now = time.time()
+        entries = []
+        removed = 0
+
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if filename.endswith(".html"):
+                entries.append((mtime, path))
+            elif filename.endswith(".tmp") and now - mtime > 60:
+                entries.append((0, path))
+
+        # oldest first
+        entries.sort()
+        count = len(entries)
+
+        for mtime, path in entries:
+            too_old = self.max_age is not None and now - mtime > self.max_age
+            too_many = self.max_entries is not None and count > self.max_entries
+            if not (too_old or too_many or mtime == 0):
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+
+            count -= 1
+            removed += 1
+
+        return removed
+
+
+class FragmentCache:
+    """Renders cafe partials through a cache."""
+
+    # partials cached per cafe (invalidate() drops all of them)
+    TEMPLATES = ("cafe/_card.html", "cafe/_detail_body.html")
+
+    def __init__(self, app=None, backend=None):
+        self.app = app
+        self.backend = backend
+        self._template_stamps = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Pick backend from config (unless given one) and make the
+        cafe_fragment() template function available."""
+
+        self.app = app
+
+        if self.backend is None:
+            if app.config['FRAGMENT_CACHE_BACKEND'] == "file":
+                self.backend = FileBackend(
+                    app.config['FRAGMENT_CACHE_DIR'],
+                    max_entries=app.config['FRAGMENT_CACHE_SIZE'],
+                    max_age=app.config['FRAGMENT_CACHE_MAX_AGE'])
+            else:
+                self.backend = MemoryBackend(app.config['FRAGMENT_CACHE_SIZE'])
+
+        app.add_template_global(self.render, "cafe_fragment")
+
+    def _template_stamp(self, template):
+        """Short hash of the partial's source, so editing it (and
+        redeploying) retires fragments rendered from the old version."""
+
+        stamp = self._template_stamps.get(template)
+
+        if stamp is None:
+            env = current_app.jinja_env
+            source, _, _ = env.loader.get_source(env, template)
+            stamp = hashlib.sha256(source.encode("UTF-8")).hexdigest()[:12]
+            self._template_stamps[template] = stamp
+
+        return stamp
+
+    def _stamp(self, template, cafe):
+        """What a fragment of this cafe was rendered from (one line)."""
+
+        city = cafe.get_city_state().replace("\n", " ")
+        return f"{cafe.revision}|{city}|{self._template_stamp(template)}"
+
+    def render(self, template, cafe):
+        """Return rendered partial for cafe, from the cache if it's current."""
+
+        key = f"{template}:{cafe.id}"
+        stamp = self._stamp(template, cafe)
+
+        entry = self.backend.get(key)
+        if entry is not None:
+            cached_stamp, _, html = entry.partition("\n")
+            if cached_stamp == stamp:
+                return Markup(html)
+
+        html = render_template(template, cafe=cafe)
+        self.backend.set(key, f"{stamp}\n{html}")
+        return Markup(html)
+
+    def invalidate(self, cafe_id):
+        """Drop every cached fragment of this cafe."""
+
+        for template in self.TEMPLATES:
+            self.backend.delete(f"{template}:{cafe_id}")
+
+    def clear(self):
+        self.backend.clear()
+
+    def prune(self):
+        """Trim the backend to its size and age limits; returns how many
+        fragments were dropped."""
+
+        return self.backend.prune()
@@ -0,0 +1,108 @@
+"""Geocoding cafe addresses (address -> latitude/longitude), and distances.
+
+Geocoders take (address, city, state) and return (latitude, longitude), or
+None if the address couldn't be found. They're run offline by the
+`flask geocode-cafes` command, never during a request; which one is used
+comes from the GEOCODER config setting (see GEOCODERS).
+"""
+
+import hashlib
+import math
+
+from instrumentation import track_upstream
+import mapping
+
+GEOCODE_URL = "https://www.mapquestapi.com/geocoding/v1/address"
+
+EARTH_RADIUS_KM = 6371.0
+
+# the stub geocoder scatters cafes up to this many degrees around this point
+STUB_CENTER = (37.7749, -122.4194)
+STUB_SPREAD = 0.05
+
+
+class GeocodeError(Exception):
+    """The geocoding service didn't give us an answer."""
+
+
+def geocode_mapquest(address, city, state):
+    """Look up location with the MapQuest geocoding API."""
+
+    # read through the module: mapping.configure() rebinds the timeouts
+    with track_upstream("mapquest_geocode"):
+        resp = mapping.get_session().get(
+            GEOCODE_URL,
+            params={"key": mapping.API_KEY,
+                    "location": f"{address}, {city}, {state}"},
+            timeout=(mapping.HTTP_CONNECT_TIMEOUT, mapping.HTTP_READ_TIMEOUT),
+        )
+
+    if resp.status_code != 200:
+        raise GeocodeError(f"MapQuest returned {resp.status_code} for {address}")
+
+    try:
+        locations = resp.json()["results"][0]["locations"]
+    except (ValueError, KeyError, IndexError):
+        raise GeocodeError(f"MapQuest sent a bad geocode response for {address}")
+
+    if not locations:
+        return None
+
+    lat_lng = locations[0]["latLng"]
+    return lat_lng["lat"], lat_lng["lng"]
+
+
+def geocode_stub(address, city, state):
+    """Offline stand-in for geocode_mapquest: a made-up location near
+    STUB_CENTER, always the same for the same address (for tests and
+    working without an API key)."""
+
+    digest = hashlib.sha256(
+        mapping.map_key(address, city, state).encode("UTF-8")).digest()
+
+    # two numbers in [-1, 1) from the hash
+    x = int.from_bytes(digest[:4], "big") / 2**31 - 1
+    y = int.from_bytes(digest[4:8], "big") / 2**31 - 1
+
+    lat, lng = STUB_CENTER
+    return lat + x * STUB_SPREAD, lng + y * STUB_SPREAD
+
+
+GEOCODERS = {
+    "mapquest": geocode_mapquest,
+    "stub": geocode_stub,
+}
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in km between two points."""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat, lng, radius_km):
+    """Return (min lat, max lat, min lng, max lng) of a box holding every
+    point within radius_km of (lat, lng).
+
+    The longitude range is None when the box would wrap around a pole or
+    the antimeridian; then every longitude has to be checked.
+    """
+
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = lat - dlat, lat + dlat
+
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), None, None
+
+    dlng = math.degrees(radius_km / EARTH_RADIUS_KM / math.cos(math.radians(lat)))
+    min_lng, max_lng = lng - dlng, lng + dlng
+
+    if min_lng < -180 or max_lng > 180:
+        return min_lat, max_lat, None, None
+
+    return min_lat, max_lat, min_lng, max_lng
@@ -1,5 +1,5 @@
-from models import City
+from models import city_registry
 
 def get_choices_vocab():
-    """Gets all cities in db"""
-    return [(city.code, city.name) for city in City.query.all()]
\ No newline at end of file
+    """Gets all cities in db (from the city registry, not the database)"""
+    return city_registry.choices()
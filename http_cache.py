@@ -0,0 +1,95 @@
+"""HTTP caching policy for Flask Cafe.
+
+- Cafe pages seen by anonymous users are the same for everyone, so they're
+  sent as public (cacheable by browsers and the CDN) with a strong ETag built
+  from whatever the page shows (see cafe_page). A request whose If-None-Match
+  still matches gets a 304 before any template is rendered.
+- Anything rendered for a logged-in user is private and revalidated.
+- Maps in the content-addressed cache, and our static images, never change
+  under the same URL, so they're marked immutable for a year.
+"""
+
+import hashlib
+
+from flask import current_app, g, make_response, request, session
+
+
+IMMUTABLE_MAX_AGE = 365 * 86400
+
+# static files (relative to /static/) that never change once published
+IMMUTABLE_STATIC_PREFIXES = ("maps/", "images/")
+
+
+def make_etag(*parts):
+    """Return an ETag value for a page showing these things.
+
+    Parts are stringified, so pass values (ids, revisions, counts) rather
+    than objects. ETAG_SALT is mixed in so a deploy that changes templates
+    doesn't keep answering 304 for pages that now look different.
+    """
+
+    text = "\x1f".join(
+        str(part) for part in (current_app.config['ETAG_SALT'], *parts))
+    return hashlib.sha256(text.encode("UTF-8")).hexdigest()[:32]
+
+
+def is_public_request():
+    """Can the response to this request be shared between users?
+
+    Only for anonymous GETs with no flash message waiting to be shown (the
+    page would include it, and showing it removes it from the session).
+    """
+
+    return (request.method in ("GET", "HEAD")
+            and g.get("user") is None
+            and not session.get("_flashes"))
+
+
+def cafe_page(render, *etag_parts):
+    """Return response for a cafe page, using HTTP caching when we can.
+
+    `render` is called (with no arguments) to make the page, unless this is
+    a public request whose If-None-Match already has the ETag made from
+    `etag_parts` -- then it's a 304 and nothing is rendered.
+    """
+
+    if not is_public_request():
+        return render()
+
+    etag = make_etag(*etag_parts)
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['PUBLIC_PAGE_MAX_AGE']
+    return response
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control on responses that haven't chosen their own."""
+
+    if request.endpoint == "static":
+        filename = (request.view_args or {}).get("filename", "")
+        if (response.status_code in (200, 304)
+                and filename.startswith(IMMUTABLE_STATIC_PREFIXES)):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+    # a public page must not hand out a cookie (e.g. a new CSRF token)
+    if response.cache_control.public and session.modified:
+        response.cache_control.public = False
+        response.cache_control.max_age = None
+        response.headers.pop("ETag", None)
+
+    if not response.cache_control.public:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    return response
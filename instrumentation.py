@@ -0,0 +1,395 @@
+"""Per-request instrumentation for Flask Cafe.
+
+For every request we count SQL statements and time spent in the database,
+in rendering templates, and waiting on upstream HTTP services (MapQuest).
+The numbers are:
+
+- sent back in a Server-Timing header (visible in browser dev tools),
+- added to process-wide totals served in Prometheus text format at
+  /metrics (per worker process; scrape each worker, or sum them), and
+- checked against the route's query budget, if it declares one with
+  @query_budget(n): going over is logged, and tests can make it fail
+  (see check_query_budget and record_requests).
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import (
+    current_app, g, has_request_context, request, before_render_template,
+    template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# request duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A route sent more SQL statements than its query budget allows."""
+
+
+def query_budget(max_queries):
+    """Declare the most SQL statements a view should need per request."""
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+class RequestStats:
+    """What one request spent its time on."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoint = None
+        self.budget = None
+        self.statements = []        # SQL sent, in order
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self.total_seconds = None
+        self._template_depth = 0
+        self._template_started = None
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    def server_timing(self):
+        """Return value for the Server-Timing header."""
+
+        metrics = [
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+        ]
+        if self.upstream_calls:
+            metrics.append(
+                f'upstream;dur={self.upstream_seconds * 1000:.1f};'
+                f'desc="{self.upstream_calls} calls"')
+        metrics.append(f'total;dur={self.total_seconds * 1000:.1f}')
+
+        return ", ".join(metrics)
+
+
+def current_stats():
+    """Return RequestStats for the request being handled, or None."""
+
+    if has_request_context():
+        return g.get("_request_stats")
+    return None
+
+
+def check_query_budget(stats):
+    """Raise QueryBudgetExceeded if this request went over its budget."""
+
+    if stats.budget is not None and stats.queries > stats.budget:
+        statements = "\n\n".join(stats.statements)
+        raise QueryBudgetExceeded(
+            f"{stats.endpoint} sent {stats.queries} queries, budget is "
+            f"{stats.budget}:\n\n{statements}")
+
+
+_recorders = []
+_recorders_lock = threading.Lock()
+
+
+@contextmanager
+def record_requests():
+    """Collect the RequestStats of every request finished in this block.
+
+        with record_requests() as requests:
+            client.get("/cafes")
+        check_query_budget(requests[-1])
+    """
+
+    records = []
+    with _recorders_lock:
+        _recorders.append(records)
+    try:
+        yield records
+    finally:
+        with _recorders_lock:
+            _recorders.remove(records)
+
+
+class Metrics:
+    """Process-wide totals, rendered in Prometheus text format."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)        # (endpoint, method, status)
+        self.durations = defaultdict(           # endpoint -> bucket counts
+            lambda: [0] * (len(self.buckets) + 1))
+        self.duration_sums = defaultdict(float)
+        self.queries = defaultdict(int)         # endpoint -> statements
+        self.db_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.budget_exceeded = defaultdict(int)
+        self.upstream_calls = defaultdict(int)  # service -> calls
+        self.upstream_seconds = defaultdict(float)
+
+    def observe_request(self, stats, method, status):
+        endpoint = stats.endpoint or "none"
+
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+
+            counts = self.durations[endpoint]
+            for i, bound in enumerate(self.buckets):
+                if stats.total_seconds <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.duration_sums[endpoint] += stats.total_seconds
+
+            self.queries[endpoint] += stats.queries
+            self.db_seconds[endpoint] += stats.db_seconds
+            self.template_seconds[endpoint] += stats.template_seconds
+
+            if stats.budget is not None and stats.queries > stats.budget:
+                self.budget_exceeded[endpoint] += 1
+
+    def observe_upstream(self, service, seconds):
+        with self._lock:
+            self.upstream_calls[service] += 1
+            self.upstream_seconds[service] += seconds
+
+    def render(self):
+        """Return all metrics as Prometheus text exposition format."""
+
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels)} {value}")
+
+        with self._lock:
+            family("flaskcafe_requests_total", "counter",
+                   "Requests handled.",
+                   [(dict(endpoint=e, method=m, status=s), n)
+                    for (e, m, s), n in sorted(self.requests.items())])
+
+            name = "flaskcafe_request_duration_seconds"
+            lines.append(f"# HELP {name} Time to handle a request.")
+            lines.append(f"# TYPE {name} histogram")
+            for endpoint, counts in sorted(self.durations.items()):
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, counts):
+                    labels = _labels(dict(endpoint=endpoint, le=bound))
+                    lines.append(f"{name}_bucket{labels} {count}")
+                labels = _labels(dict(endpoint=endpoint))
+                lines.append(
+                    f"{name}_sum{labels} {self.duration_sums[endpoint]:.6f}")
+                lines.append(f"{name}_count{labels} {counts[-1]}")
+
+            for name, help, values in [
+                ("flaskcafe_db_queries_total",
+                 "SQL statements sent.", self.queries),
+                ("flaskcafe_db_seconds_total",
+                 "Time spent in SQL statements.", self.db_seconds),
+                ("flaskcafe_template_seconds_total",
+                 "Time spent rendering templates.", self.template_seconds),
+                ("flaskcafe_query_budget_exceeded_total",
+                 "Requests that sent more SQL than their route's budget.",
+                 self.budget_exceeded),
+            ]:
+                family(name, "counter", help,
+                       [(dict(endpoint=e), v) for e, v in sorted(values.items())])
+
+            family("flaskcafe_upstream_requests_total", "counter",
+                   "HTTP requests to upstream services.",
+                   [(dict(service=s), n)
+                    for s, n in sorted(self.upstream_calls.items())])
+            family("flaskcafe_upstream_seconds_total", "counter",
+                   "Time spent waiting on upstream services.",
+                   [(dict(service=s), n)
+                    for s, n in sorted(self.upstream_seconds.items())])
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+                .replace('"', '\\"'))
+
+    return "{" + ",".join(
+        f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def track_upstream(service):
+    """Time an upstream HTTP call (counted for the current request, if
+    any, and in the process-wide metrics)."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe_upstream(service, elapsed)
+
+        stats = current_stats()
+        if stats is not None:
+            stats.upstream_calls += 1
+            stats.upstream_seconds += elapsed
+
+
+##############################################################################
+# hooks
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_started", []).append(
+        (cursor, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _, started = conn.info["query_started"].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.statements.append(statement)
+        stats.db_seconds += time.perf_counter() - started
+
+
+def _handle_error(context):
+    """A statement failed, so there'll be no after_cursor_execute for it:
+    drop its start time, or the connection's list grows forever."""
+
+    conn = context.connection
+    if conn is None or conn.invalidated:
+        return
+
+    # (ExceptionContext.cursor isn't always filled in; the execution
+    # context's is)
+    cursor = context.cursor
+    if cursor is None and context.execution_context is not None:
+        cursor = context.execution_context.cursor
+
+    started = conn.info.get("query_started")
+    if cursor is not None and started and started[-1][0] is cursor:
+        started.pop()
+
+
+def _before_render_template(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        # templates rendered inside templates (cafe fragments) are counted
+        # as part of the outer one
+        if stats._template_depth == 0:
+            stats._template_started = time.perf_counter()
+        stats._template_depth += 1
+
+
+def _template_rendered(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats._template_depth:
+        stats._template_depth -= 1
+        if stats._template_depth == 0:
+            stats.template_seconds += (
+                time.perf_counter() - stats._template_started)
+
+
+_engine_hooks_lock = threading.Lock()
+_engine_hooked = False
+
+
+def _hook_engines():
+    """Listen to every SQLAlchemy engine (once per process)."""
+
+    global _engine_hooked
+
+    with _engine_hooks_lock:
+        if not _engine_hooked:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+            _engine_hooked = True
+
+
+class Instrumentation:
+    """Flask extension wiring up the hooks above."""
+
+    def __init__(self, app=None):
+        self.metrics = metrics
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        _hook_engines()
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+        if app.config['METRICS_ENABLED']:
+            app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    def _start_request(self):
+        g._request_stats = RequestStats()
+
+    def _finish_request(self, response):
+        stats = g.pop("_request_stats", None)
+        if stats is None:
+            return response
+
+        self._observe(stats, response.status_code)
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers["Server-Timing"] = stats.server_timing()
+
+        return response
+
+    def _teardown_request(self, exc):
+        """Count a request that raised before _finish_request could (an
+        unhandled error) as a 500."""
+
+        stats = g.pop("_request_stats", None)
+        if stats is not None:
+            self._observe(stats, 500)
+
+    def _observe(self, stats, status):
+        stats.total_seconds = time.perf_counter() - stats.started
+        stats.endpoint = request.endpoint
+
+        view = current_app.view_functions.get(request.endpoint)
+        stats.budget = getattr(view, "query_budget", None)
+
+        if stats.budget is not None and stats.queries > stats.budget:
+            logger.warning("%s sent %s queries (budget %s)",
+                           stats.endpoint, stats.queries, stats.budget)
+
+        self.metrics.observe_request(stats, request.method, status)
+
+        with _recorders_lock:
+            for records in _recorders:
+                records.append(stats)
+
+    def metrics_view(self):
+        return current_app.response_class(
+            self.metrics.render(), mimetype="text/plain; version=0.0.4")
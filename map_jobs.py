@@ -0,0 +1,378 @@
+"""Background queue for fetching cafe static maps.
+
+Fetching a map from MapQuest can take seconds (or fail), so views enqueue a
+job here instead of calling save_map inline. Worker threads fetch the maps,
+retrying failures with exponential backoff.
+
+Each pending job is also written to a small JSON file in a journal directory
+and removed once it's done, so jobs left over when the app stops are picked
+up again when it starts.
+
+Jobs are keyed by the map's cache key (see mapping.map_key), so asking for
+the same location again while its map is pending -- whether for the same
+cafe or another one at that address -- is a no-op. So is asking again for
+a location given up on (after max_attempts failures) within the last
+failure_ttl seconds: otherwise every view of a cafe whose address MapQuest
+rejects would cost another max_attempts fetches.
+"""
+
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mapping import MAP_FETCHERS, map_key, get_cached_map
+
+
+logger = logging.getLogger(__name__)
+
+
+class MapJobQueue:
+    """Queue of map fetch jobs run by a small pool of worker threads."""
+
+    def __init__(self, app=None, fetch=None, journal_dir=None, workers=None,
+                 max_attempts=None, backoff=None, failure_ttl=None):
+        """Set up queue; settings not given here come from app config."""
+
+        self.app = app
+        self.fetch = fetch
+        self.journal_dir = journal_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.failure_ttl = failure_ttl
+
+        self._lock = threading.Condition()
+        self._jobs = {}         # map key -> job dict
+        self._given_up = {}     # map key -> time.monotonic() to retry after
+        self._schedule = []     # heap of (not_before, seq, map key)
+        self._seq = 0
+        self._threads = []
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Use this app's config for any settings not given to __init__.
+
+        Config is read when the queue starts (see start), so tests can still
+        change it after importing the app.
+        """
+
+        self.app = app
+
+    def _configure(self):
+        """Fill in unset settings from app config (see app.py for defaults)."""
+
+        config = self.app.config
+
+        if self.fetch is None:
+            self.fetch = MAP_FETCHERS[config['MAP_FETCHER']]
+        if self.journal_dir is None:
+            self.journal_dir = config['MAP_JOBS_DIR']
+        if self.workers is None:
+            self.workers = config['MAP_JOBS_WORKERS']
+        if self.max_attempts is None:
+            self.max_attempts = config['MAP_JOBS_MAX_ATTEMPTS']
+        if self.backoff is None:
+            self.backoff = config['MAP_JOBS_BACKOFF']
+        if self.failure_ttl is None:
+            self.failure_ttl = config['MAP_JOBS_FAILURE_TTL']
+
+    ##########################################################################
+    # public interface
+
+    def enqueue(self, address, city, state):
+        """Ask for the map of this location to be fetched.
+
+        Returns False if a job for it was already pending, or was given up
+        on less than failure_ttl seconds ago.
+        """
+
+        self.start()
+
+        key = map_key(address, city, state)
+
+        with self._lock:
+            if key in self._jobs or self._is_given_up(key):
+                return False
+
+            job = dict(key=key, address=address, city=city, state=state,
+                       attempts=0)
+            self._jobs[key] = job
+            self._write_journal(job)
+            self._schedule_job(key, delay=0)
+
+        return True
+
+    def start(self):
+        """Replay the journal and start the worker threads (once)."""
+
+        with self._lock:
+            if self._threads:
+                return
+
+            if self.app is not None:
+                self._configure()
+
+            for job in self._read_journal():
+                if job["key"] not in self._jobs:
+                    self._jobs[job["key"]] = job
+                    self._schedule_job(job["key"], delay=0)
+
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"map-jobs-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def pending(self):
+        """Return list of map keys with a job not yet done."""
+
+        with self._lock:
+            return sorted(self._jobs)
+
+    def join(self, timeout=None):
+        """Wait until every job is done (or given up on).
+
+        Returns False if timeout ran out first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._lock:
+            while self._jobs:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._lock.wait(remaining)
+
+        return True
+
+    ##########################################################################
+    # workers
+
+    def _work(self):
+        """Worker thread: run jobs as they come due, forever."""
+
+        while True:
+            job = self._next_job()
+
+            try:
+                self.fetch(job["address"], job["city"], job["state"])
+            except Exception:
+                logger.warning(
+                    "Map fetch for %s, %s, %s failed",
+                    job["address"], job["city"], job["state"], exc_info=True)
+                self._finish(job, ok=False)
+            else:
+                self._finish(job, ok=True)
+
+    def _next_job(self):
+        """Block until a job is due and return it."""
+
+        with self._lock:
+            while True:
+                now = time.monotonic()
+
+                if self._schedule and self._schedule[0][0] <= now:
+                    _, _, key = heapq.heappop(self._schedule)
+                    return dict(self._jobs[key])
+
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._lock.wait(timeout)
+
+    def _finish(self, job, ok):
+        """Record outcome of a job: done, retry later, or give up."""
+
+        key = job["key"]
+
+        with self._lock:
+            current = self._jobs[key]
+
+            if not ok:
+                current["attempts"] += 1
+
+            if ok or current["attempts"] >= self.max_attempts:
+                if not ok:
+                    logger.error(
+                        "Giving up on map for %s, %s, %s after %s attempts",
+                        job["address"], job["city"], job["state"],
+                        current["attempts"])
+                    self._give_up(key)
+                del self._jobs[key]
+                self._remove_journal(key)
+            else:
+                self._write_journal(current)
+                delay = self.backoff * 2 ** (current["attempts"] - 1)
+                self._schedule_job(key, delay=delay * random.uniform(1, 1.5))
+
+            self._lock.notify_all()
+
+    def _give_up(self, key):
+        """Don't take jobs for this key again for failure_ttl seconds.
+
+        Caller must hold the lock.
+        """
+
+        now = time.monotonic()
+
+        # forget expired keys (the oldest come first, as the TTL is fixed)
+        for old_key, expires in list(self._given_up.items()):
+            if expires > now:
+                break
+            del self._given_up[old_key]
+
+        self._given_up.pop(key, None)
+        self._given_up[key] = now + (self.failure_ttl or 0)
+
+    def _is_given_up(self, key):
+        """Was this key given up on less than failure_ttl seconds ago?
+
+        Caller must hold the lock.
+        """
+
+        expires = self._given_up.get(key)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            del self._given_up[key]
+            return False
+        return True
+
+    def _schedule_job(self, key, delay):
+        """Put job on the schedule to run after `delay` seconds.
+
+        Caller must hold the lock.
+        """
+
+        self._seq += 1
+        heapq.heappush(
+            self._schedule, (time.monotonic() + delay, self._seq, key))
+        self._lock.notify_all()
+
+    ##########################################################################
+    # journal
+
+    def _journal_path(self, key):
+        return os.path.join(self.journal_dir, f"{key}.json")
+
+    def _write_journal(self, job):
+        """Save job to the journal (atomically, via a temp file)."""
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+        path = self._journal_path(job["key"])
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def _remove_journal(self, key):
+        try:
+            os.remove(self._journal_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _read_journal(self):
+        """Return list of jobs left in the journal."""
+
+        if not os.path.isdir(self.journal_dir):
+            return []
+
+        jobs = []
+        for filename in os.listdir(self.journal_dir):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.journal_dir, filename)) as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                logger.warning("Skipping unreadable map job %s", filename)
+
+        return jobs
+
+
+##############################################################################
+# bulk backfill
+
+
+class BackfillStats:
+    """Running totals for a map backfill."""
+
+    def __init__(self):
+        self.scanned = 0        # cafes looked at
+        self.cached = 0         # cafes whose map was already fresh in cache
+        self.fetched = 0        # maps fetched
+        self.failed = []        # (cafe id, error) for maps we couldn't fetch
+        self.last_id = None     # last cafe id fully handled
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def __str__(self):
+        elapsed = self.elapsed
+        rate = self.fetched / elapsed if elapsed else 0
+
+        return (f"{self.scanned} cafes scanned, {self.cached} already cached, "
+                f"{self.fetched} fetched, {len(self.failed)} failed "
+                f"in {elapsed:.1f}s ({rate:.1f} maps/s); "
+                f"last cafe id {self.last_id}")
+
+
+def backfill_maps(batches, fetch, workers, max_age=None, progress=None):
+    """Fetch every missing or stale map, `workers` at a time.
+
+    `batches` yields lists of (cafe id, address, city, state), in cafe id
+    order. Each batch is finished before the next is read, so memory stays
+    bounded and BackfillStats.last_id is always a safe point to resume from
+    (maps already cached are skipped, so simply re-running also resumes).
+    Cafes sharing a location only cost one fetch.
+
+    `progress` is called with the BackfillStats after each batch.
+    """
+
+    stats = BackfillStats()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batches:
+            futures = {}    # map key -> (future, first cafe id)
+
+            for cafe_id, address, city, state in batch:
+                stats.scanned += 1
+                key = map_key(address, city, state)
+
+                if key in futures:
+                    continue
+
+                if get_cached_map(key, max_age=max_age):
+                    stats.cached += 1
+                    continue
+
+                future = pool.submit(fetch, address, city, state)
+                futures[key] = (future, cafe_id)
+
+            for future, cafe_id in futures.values():
+                try:
+                    future.result()
+                except Exception as exc:
+                    stats.failed.append((cafe_id, exc))
+                else:
+                    stats.fetched += 1
+
+            if batch:
+                stats.last_id = batch[-1][0]
+
+            if progress:
+                progress(stats)
+
+    return stats
@@ -1,30 +1,307 @@
+"""Static maps for cafes, fetched from MapQuest.
+
+Maps are cached on disk by content: each image is saved as
+static/maps/cache/<key>.jpg, where key is a hash of the normalized
+(address, city, state, zoom, size) it shows. Cafes don't own map files; they
+point at the blob for their location (see Cafe.map_key), so cafes sharing an
+address share a map, and re-saving a cafe without moving it costs nothing.
+"""
+
+import hashlib
 import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 
 from dotenv import load_dotenv
+
+from instrumentation import track_upstream
+
 load_dotenv()
 
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
 
+# point this at a local stub server to fetch maps without MapQuest
+STATIC_MAP_URL = os.environ.get(
+    "MAPQUEST_STATIC_MAP_URL", "https://www.mapquestapi.com/staticmap/v5/map")
+
+# upstream limits: seconds to connect / to wait between bytes, and how many
+# requests may be in flight at once (across all threads in this process)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("MAPQUEST_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("MAPQUEST_READ_TIMEOUT", 30))
+HTTP_MAX_CONCURRENCY = int(os.environ.get("MAPQUEST_MAX_CONCURRENCY", 8))
+
+MAP_ZOOM = 15
+MAP_SIZE = "@2x"
+
+# cached maps older than this are refetched; the cache is trimmed to this size
+MAP_CACHE_MAX_AGE = int(os.environ.get("MAP_CACHE_MAX_AGE_DAYS", 90)) * 86400
+MAP_CACHE_MAX_BYTES = int(os.environ.get("MAP_CACHE_MAX_MB", 1024)) * 2**20
+
+APP_DIR = os.path.abspath(os.path.dirname(__file__))
+MAPS_DIR = os.path.join(APP_DIR, "static", "maps")
+STUB_MAP_IMAGE = os.path.join(APP_DIR, "static", "images", "default-cafe.jpg")
+
+# first bytes of the image formats MapQuest can send back
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8")
+
+
+class MapFetchError(Exception):
+    """MapQuest didn't send back a map image."""
+
+
+_session = None
+_session_lock = threading.Lock()
+_concurrency = threading.BoundedSemaphore(HTTP_MAX_CONCURRENCY)
+
+
+def configure(connect_timeout=None, read_timeout=None, max_concurrency=None):
+    """Change upstream timeouts / concurrency limit for this process."""
+
+    global HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_MAX_CONCURRENCY
+    global _session, _concurrency
+
+    with _session_lock:
+        if connect_timeout is not None:
+            HTTP_CONNECT_TIMEOUT = connect_timeout
+        if read_timeout is not None:
+            HTTP_READ_TIMEOUT = read_timeout
+        if max_concurrency is not None:
+            HTTP_MAX_CONCURRENCY = max_concurrency
+            _concurrency = threading.BoundedSemaphore(max_concurrency)
+            # pool has to grow with the number of concurrent requests
+            if _session is not None:
+                _session.close()
+                _session = None
+
+
+def get_session():
+    """Return the shared HTTP session used for every map fetch.
+
+    Its connection pool keeps connections to MapQuest alive between
+    requests, so fetching many maps doesn't pay for a new TCP + TLS
+    handshake each time.
+    """
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_MAX_CONCURRENCY,
+                pool_block=True,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+
+        return _session
+
+
 def get_map_url(address, city, state):
     """Get MapQuest URL for a static map for this location."""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
+    base = f"{STATIC_MAP_URL}?key={API_KEY}"
     where = f"{address},{city},{state}"
-    return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+    return (f"{base}&center={where}&size={MAP_SIZE}&zoom={MAP_ZOOM}"
+            f"&locations={where}")
+
+
+def map_key(address, city, state, zoom=MAP_ZOOM, size=MAP_SIZE):
+    """Return cache key for the map of this location.
+
+    Case and runs of whitespace don't matter: "500  Sansome st" and
+    "500 Sansome St" share a map.
+    """
+
+    parts = [" ".join(str(part).split()).lower()
+             for part in (address, city, state, zoom, size)]
+
+    return hashlib.sha256("\x1f".join(parts).encode("UTF-8")).hexdigest()
+
+
+def cache_dir():
+    """Directory holding cached map images."""
+
+    return os.path.join(MAPS_DIR, "cache")
+
+
+def cached_map_path(key):
+    """Path on disk of the cached map with this key."""
+
+    return os.path.join(cache_dir(), f"{key}.jpg")
+
+
+def cached_map_url(key):
+    """URL of the cached map with this key."""
+
+    return f"/static/maps/cache/{key}.jpg"
+
+
+def legacy_map_path(id):
+    """Path of a map saved per cafe id, before maps were cached by location."""
+
+    return os.path.join(MAPS_DIR, f"{id}.jpg")
 
 
-def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
+def get_cached_map(key, max_age=None):
+    """Return path of the cached map with this key, if it's usable.
 
-    # read from request
-    resp = requests.get(get_map_url(address, city, state))
-    # path to directory
-    path = os.path.abspath(os.path.dirname(__file__))
+    Returns None if it's missing, isn't an image (e.g. a truncated write or
+    an error page), or (when max_age is given) is older than max_age seconds.
+    """
 
-    # write contents of file to path
-    with open(f"{path}/static/maps/{id}.jpg", 'wb') as wf: # opens in write mode.
-        wf.write(resp.content)
+    path = cached_map_path(key)
+
+    try:
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            head = f.read(4)
+    except OSError:
+        return None
+
+    if not head.startswith(IMAGE_SIGNATURES):
+        return None
+
+    if max_age is not None and time.time() - stat.st_mtime > max_age:
+        return None
+
+    return path
+
+
+def save_map(address, city, state):
+    """Make sure the map for this location is cached; return its key.
+
+    Only calls MapQuest if there's no fresh cached copy. Raises
+    MapFetchError (or a requests exception) if the fetch fails.
+    """
+
+    key = map_key(address, city, state)
+
+    if get_cached_map(key, max_age=MAP_CACHE_MAX_AGE):
+        return key
+
+    url = get_map_url(address, city, state)
+
+    with _concurrency, track_upstream("mapquest_maps"):
+        resp = get_session().get(
+            url,
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+            stream=True,
+        )
+
+        with resp:
+            if resp.status_code != 200:
+                raise MapFetchError(
+                    f"MapQuest returned {resp.status_code} for {address}")
+
+            content_type = resp.headers.get("Content-Type", "")
+            if not content_type.startswith("image/"):
+                raise MapFetchError(
+                    f"MapQuest returned {content_type or 'no content type'}"
+                    f" for {address}")
+
+            # straight to disk, a chunk at a time
+            _write_cached_map(key, resp.iter_content(chunk_size=64 * 1024))
 
     # FIXME: WHY ARE WE SAVING IMAGE IN ROOT AND NOT IN DB?
         # Elie's short answer: images are not good to store in databses
+
+    return key
+
+
+def save_stub_map(address, city, state):
+    """Offline stand-in for save_map: caches a placeholder image instead of
+    calling MapQuest (for tests and working without an API key)."""
+
+    key = map_key(address, city, state)
+
+    with open(STUB_MAP_IMAGE, "rb") as f:
+        _write_cached_map(key, [f.read()])
+
+    return key
+
+
+def _write_cached_map(key, chunks):
+    """Write image (given as an iterable of byte chunks) to the cache.
+
+    Goes via a temp file so readers never see a half-written map, and raises
+    MapFetchError without touching the cache if it isn't an image.
+    """
+
+    os.makedirs(cache_dir(), exist_ok=True)
+
+    path = cached_map_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        with open(tmp_path, 'wb') as wf: # opens in write mode.
+            head = b""
+            for chunk in chunks:
+                if len(head) < 4:
+                    head += chunk[:4]
+                wf.write(chunk)
+
+        if not head.startswith(IMAGE_SIGNATURES):
+            raise MapFetchError(f"Map {key} is not an image")
+
+        os.replace(tmp_path, path)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def evict_maps(max_bytes=MAP_CACHE_MAX_BYTES, max_age=MAP_CACHE_MAX_AGE):
+    """Trim the map cache: drop maps older than max_age seconds, then the
+    oldest maps until it's no bigger than max_bytes.
+
+    Returns (number of maps removed, bytes freed). Cafes whose map was
+    evicted show a placeholder until it's fetched again.
+    """
+
+    try:
+        filenames = os.listdir(cache_dir())
+    except FileNotFoundError:
+        return 0, 0
+
+    now = time.time()
+    entries = []
+    for filename in filenames:
+        path = os.path.join(cache_dir(), filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    # oldest first
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = freed = 0
+
+    for mtime, size, path in entries:
+        too_old = max_age is not None and now - mtime > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if not (too_old or too_big):
+            continue
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+        total -= size
+        removed += 1
+        freed += size
+
+    return removed, freed
+
+
+MAP_FETCHERS = {
+    "mapquest": save_map,
+    "stub": save_stub_map,
+}
@@ -0,0 +1,188 @@
+"""Schema migrations for Flask Cafe.
+
+New databases get the whole current schema from db.create_all() (see
+seed.py) and are then stamped as fully migrated. Databases made by an
+older version of the app are brought up to date by running the
+migrations they haven't had yet, in order:
+
+    flask db status     # which migrations have run
+    flask db upgrade    # run the rest
+
+Each migration is plain SQL, run in its own transaction together with the
+row recording it in schema_migrations, so a failed migration leaves no
+trace and can simply be re-run. They're written to be safe on a database
+that already has some of their changes (IF NOT EXISTS, etc).
+
+To change the schema, change models.py *and* add a migration to the end
+of MIGRATIONS doing the same to existing databases.
+"""
+
+from collections import namedtuple
+
+from models import (
+    db, LIKE_COUNT_TRIGGER, USER_LIKE_COUNT_TRIGGER, LIKE_EVENT_TRIGGER,
+    SEARCH_VECTOR_TRIGGER, CITY_SEARCH_VECTOR_TRIGGER)
+
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Text, primary_key=True),
+    db.Column('description', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              server_default=db.func.now()),
+)
+
+
+Migration = namedtuple("Migration", ["version", "description", "sql"])
+
+
+MIGRATIONS = [
+    Migration("0001", "cafes.like_count kept up to date by a trigger", f"""
+        ALTER TABLE cafes
+            ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS ix_cafes_like_count_id
+            ON cafes (like_count, id);
+
+        DROP TRIGGER IF EXISTS likes_like_count ON likes;
+        {LIKE_COUNT_TRIGGER.statement}
+
+        UPDATE cafes SET like_count = counts.n
+        FROM (
+            SELECT cafes.id, COUNT(likes.cafe_id) AS n
+            FROM cafes LEFT JOIN likes ON likes.cafe_id = cafes.id
+            GROUP BY cafes.id
+        ) AS counts
+        WHERE cafes.id = counts.id AND cafes.like_count <> counts.n;
+    """),
+
+    Migration("0002", "cafes.revision, for HTTP caching", """
+        ALTER TABLE cafes
+            ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 1;
+    """),
+
+    Migration("0003", "full-text search vector for cafes", f"""
+        ALTER TABLE cafes ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+        CREATE INDEX IF NOT EXISTS ix_cafes_search_vector
+            ON cafes USING gin (search_vector);
+
+        DROP TRIGGER IF EXISTS cafes_search_vector ON cafes;
+        {SEARCH_VECTOR_TRIGGER.statement}
+
+        DROP TRIGGER IF EXISTS cities_search_vector ON cities;
+        {CITY_SEARCH_VECTOR_TRIGGER.statement}
+
+        UPDATE cafes SET name = name WHERE search_vector IS NULL;
+    """),
+
+    Migration("0004", "cafe latitude/longitude", """
+        ALTER TABLE cafes ADD COLUMN IF NOT EXISTS latitude FLOAT;
+        ALTER TABLE cafes ADD COLUMN IF NOT EXISTS longitude FLOAT;
+        CREATE INDEX IF NOT EXISTS ix_cafes_latitude_longitude
+            ON cafes (latitude, longitude);
+    """),
+
+    Migration("0005", "indexes for cafe list order, city and cafe likers", """
+        CREATE INDEX IF NOT EXISTS ix_cafes_name_id ON cafes (name, id);
+        CREATE INDEX IF NOT EXISTS ix_cafes_city_code ON cafes (city_code);
+        CREATE INDEX IF NOT EXISTS ix_likes_cafe_id_user_id
+            ON likes (cafe_id, user_id);
+    """),
+
+    Migration("0006", "likes.created_at and users.like_count, for the profile", f"""
+        ALTER TABLE likes
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL
+                DEFAULT now();
+        CREATE INDEX IF NOT EXISTS ix_likes_user_id_created_at
+            ON likes (user_id, created_at, cafe_id);
+
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0;
+
+        DROP TRIGGER IF EXISTS likes_user_like_count ON likes;
+        {USER_LIKE_COUNT_TRIGGER.statement}
+
+        UPDATE users SET like_count = counts.n
+        FROM (
+            SELECT user_id, COUNT(*) AS n FROM likes GROUP BY user_id
+        ) AS counts
+        WHERE users.id = counts.user_id AND users.like_count <> counts.n;
+    """),
+
+    Migration("0007", "like_events log, partitioned by month", f"""
+        CREATE TABLE IF NOT EXISTS like_events (
+            id BIGSERIAL,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            cafe_id INTEGER NOT NULL,
+            like_created_at TIMESTAMP,
+            PRIMARY KEY (id, created_at),
+            CONSTRAINT ck_like_events_kind CHECK (kind IN ('like', 'unlike'))
+        ) PARTITION BY RANGE (created_at);
+        CREATE TABLE IF NOT EXISTS like_events_default
+            PARTITION OF like_events DEFAULT;
+        CREATE INDEX IF NOT EXISTS ix_like_events_txid_id
+            ON like_events (txid, id);
+
+        DROP TRIGGER IF EXISTS likes_like_event ON likes;
+        {LIKE_EVENT_TRIGGER.statement}
+    """),
+]
+
+
+def applied_versions():
+    """Return set of versions of the migrations that have been run."""
+
+    schema_migrations.create(db.engine, checkfirst=True)
+
+    with db.engine.connect() as conn:
+        return set(conn.execute(db.select(schema_migrations.c.version))
+                   .scalars())
+
+
+def pending_migrations():
+    """Return list of migrations not yet run, in the order to run them."""
+
+    applied = applied_versions()
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def _record(conn, migration):
+    conn.execute(schema_migrations.insert().values(
+        version=migration.version, description=migration.description))
+
+
+def upgrade(progress=None):
+    """Run every pending migration, each in its own transaction.
+
+    `progress` is called with each migration before it runs. Returns the
+    list of migrations run.
+    """
+
+    migrations = pending_migrations()
+
+    for migration in migrations:
+        if progress:
+            progress(migration)
+
+        with db.engine.begin() as conn:
+            # migrations may rewrite whole tables; no prod statement timeout
+            conn.exec_driver_sql("SET LOCAL statement_timeout = 0")
+            conn.exec_driver_sql(migration.sql)
+            _record(conn, migration)
+
+    return migrations
+
+
+def stamp():
+    """Record every migration as run, without running them (for a database
+    just made with db.create_all(), which already has the latest schema)."""
+
+    migrations = pending_migrations()
+
+    with db.engine.begin() as conn:
+        for migration in migrations:
+            _record(conn, migration)
+
+    return migrations
@@ -1,18 +1,32 @@
 """Data models for Flask Cafe"""
 
+import heapq
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import date
+from itertools import chain
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
+from sqlalchemy.orm import Session
 
-from mapping import save_map
+from passwords import passwords
+from mapping import (
+    save_map, map_key, get_cached_map, cached_map_url, legacy_map_path)
+from geocoding import bounding_box, haversine
+from pagination import keyset_page, encode_cursor, decode_cursor
 
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 DEFAULT_USER_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_CAFE_IMAGE_URL = "/static/images/default-cafe.jpg"
 
+# text search configuration for cafe search (see Cafe.search)
+SEARCH_CONFIG = "english"
+
 # class Follows(db.Model):
 #     """Connection of a follower <-> followed_user."""
 
@@ -49,6 +63,393 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    __table_args__ = (
+        # the primary key starts with user_id; this covers lookups by cafe
+        # (a cafe's likers, and the ON DELETE CASCADE from cafes)
+        db.Index('ix_likes_cafe_id_user_id', 'cafe_id', 'user_id'),
+        # a user's likes, newest first (the profile's liked cafes)
+        db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at',
+                 'cafe_id'),
+    )
+
+    @classmethod
+    def liked_cafe_ids(cls, user_id, cafe_ids):
+        """Return the set of `cafe_ids` that this user likes.
+
+        One query, answered from the (user_id, cafe_id) primary key index.
+        """
+
+        if not cafe_ids:
+            return set()
+
+        rows = (db.session.query(cls.cafe_id)
+                .filter(cls.user_id == user_id, cls.cafe_id.in_(cafe_ids))
+                .all())
+
+        return {cafe_id for (cafe_id,) in rows}
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Make user like cafe. Returns True if this added a new like.
+
+        A single INSERT ... ON CONFLICT DO NOTHING, so liking a cafe twice is
+        harmless and doesn't need to look at who else likes the cafe.
+        """
+
+        stmt = (insert(cls.__table__)
+                .values(user_id=user_id, cafe_id=cafe_id)
+                .on_conflict_do_nothing())
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Make user unlike cafe. Returns True if there was a like to remove.
+
+        A single DELETE by primary key, so it's also safe to repeat.
+        """
+
+        deleted = (cls.query
+                   .filter_by(user_id=user_id, cafe_id=cafe_id)
+                   .delete(synchronize_session=False))
+
+        return deleted == 1
+
+    @classmethod
+    def toggle(cls, user_id, cafe_id):
+        """Like the cafe if user doesn't, unlike it if they do. Returns True
+        if it's now liked, False if unliked, None if there's no such cafe.
+
+        One statement: the DELETE by primary key, and an INSERT that only
+        runs if that deleted nothing.
+        """
+
+        unliked, liked, exists = db.session.execute(db.text("""
+            WITH deleted AS (
+                DELETE FROM likes
+                WHERE user_id = :user_id AND cafe_id = :cafe_id
+                RETURNING cafe_id
+            ), inserted AS (
+                INSERT INTO likes (user_id, cafe_id)
+                SELECT :user_id, id FROM cafes
+                WHERE id = :cafe_id AND NOT EXISTS (SELECT FROM deleted)
+                ON CONFLICT DO NOTHING
+                RETURNING cafe_id
+            )
+            SELECT EXISTS (SELECT FROM deleted),
+                   EXISTS (SELECT FROM inserted),
+                   EXISTS (SELECT FROM cafes WHERE id = :cafe_id)
+        """), {"user_id": user_id, "cafe_id": cafe_id}).one()
+
+        if unliked:
+            return False
+        # (not inserted but the cafe exists: a concurrent toggle liked it)
+        return True if liked or exists else None
+
+    @classmethod
+    def add_many(cls, user_id, cafe_ids):
+        """Make user like each of these cafes; return the set of cafe ids
+        newly liked.
+
+        One INSERT ... SELECT from cafes, so ids of cafes that don't exist
+        are skipped rather than an error. Rows go in in cafe id order, so
+        two of these running at once can't deadlock.
+        """
+
+        if not cafe_ids:
+            return set()
+
+        added = db.session.execute(db.text("""
+            INSERT INTO likes (user_id, cafe_id)
+            SELECT :user_id, id FROM cafes
+            WHERE id = ANY(:cafe_ids)
+            ORDER BY id
+            ON CONFLICT DO NOTHING
+            RETURNING cafe_id
+        """), {"user_id": user_id, "cafe_ids": sorted(cafe_ids)})
+
+        return set(added.scalars())
+
+    @classmethod
+    def remove_many(cls, user_id, cafe_ids):
+        """Make user unlike each of these cafes; return the set of cafe ids
+        that were liked."""
+
+        if not cafe_ids:
+            return set()
+
+        removed = db.session.execute(db.text("""
+            DELETE FROM likes
+            WHERE user_id = :user_id AND cafe_id = ANY(:cafe_ids)
+            RETURNING cafe_id
+        """), {"user_id": user_id, "cafe_ids": sorted(cafe_ids)})
+
+        return set(removed.scalars())
+
+    @classmethod
+    def liked_cafes_page(cls, user_id, per_page, after=None):
+        """Return a KeysetPage of LikedCafes for this user, most recently
+        liked first.
+
+        `after` is a decoded cursor (see pagination.py) from an earlier
+        page's next_cursor. Only the few columns shown are read, and the
+        page is found by seeking the (user_id, created_at) index, so a user
+        with 10k likes costs the same as one with 10.
+        """
+
+        query = (db.session.query(
+                    cls.created_at, cls.cafe_id, Cafe.name, Cafe.city_code)
+                 .join(Cafe, Cafe.id == cls.cafe_id)
+                 .filter(cls.user_id == user_id))
+
+        page = keyset_page(
+            query,
+            [cls.created_at, cls.cafe_id],
+            lambda row: (row.created_at.isoformat(), row.cafe_id),
+            per_page,
+            after=after,
+            descending=True,
+        )
+
+        def city_state(code):
+            city = city_registry.get(code)
+            return f"{city.name}, {city.state}" if city else ""
+
+        page.items = [
+            LikedCafe(id=row.cafe_id, name=row.name,
+                      city=city_state(row.city_code), liked_at=row.created_at)
+            for row in page.items
+        ]
+
+        return page
+
+
+LikedCafe = namedtuple("LikedCafe", ["id", "name", "city", "liked_at"])
+
+
+class LikeEvent(db.Model):
+    """Append-only log of likes and unlikes, for consumers that want to
+    follow changes (trending, caches) without rescanning likes.
+
+    Rows are written by a trigger on likes (see LIKE_EVENT_TRIGGER), so
+    every way of liking is logged, in the same transaction as the like.
+    Read them in order with tail().
+
+    The table is partitioned by month on created_at, so old events are
+    dropped a month at a time (drop_partitions) instead of DELETEd.
+    Partitions are made ahead of time by create_partitions (run it from
+    cron: `flask like-events partitions`); events for a month without
+    one land in like_events_default until it's made.
+    """
+
+    __tablename__ = 'like_events'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    # the partition key has to be part of the primary key
+    created_at = db.Column(
+        db.DateTime,
+        primary_key=True,
+        server_default=db.func.now(),
+    )
+
+    # id of the transaction that wrote the event (see tail())
+    txid = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default=db.text("pg_current_xact_id()::text::bigint"),
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # when the like was made (for an unlike: when the removed like was made)
+    like_created_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.CheckConstraint("kind IN ('like', 'unlike')",
+                           name="ck_like_events_kind"),
+        db.Index('ix_like_events_txid_id', 'txid', 'id'),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+    def serialize(self):
+        """Serialize to dictionary."""
+
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "user_id": self.user_id,
+            "cafe_id": self.cafe_id,
+            "like_created_at": (self.like_created_at.isoformat()
+                                if self.like_created_at else None),
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @classmethod
+    def tail(cls, cursor=None, limit=1000):
+        """Return (events, cursor): up to `limit` events after `cursor` (from
+        an earlier call; None to start at the beginning), oldest first, and
+        the cursor to pass next time.
+
+        Events come in transaction order, and only from transactions that
+        have finished, as of now. Ids alone can't be used as a cursor:
+        a transaction can take an id, then commit after one that took a
+        later id, and a reader that had moved past the later id would never
+        see it. Any transaction older than the oldest one still running is
+        finished, so events from those can't show up behind the cursor.
+        A long-running transaction holds back newer events until it ends.
+        """
+
+        query = cls.query
+
+        after = decode_cursor(cursor)
+        if after is not None:
+            try:
+                after = tuple(int(value) for value in after)
+            except (ValueError, TypeError):
+                after = None
+        if after is not None and len(after) == 2:
+            query = query.filter(db.tuple_(cls.txid, cls.id) > after)
+
+        horizon = db.cast(
+            db.cast(db.func.pg_snapshot_xmin(db.func.pg_current_snapshot()),
+                    db.Text),
+            db.BigInteger)
+
+        events = (query
+                  .filter(cls.txid < horizon)
+                  .order_by(cls.txid, cls.id)
+                  .limit(limit)
+                  .all())
+
+        if events:
+            cursor = encode_cursor([events[-1].txid, events[-1].id])
+
+        return events, cursor
+
+    @classmethod
+    def cursor_before(cls, txid):
+        """Return a tail() cursor that starts at the events of transaction
+        txid (and every later one)."""
+
+        return encode_cursor([txid - 1, 2**63 - 1])
+
+    @classmethod
+    def partitions(cls):
+        """Return {first day of month: partition name} of the monthly
+        partitions there are."""
+
+        names = db.session.execute(db.text("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'like_events'::regclass
+        """)).scalars().all()
+
+        months = {}
+        for name in names:
+            match = re.fullmatch(r"like_events_(\d{4})_(\d{2})", name)
+            if match:
+                months[date(int(match[1]), int(match[2]), 1)] = name
+
+        return months
+
+    @classmethod
+    def create_partitions(cls, months_ahead=2, today=None):
+        """Make sure there are partitions for this month and the next
+        `months_ahead`. Events already in the default partition for those
+        months are moved into them. Returns names of partitions made.
+        (Caller commits.)"""
+
+        today = today or date.today()
+        month = date(today.year, today.month, 1)
+        existing = cls.partitions()
+        made = []
+
+        for _ in range(months_ahead + 1):
+            following = _next_month(month)
+
+            if month not in existing:
+                name = f"like_events_{month:%Y_%m}"
+                bounds = {"start": month, "end": following}
+
+                db.session.execute(db.text(
+                    f"CREATE TABLE {name} (LIKE like_events INCLUDING DEFAULTS"
+                    f" INCLUDING CONSTRAINTS)"))
+                db.session.execute(db.text(f"""
+                    WITH moved AS (
+                        DELETE FROM like_events_default
+                        WHERE created_at >= :start AND created_at < :end
+                        RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                """), bounds)
+                db.session.execute(db.text(
+                    f"ALTER TABLE like_events ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{month}') TO ('{following}')"))
+
+                made.append(name)
+
+            month = following
+
+        return made
+
+    @classmethod
+    def drop_partitions(cls, before):
+        """Drop monthly partitions holding only events from before the date
+        `before`. Returns names of partitions dropped. (Caller commits.)"""
+
+        dropped = []
+
+        for month, name in sorted(cls.partitions().items()):
+            if _next_month(month) <= before:
+                db.session.execute(db.text(f"DROP TABLE {name}"))
+                dropped.append(name)
+
+        return dropped
+
+
+def _next_month(month):
+    """First day of the month after `month` (a first day of month)."""
+
+    if month.month == 12:
+        return date(month.year + 1, 1, 1)
+    return date(month.year, month.month + 1, 1)
+
+
+# events for months without a partition of their own go here
+LIKE_EVENTS_DEFAULT_PARTITION = db.DDL("""
+CREATE TABLE like_events_default PARTITION OF like_events DEFAULT
+""")
+
+db.event.listen(LikeEvent.__table__, 'after_create',
+                LIKE_EVENTS_DEFAULT_PARTITION)
+
 
 class City(db.Model):
     """Cities for cafes."""
@@ -71,6 +472,110 @@ class City(db.Model):
     )
 
 
+CityInfo = namedtuple("CityInfo", ["code", "name", "state"])
+
+
+class CityRegistry:
+    """Process-wide copy of the cities table.
+
+    Cities are few and rarely change, yet nearly every page needs them (form
+    choices, "city, state" for each cafe). The registry loads them all on
+    first use and keeps them until a City row changes in this process (see
+    the session listeners below); `version` goes up each time that happens.
+
+    Changes made by other processes, or by raw SQL, aren't noticed: call
+    invalidate() after those.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._cities = None     # code -> CityInfo, ordered by name
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Return code -> CityInfo dict, loading it if needed."""
+
+        with self._lock:
+            if self._cities is not None:
+                return self._cities
+            version = self.version
+
+        rows = (db.session.query(City.code, City.name, City.state)
+                .order_by(City.name, City.code)
+                .all())
+        cities = {row.code: CityInfo(*row) for row in rows}
+
+        with self._lock:
+            # don't keep a copy that went stale while we were reading it
+            if self.version == version:
+                self._cities = cities
+
+        return cities
+
+    def all(self):
+        """Return list of CityInfo for every city, by name."""
+
+        return list(self._load().values())
+
+    def choices(self):
+        """Return [(code, name), ...] for a select field."""
+
+        return [(city.code, city.name) for city in self._load().values()]
+
+    def get(self, code):
+        """Return CityInfo for this city code, or None if there's no such
+        city."""
+
+        return self._load().get(code)
+
+    def is_valid(self, code):
+        """Is this the code of an existing city?"""
+
+        return code in self._load()
+
+    def invalidate(self):
+        """Forget loaded cities; they're read again on next use."""
+
+        with self._lock:
+            self._cities = None
+            self.version += 1
+
+
+city_registry = CityRegistry()
+
+
+def _note_city_changes(session, flush_context):
+    """Invalidate city registry if this flush wrote any City rows."""
+
+    changed = chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, City) for obj in changed):
+        session.info["cities_changed"] = True
+        city_registry.invalidate()
+
+
+def _note_city_bulk_changes(orm_execute_state):
+    """Invalidate city registry on City.query.update() / .delete()."""
+
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and orm_execute_state.bind_mapper is City.__mapper__):
+        orm_execute_state.session.info["cities_changed"] = True
+        city_registry.invalidate()
+
+
+def _end_city_changes(session):
+    """Invalidate again once a transaction that changed cities ends: the
+    registry may have been reloaded with its uncommitted rows meanwhile."""
+
+    if session.info.pop("cities_changed", False):
+        city_registry.invalidate()
+
+
+db.event.listen(Session, "after_flush", _note_city_changes)
+db.event.listen(Session, "do_orm_execute", _note_city_bulk_changes)
+db.event.listen(Session, "after_commit", _end_city_changes)
+db.event.listen(Session, "after_rollback", _end_city_changes)
+
+
 class Cafe(db.Model):
     """Cafe information."""
 
@@ -113,6 +618,60 @@ class Cafe(db.Model):
         default=DEFAULT_CAFE_IMAGE_URL,
     )
 
+    # denormalized count of rows in likes for this cafe; kept up to date by
+    # the likes_like_count trigger (see LIKE_COUNT_TRIGGER below)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # where the cafe is; filled in offline by `flask geocode-cafes`, and
+    # cleared when the address changes (None until geocoded)
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    # name, city, address and description, weighted in that order, for
+    # full-text search; kept up to date by the cafes_search_vector trigger
+    # (see SEARCH_VECTOR_TRIGGER below). Deferred: only searches read it.
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        server_default=db.FetchedValue(),
+        server_onupdate=db.FetchedValue(),
+    ))
+
+    __table_args__ = (
+        # for paging through cafes by name, and by popularity
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+        # cafes in a city (search filter, and the cities foreign key)
+        db.Index('ix_cafes_city_code', 'city_code'),
+        db.Index(
+            'ix_cafes_search_vector', 'search_vector', postgresql_using='gin'),
+        # for finding cafes in a bounding box (see Cafe.nearby)
+        db.Index('ix_cafes_latitude_longitude', 'latitude', 'longitude'),
+    )
+
+    # bumped by every ORM update of the cafe (not by likes); identifies a
+    # version of the cafe for HTTP caching
+    revision = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="1",
+    )
+
+    __mapper_args__ = {
+        "version_id_col": revision,
+    }
+
     city = db.relationship("City", backref='cafes')
 
     liking_users = db.relationship("User", secondary="likes")
@@ -120,52 +679,383 @@ class Cafe(db.Model):
     def is_liking_cafe(self, current_user):
         """Does current user like the cafe?"""
 
-        # get all users who currently like the cafe
-        found_user_list = [
-            user for user in self.liking_users if user == current_user
-        ]
-        return len(found_user_list) == 1
-
-        #  if user is found, remove user, if not add the user
-
+        return self.id in Like.liked_cafe_ids(current_user.id, [self.id])
 
     def like_cafe(self, user):
-        if not self.is_liking_cafe(user):
-            self.liking_users.append(user)
-            return self
+        """Make user like this cafe (no-op if they already do)."""
+
+        Like.add(user.id, self.id)
+        db.session.expire(self, ['liking_users'])
+        return self
 
     def unlike_cafe(self, user):
-        if self.is_liking_cafe(user):
-            self.liking_users.remove(user)
-            return self
+        """Make user stop liking this cafe (no-op if they don't)."""
+
+        Like.remove(user.id, self.id)
+        db.session.expire(self, ['liking_users'])
+        return self
+
 
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recompute like_count for every cafe from the likes table.
+
+        The trigger keeps counts right as likes come and go; this is for
+        repairing them in bulk (e.g. after loading likes with the trigger
+        disabled). Blocks like/unlike until the transaction ends, so counts
+        can't drift while they're being rebuilt. Returns how many cafes had
+        a wrong count.
+        """
+
+        db.session.execute(db.text("SET LOCAL statement_timeout = 0"))
+        db.session.execute(db.text("LOCK TABLE likes IN SHARE MODE"))
+
+        result = db.session.execute(db.text("""
+            UPDATE cafes
+            SET like_count = counts.n
+            FROM (
+                SELECT cafes.id, COUNT(likes.cafe_id) AS n
+                FROM cafes LEFT JOIN likes ON likes.cafe_id = cafes.id
+                GROUP BY cafes.id
+            ) AS counts
+            WHERE cafes.id = counts.id AND cafes.like_count <> counts.n
+        """))
+
+        return result.rowcount
+
+    @classmethod
+    def search(cls, text, city_code=None, limit=20, columns=None):
+        """Return up to `limit` cafes matching search text, best first.
+
+        Every word must match, and each word also matches as a prefix
+        ("sans" finds "Sansome"), so this works for autocomplete. Matches
+        in the name rank above matches in the city, address, then
+        description. Answered from the GIN index on search_vector.
+
+        Pass `columns` to get rows of just those columns instead of Cafes.
+        """
+
+        ts_query = to_prefix_tsquery(text)
+        if ts_query is None:
+            return []
+
+        ts_query = db.func.to_tsquery(SEARCH_CONFIG, ts_query)
+        rank = db.func.ts_rank_cd(cls.search_vector, ts_query)
+
+        query = db.session.query(*columns) if columns else cls.query
+        query = query.filter(cls.search_vector.op('@@')(ts_query))
+
+        if city_code:
+            query = query.filter(cls.city_code == city_code)
+
+        return query.order_by(rank.desc(), cls.id).limit(limit).all()
+
+    @classmethod
+    def nearby(cls, lat, lng, radius_km, limit=10):
+        """Return up to `limit` [(cafe, distance in km), ...] within
+        radius_km of (lat, lng), nearest first.
+
+        Reads just (id, latitude, longitude) for cafes in the bounding box
+        of the circle (a range scan of ix_cafes_latitude_longitude), works
+        out their real distances here, and then loads only the nearest.
+        Cafes that haven't been geocoded are never found.
+        """
+
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+
+        query = (db.session.query(cls.id, cls.latitude, cls.longitude)
+                 .filter(cls.latitude.between(min_lat, max_lat)))
+
+        if min_lng is not None:
+            query = query.filter(cls.longitude.between(min_lng, max_lng))
+        else:
+            query = query.filter(cls.longitude.isnot(None))
+
+        distances = []
+        for cafe_id, cafe_lat, cafe_lng in query:
+            distance = haversine(lat, lng, cafe_lat, cafe_lng)
+            if distance <= radius_km:
+                distances.append((distance, cafe_id))
+
+        nearest = heapq.nsmallest(limit, distances)
+        if not nearest:
+            return []
+
+        cafes = {cafe.id: cafe
+                 for cafe in cls.query.filter(
+                     cls.id.in_([cafe_id for _, cafe_id in nearest]))}
+
+        # (skipping any deleted since we looked)
+        return [(cafes[cafe_id], distance)
+                for distance, cafe_id in nearest if cafe_id in cafes]
+
+    @classmethod
+    def set_locations(cls, locations):
+        """Save geocoded locations: [(cafe id, latitude, longitude), ...].
+
+        One executemany UPDATE; doesn't change the cafes' revisions (their
+        pages don't show coordinates).
+        """
+
+        if not locations:
+            return
+
+        table = cls.__table__
+        stmt = (table.update()
+                .where(table.c.id == db.bindparam('cafe_id'))
+                .values(latitude=db.bindparam('lat'),
+                        longitude=db.bindparam('lng')))
+
+        db.session.execute(stmt, [
+            dict(cafe_id=cafe_id, lat=lat, lng=lng)
+            for cafe_id, lat, lng in locations
+        ])
+
+    @classmethod
+    def iter_map_locations(cls, after_id=0, batch_size=1000,
+                           not_geocoded=False):
+        """Yield lists of (id, address, city name, state) for every cafe with
+        id > after_id, in id order, batch_size at a time (only cafes with no
+        latitude/longitude, if not_geocoded).
+
+        Only reads the columns needed to fetch maps, and seeks by id, so it's
+        cheap to walk the whole table.
+        """
+
+        while True:
+            query = (db.session.query(
+                        cls.id, cls.address, City.name, City.state)
+                     .join(City, cls.city_code == City.code)
+                     .filter(cls.id > after_id))
+
+            if not_geocoded:
+                query = query.filter(cls.latitude.is_(None))
+
+            batch = query.order_by(cls.id).limit(batch_size).all()
+
+            if not batch:
+                return
+
+            yield [tuple(row) for row in batch]
+            after_id = batch[-1].id
 
     def __repr__(self): # pragma: no cover #FIXME: saw this in the solution, what does this mean?
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    def serialize(self):
+        """Return dict of the cafe's public details, for JSON APIs."""
+
+        return {
+            "id": self.id,
+            "name": self.name,
+            "address": self.address,
+            "city_code": self.city_code,
+            "city": self.get_city_state(),
+            "image_url": self.image_url,
+            "url": f"/cafes/{self.id}",
+        }
+
+    def get_city(self):
+        """Return this cafe's city (a CityInfo, from the city registry)."""
+
+        # a city added by another process isn't in our registry yet
+        return city_registry.get(self.city_code) or self.city
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = self.get_city()
         return f'{city.name}, {city.state}'
 
+    def map_location(self):
+        """Return (address, city name, state) that this cafe's map shows."""
+
+        city = self.get_city()
+        return self.address, city.name, city.state
+
 
     def save_map(self):
         """Saves map"""
 
-        return save_map(self.id, self.address, self.city.name, self.city.state)
+        return save_map(*self.map_location())
 
+    def map_key(self):
+        """Key of this cafe's map in the map cache."""
 
-def connect_db(app):
-    """Connect this database to provided Flask app.
+        return map_key(*self.map_location())
 
-    You should call this in your Flask app.
-    """
+    def map_url(self):
+        """URL of this cafe's map, or None if it hasn't been fetched yet."""
+
+        key = self.map_key()
+        if get_cached_map(key):
+            return cached_map_url(key)
 
-    app.app_context().push()
-    db.app = app
-    db.init_app(app)
+        # maps saved by cafe id, before the cache (removed when the cafe
+        # moves; see _drop_moved_legacy_maps)
+        if os.path.exists(legacy_map_path(self.id)):
+            return f"/static/maps/{self.id}.jpg"
+
+        return None
 
+    def has_map(self):
+        """Has this cafe's map been fetched yet?"""
+
+        return self.map_url() is not None
+
+
+def _note_moved_cafes(session, flush_context):
+    """Remember cafes whose address or city this flush changed."""
+
+    for obj in session.dirty:
+        if not isinstance(obj, Cafe):
+            continue
+        attrs = db.inspect(obj).attrs
+        if (attrs.address.history.has_changes()
+                or attrs.city_code.history.has_changes()):
+            session.info.setdefault("moved_cafes", set()).add(obj.id)
+
+
+def _drop_moved_legacy_maps(session):
+    """Once cafes have moved for good, delete their legacy (per cafe id)
+    maps: they show the old location, and are served as immutable, so
+    leaving them would keep the wrong map in browsers and CDNs."""
+
+    for cafe_id in session.info.pop("moved_cafes", ()):
+        try:
+            os.remove(legacy_map_path(cafe_id))
+        except FileNotFoundError:
+            pass
+
+
+def _forget_moved_cafes(session):
+    session.info.pop("moved_cafes", None)
+
+
+db.event.listen(Session, "after_flush", _note_moved_cafes)
+db.event.listen(Session, "after_commit", _drop_moved_legacy_maps)
+db.event.listen(Session, "after_rollback", _forget_moved_cafes)
+
+
+# Keep cafes.like_count in step with the likes table. Doing this in the
+# database (rather than in Like.add/remove) means every way of adding a like --
+# the toggle API, liked_cafes.append(), seed scripts -- is counted, and the
+# row lock taken by the UPDATE keeps concurrent toggles from losing counts.
+LIKE_COUNT_TRIGGER = db.DDL("""
+CREATE OR REPLACE FUNCTION cafes_like_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE cafes SET like_count = like_count + 1 WHERE id = NEW.cafe_id;
+    ELSE
+        UPDATE cafes SET like_count = like_count - 1 WHERE id = OLD.cafe_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_like_count
+AFTER INSERT OR DELETE ON likes
+FOR EACH ROW EXECUTE FUNCTION cafes_like_count();
+""")
+
+db.event.listen(Like.__table__, 'after_create', LIKE_COUNT_TRIGGER)
+
+
+# Same for users.like_count (how many cafes each user likes, for the profile).
+USER_LIKE_COUNT_TRIGGER = db.DDL("""
+CREATE OR REPLACE FUNCTION users_like_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET like_count = like_count + 1 WHERE id = NEW.user_id;
+    ELSE
+        UPDATE users SET like_count = like_count - 1 WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_user_like_count
+AFTER INSERT OR DELETE ON likes
+FOR EACH ROW EXECUTE FUNCTION users_like_count();
+""")
+
+db.event.listen(Like.__table__, 'after_create', USER_LIKE_COUNT_TRIGGER)
+
+
+# Log every like and unlike to like_events (see LikeEvent).
+LIKE_EVENT_TRIGGER = db.DDL("""
+CREATE OR REPLACE FUNCTION likes_log_event() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO like_events (kind, user_id, cafe_id, like_created_at)
+        VALUES ('like', NEW.user_id, NEW.cafe_id, NEW.created_at);
+    ELSE
+        INSERT INTO like_events (kind, user_id, cafe_id, like_created_at)
+        VALUES ('unlike', OLD.user_id, OLD.cafe_id, OLD.created_at);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_like_event
+AFTER INSERT OR DELETE ON likes
+FOR EACH ROW EXECUTE FUNCTION likes_log_event();
+""")
+
+db.event.listen(Like.__table__, 'after_create', LIKE_EVENT_TRIGGER)
+
+
+def to_prefix_tsquery(text):
+    """Turn search text into a to_tsquery() string where every word must
+    match as a prefix: "blue bott" -> "blue:* & bott:*".
+
+    Only letters and digits are kept, so users can't inject tsquery syntax.
+    Returns None if there are no words to search for.
+    """
+
+    words = re.findall(r"[^\W_]+", text or "")
+    if not words:
+        return None
+
+    return " & ".join(f"{word}:*" for word in words)
+
+
+# Keep cafes.search_vector in step with the cafe (and its city's name).
+SEARCH_VECTOR_TRIGGER = db.DDL(f"""
+CREATE OR REPLACE FUNCTION cafes_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+            (SELECT name FROM cities WHERE code = NEW.city_code), '')), 'B') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.address, '')), 'C') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.description, '')), 'D');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cafes_search_vector
+BEFORE INSERT OR UPDATE OF name, description, address, city_code ON cafes
+FOR EACH ROW EXECUTE FUNCTION cafes_search_vector();
+""")
+
+# Renaming a city re-indexes its cafes (by "touching" their city_code).
+CITY_SEARCH_VECTOR_TRIGGER = db.DDL("""
+CREATE OR REPLACE FUNCTION cities_search_vector() RETURNS trigger AS $$
+BEGIN
+    UPDATE cafes SET city_code = city_code WHERE city_code = NEW.code;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cities_search_vector
+AFTER UPDATE OF name ON cities
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION cities_search_vector();
+""")
+
+db.event.listen(Cafe.__table__, 'after_create', SEARCH_VECTOR_TRIGGER)
+db.event.listen(City.__table__, 'after_create', CITY_SEARCH_VECTOR_TRIGGER)
 
 
 class User(db.Model):
@@ -219,6 +1109,15 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized count of this user's likes; kept up to date by the
+    # likes_user_like_count trigger (see USER_LIKE_COUNT_TRIGGER below)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     # reference: https://stackoverflow.com/questions/19598578/how-do-primaryjoin-and-secondaryjoin-work-for-many-to-many-relationship-in-s
     # liked_cafes = db.relationship(
     #     "Cafe",
@@ -247,9 +1146,7 @@ class User(db.Model):
     def currently_likes(self, cafe):
         """does this user currently like the cafe?"""
 
-        found_liked_cafes = [
-            cafe for cafe in self.liking_users if cafe == cafe]
-        return len(found_liked_cafes) == 1
+        return cafe.id in Like.liked_cafe_ids(self.id, [cafe.id])
 
 
 
@@ -257,6 +1154,28 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
 
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recompute like_count for every user from the likes table (see
+        Cafe.reconcile_like_counts). Returns how many users had a wrong
+        count."""
+
+        db.session.execute(db.text("SET LOCAL statement_timeout = 0"))
+        db.session.execute(db.text("LOCK TABLE likes IN SHARE MODE"))
+
+        result = db.session.execute(db.text("""
+            UPDATE users
+            SET like_count = counts.n
+            FROM (
+                SELECT users.id, COUNT(likes.user_id) AS n
+                FROM users LEFT JOIN likes ON likes.user_id = users.id
+                GROUP BY users.id
+            ) AS counts
+            WHERE users.id = counts.id AND users.like_count <> counts.n
+        """))
+
+        return result.rowcount
+
     def get_full_name(self):
         """Returs user first name and last name"""
         return f"{self.first_name} {self.last_name}"
@@ -268,7 +1187,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -292,6 +1211,9 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
+        If the stored hash was made with a different bcrypt cost than the one
+        configured now, it's rehashed at the current cost (caller commits).
+
         If this can't find matching user (or if password is wrong), returns
         False.
         """
@@ -299,11 +1221,10 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash(password)
                 return user
 
         return False
-
-
-
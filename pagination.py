@@ -0,0 +1,180 @@
+"""Keyset (seek) pagination helpers for Flask Cafe."""
+
+import base64
+import binascii
+from datetime import datetime
+
+from flask.json.tag import TaggedJSONSerializer
+from sqlalchemy import tuple_
+
+
+cursor_serializer = TaggedJSONSerializer()
+
+
+def encode_cursor(values, sort=None):
+    """Turn a row's sort-key values into an opaque, URL-safe cursor.
+
+    For a list that can be sorted more than one way, pass the name of the
+    sort too; the cursor then only decodes for that sort (see
+    decode_cursor).
+    """
+
+    payload = list(values)
+    if sort is not None:
+        payload = {"sort": sort, "key": payload}
+
+    data = cursor_serializer.dumps(payload).encode('UTF-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort=None):
+    """Turn a cursor back into a list of sort-key values.
+
+    Returns None if cursor is missing or can't be read (a hand-edited URL
+    should just land on the first page, not blow up), or if it was made
+    for a different sort than `sort` (say, a name cursor reused with
+    ?sort=popular).
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = base64.urlsafe_b64decode(padded.encode('ascii'))
+        values = cursor_serializer.loads(data.decode('UTF-8'))
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return None
+
+    if sort is not None:
+        if not isinstance(values, dict) or values.get("sort") != sort:
+            return None
+        values = values.get("key")
+
+    if not isinstance(values, list):
+        return None
+
+    return values
+
+
+def _coerce_value(column, value):
+    """Return cursor value as the Python type of `column`; raise
+    ValueError if it isn't one (e.g. text where the column is an integer)."""
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = None
+
+    if python_type is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif python_type is float:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif python_type is str:
+        if isinstance(value, str):
+            return value
+    elif python_type is datetime:
+        # cursors hold datetimes as ISO strings (see Like.liked_cafes_page)
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, str):
+            return datetime.fromisoformat(value)
+    elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return value
+
+    raise ValueError(f"{value!r} doesn't fit {column}")
+
+
+def coerce_cursor(cursor, columns):
+    """Return the decoded cursor's values as the types of the sort-key
+    `columns`, or None if it doesn't fit them (wrong length, or a value of
+    the wrong type), so a hand-edited cursor lands on the first page rather
+    than in an SQL error."""
+
+    if cursor is None or len(cursor) != len(columns):
+        return None
+
+    try:
+        return [_coerce_value(column, value)
+                for column, value in zip(columns, cursor)]
+    except ValueError:
+        return None
+
+
+class KeysetPage:
+    """One page of results plus cursors to the pages on either side."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_page(query, columns, key, per_page, after=None, before=None,
+                descending=False, sort=None):
+    """Return a KeysetPage of `query` ordered by `columns`.
+
+    `columns` is the list of columns making up the (unique) sort key, e.g.
+    [Cafe.name, Cafe.id]. `key` is a function returning those same values
+    for a result row, used to build cursors.
+
+    Pass the decoded `after` cursor to get the page following it, or the
+    decoded `before` cursor to get the page preceding it. Either way the
+    database seeks straight to the cursor using the sort-key index, so
+    every page costs the same no matter how deep into the list it is.
+    A cursor that doesn't fit the columns (see coerce_cursor) is ignored.
+    If the list has more than one sort, pass its name as `sort` to have it
+    recorded in the cursors made here (decode them with the same `sort`).
+    """
+
+    before = coerce_cursor(before, columns)
+    after = coerce_cursor(after, columns)
+
+    sort_key = tuple_(*columns)
+    backwards = before is not None
+
+    if backwards:
+        cursor = before
+        seek_forward = descending
+    else:
+        cursor = after
+        seek_forward = not descending
+
+    if cursor is not None:
+        if seek_forward:
+            query = query.filter(sort_key > tuple(cursor))
+        else:
+            query = query.filter(sort_key < tuple(cursor))
+
+    if seek_forward:
+        query = query.order_by(*[col.asc() for col in columns])
+    else:
+        query = query.order_by(*[col.desc() for col in columns])
+
+    # fetch one extra row to know whether there's anything past this page
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if backwards:
+        rows.reverse()
+        has_next = cursor is not None
+        has_prev = has_more
+    else:
+        has_next = has_more
+        has_prev = cursor is not None
+
+    next_cursor = (encode_cursor(key(rows[-1]), sort=sort)
+                   if rows and has_next else None)
+    prev_cursor = (encode_cursor(key(rows[0]), sort=sort)
+                   if rows and has_prev else None)
+
+    return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
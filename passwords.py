@@ -0,0 +1,116 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is deliberately slow (hundreds of ms at high cost), so hashing and
+checking passwords runs on a small, bounded pool of threads rather than
+directly on the request thread: bcrypt releases the GIL while it works, so
+the pool can use every core, but a login storm can never have more than
+BCRYPT_MAX_WORKERS hashes competing for CPU with the rest of the app.
+A request that can't get a worker within BCRYPT_QUEUE_TIMEOUT seconds
+gives up with PasswordCheckBusy instead of queueing behind the storm.
+
+This bounds CPU, not request threads: the request thread still blocks
+until its hash is done (the app is plain WSGI, with nothing else for the
+thread to do meanwhile), so a server's worker threads should comfortably
+outnumber BCRYPT_MAX_WORKERS.
+
+The cost (log rounds) comes from the BCRYPT_LOG_ROUNDS config setting.
+Hashes made with a different cost are upgraded the next time their owner
+logs in (see User.authenticate).
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+
+bcrypt = Bcrypt()
+
+
+class PasswordCheckBusy(Exception):
+    """Too many password checks queued up; try again later."""
+
+
+class PasswordHasher:
+    """Runs bcrypt work on a bounded thread pool."""
+
+    def __init__(self, max_workers=None, queue_timeout=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._make_pool()
+
+    def init_app(self, app):
+        """Configure cost and pool size from app config."""
+
+        bcrypt.init_app(app)
+
+        self.max_workers = (app.config.get('BCRYPT_MAX_WORKERS')
+                            or self.max_workers)
+        self.queue_timeout = app.config.get('BCRYPT_QUEUE_TIMEOUT')
+
+        self._make_pool()
+
+    def _make_pool(self):
+        # (the executor only starts threads when work is submitted)
+        old_pool = self._pool
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="bcrypt")
+        # one slot per worker: holding a slot means a worker is free
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    @property
+    def log_rounds(self):
+        return bcrypt._log_rounds
+
+    def _run(self, fn, *args):
+        """Run fn(*args) on the pool and wait for its result.
+
+        Raises PasswordCheckBusy if no worker is free within queue_timeout
+        seconds. Once it has a worker, it waits as long as fn takes.
+        """
+
+        pool, slots = self._pool, self._slots
+
+        if not slots.acquire(timeout=self.queue_timeout):
+            raise PasswordCheckBusy()
+
+        try:
+            return pool.submit(fn, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Return bcrypt hash of password (as text) at the configured cost."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does password match this hash?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was this hash made with a different cost than we use now?"""
+
+        return hash_cost(hashed) != self.log_rounds
+
+
+def hash_cost(hashed):
+    """Return the cost (log rounds) a bcrypt hash was made with.
+
+    A bcrypt hash looks like $2b$12$<salt+hash>; 12 is the cost.
+    """
+
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+passwords = PasswordHasher()
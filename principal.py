@@ -0,0 +1,114 @@
+"""Lightweight current-user lookups for Flask Cafe.
+
+Every request needs to know who's logged in, but almost none need the whole
+users row (with its password hash, description, etc). Instead, g.user holds
+a Principal: a small read-only projection of the user, kept in a
+process-local cache so most requests don't touch the database at all.
+
+Routes that need the full User (like /profile) load it themselves.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from models import db, User
+
+
+class Principal(namedtuple(
+        "Principal", ["id", "username", "admin", "first_name", "last_name"])):
+    """Who's logged in: just enough of a User for auth checks and the navbar."""
+
+    __slots__ = ()
+
+    def get_full_name(self):
+        """Returs user first name and last name"""
+        return f"{self.first_name} {self.last_name}"
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()      # key -> (expires at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value for key, or None if missing/expired."""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PrincipalCache:
+    """Looks up Principals by user id, caching them for a short while."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def init_app(self, app):
+        """Size the cache from app config (CURRENT_USER_CACHE_*)."""
+
+        self.cache = TTLCache(
+            maxsize=app.config['CURRENT_USER_CACHE_SIZE'],
+            ttl=app.config['CURRENT_USER_CACHE_TTL'],
+        )
+
+    def get(self, user_id):
+        """Return Principal for user_id, or None if there's no such user."""
+
+        if not user_id:
+            return None
+
+        principal = self.cache.get(user_id)
+        if principal is not None:
+            return principal
+
+        row = (db.session.query(
+                    User.id, User.username, User.admin,
+                    User.first_name, User.last_name)
+               .filter(User.id == user_id)
+               .first())
+
+        if row is None:
+            return None
+
+        principal = Principal(*row)
+        self.cache.set(user_id, principal)
+        return principal
+
+    def invalidate(self, user_id):
+        """Forget cached Principal (call after changing the user)."""
+
+        self.cache.pop(user_id)
@@ -0,0 +1,458 @@
+"""Cafe recommendations: "similar cafes" and "cafes you may like".
+
+Item-item collaborative filtering on likes. Two cafes are similar when the
+same people like them: the cosine similarity of their columns in the
+user x cafe like matrix, (users who like both) / sqrt(likes of one * likes
+of the other). Each cafe keeps its RECOMMENDER_NEIGHBORS most similar
+cafes. A user's suggestions are the neighbors of the cafes they like,
+scored by summed similarity, minus the cafes they already like.
+
+Likes are held as SciPy sparse (CSR) matrices (see LikeMatrix), and
+similarities are worked out a batch of cafes at a time with sparse matrix
+products, so the whole cafe x cafe matrix is never made.
+
+Building it reads every like, so it's done by a background thread (see
+start), never in a request. After that the thread follows the like event
+log (models.LikeEvent) and recomputes only the cafes a like can change:
+the liked cafe, cafes that had it as a neighbor, and cafes it's now similar
+enough to become one. toggle_like wakes the thread; otherwise it checks
+every RECOMMENDER_REFRESH_INTERVAL seconds. Views only read the
+precomputed neighbors, and get nothing until the first build is done.
+"""
+
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+from models import db, LikeEvent
+from trending import Snapshot
+
+logger = logging.getLogger(__name__)
+
+# cafes whose similarities are computed in one sparse product
+BATCH_SIZE = 256
+
+# events read per query while syncing
+SYNC_BATCH = 1000
+
+# likes read from the database at a time while building
+READ_BATCH = 100000
+
+# fold a LikeMatrix's changes into its base once they're this big a
+# fraction of it
+MERGE_FRACTION = 0.05
+
+
+# Everything a view needs, replaced as a whole on each sync so readers never
+# see half of one. Cafes and users are numbered 0..n-1 in the matrices;
+# cafe_ids maps those numbers back to cafe ids.
+Index = namedtuple("Index", [
+    "cafe_ids",         # array: cafe number -> cafe id
+    "cafe_numbers",     # dict: cafe id -> cafe number
+    "user_numbers",     # dict: user id -> user number
+    "likes",            # LikeMatrix
+    "neighbors",        # array, cafes x N: most similar cafes' numbers, or -1
+    "similarity",       # array, cafes x N: their similarity (0 for -1s)
+])
+
+
+def _resize(matrix, shape):
+    """CSR matrix with more rows and/or columns (all empty), sharing its
+    entries with matrix rather than copying them."""
+
+    extra_rows = shape[0] - matrix.shape[0]
+    indptr = np.concatenate([
+        matrix.indptr,
+        np.full(extra_rows, matrix.indptr[-1], dtype=matrix.indptr.dtype)])
+
+    return sparse.csr_matrix(
+        (matrix.data, matrix.indices, indptr), shape=shape)
+
+
+class LikeMatrix:
+    """Likes as a cafes x users matrix (1 where the user likes the cafe).
+
+    Held as a base CSR matrix and its transpose, plus a small CSR delta of
+    the changes since (+1 for a like, -1 for an unlike): applying likes
+    only touches the delta, not every like, and merged() folds it into the
+    base now and then. Never changed in place; changed() and merged()
+    return new LikeMatrixes, sharing what they can with this one.
+    """
+
+    def __init__(self, base, base_t=None, delta=None):
+        self.base = base
+        self.base_t = base.T.tocsr() if base_t is None else base_t
+        self.delta = (sparse.csr_matrix(base.shape, dtype=np.float32)
+                      if delta is None else delta)
+        self.delta_t = self.delta.T.tocsr()
+
+        # likes per cafe
+        self.counts = (np.diff(base.indptr) +
+                       np.asarray(self.delta.sum(axis=1)).ravel())
+
+    @property
+    def shape(self):
+        return self.base.shape
+
+    def rows(self, cafes):
+        """CSR of these cafes' (numbers) rows."""
+
+        rows = (self.base[cafes] + self.delta[cafes]).tocsr()
+        rows.eliminate_zeros()
+        return rows
+
+    def co_counts(self, cafes):
+        """CSR, len(cafes) x all cafes: users who like both, for every cafe
+        sharing a user with these."""
+
+        rows = self.rows(cafes)
+        return (rows @ self.base_t + rows @ self.delta_t).tocsr()
+
+    def liked_by(self, user):
+        """Numbers of the cafes this user (number) likes."""
+
+        base = self.base_t.indices[
+            self.base_t.indptr[user]:self.base_t.indptr[user + 1]]
+
+        lo, hi = self.delta_t.indptr[user], self.delta_t.indptr[user + 1]
+        changed, change = self.delta_t.indices[lo:hi], self.delta_t.data[lo:hi]
+
+        return np.union1d(np.setdiff1d(base, changed[change < 0]),
+                          changed[change > 0])
+
+    def changed(self, cafes, users, changes, shape):
+        """A LikeMatrix with these likes (+1) and unlikes (-1) of cafes by
+        users (numbers) applied, grown to shape for new cafes and users."""
+
+        base = _resize(self.base, shape)
+        base_t = _resize(self.base_t, shape[::-1])
+
+        delta = (_resize(self.delta, shape) +
+                 sparse.csr_matrix((changes, (cafes, users)), shape=shape))
+        delta = delta.tocoo()
+
+        # keep base + delta at 0 or 1 (liking a liked cafe changes nothing)
+        current = np.asarray(base[delta.row, delta.col]).ravel()
+        data = np.clip(current + delta.data, 0, 1) - current
+        delta = sparse.csr_matrix(
+            (data.astype(np.float32), (delta.row, delta.col)), shape=shape)
+        delta.eliminate_zeros()
+
+        return LikeMatrix(base, base_t, delta)
+
+    def merged(self):
+        """The same likes, with the delta folded into the base (copies and
+        transposes every like)."""
+
+        base = (self.base + self.delta).tocsr()
+        base.eliminate_zeros()
+        return LikeMatrix(base)
+
+
+def co_likes(likes, cafes):
+    """Cosine similarity of these cafes (numbers) to every other cafe: a
+    CSR matrix, len(cafes) x all cafes, with no entry for a cafe and itself.
+    """
+
+    norms = np.sqrt(likes.counts).astype(np.float32)
+
+    # users who like both, for every cafe sharing a user with these
+    block = likes.co_counts(cafes)
+
+    row_cafes = np.repeat(cafes, np.diff(block.indptr))
+    block.data = block.data / (norms[row_cafes] * norms[block.indices])
+    block.data[block.indices == row_cafes] = 0
+    block.eliminate_zeros()
+
+    return block
+
+
+def cosine_neighbors(likes, cafes, n, batch_size=BATCH_SIZE):
+    """Return (neighbors, similarity) arrays, len(cafes) x n: the n most
+    similar cafes to each of these cafes (numbers), most similar first,
+    padded with -1 (and similarity 0) if there are fewer."""
+
+    neighbors = np.full((len(cafes), n), -1, dtype=np.int32)
+    similarity = np.zeros((len(cafes), n), dtype=np.float32)
+
+    for start in range(0, len(cafes), batch_size):
+        block = co_likes(likes, cafes[start:start + batch_size])
+
+        for i in range(block.shape[0]):
+            lo, hi = block.indptr[i], block.indptr[i + 1]
+            scores, others = block.data[lo:hi], block.indices[lo:hi]
+
+            if len(scores) > n:
+                # the n best, and anything tied with the last of them
+                nth = -np.partition(-scores, n - 1)[n - 1]
+                best = scores >= nth
+                scores, others = scores[best], others[best]
+
+            # most similar first; ties by cafe number, so results are stable
+            order = np.lexsort((others, -scores))[:n]
+            neighbors[start + i, :len(order)] = others[order]
+            similarity[start + i, :len(order)] = scores[order]
+
+    return neighbors, similarity
+
+
+class Recommender:
+    """Precomputed nearest-neighbor cafes, kept current in the background."""
+
+    def __init__(self, app=None):
+        self.app = app
+        self.n_neighbors = None
+        self.refresh_interval = None
+
+        self._index = None
+        self._snapshot = None       # what the build saw (see _apply)
+        self._cursor = None         # LikeEvent.tail cursor
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["recommender"] = self
+        self.n_neighbors = app.config['RECOMMENDER_NEIGHBORS']
+        self.refresh_interval = app.config['RECOMMENDER_REFRESH_INTERVAL']
+
+    ##########################################################################
+    # reading
+
+    def similar(self, cafe_id, k):
+        """[(cafe id, similarity), ...] of the k cafes most like this one,
+        most similar first."""
+
+        index = self._index
+        number = index and index.cafe_numbers.get(cafe_id)
+        if number is None:
+            return []
+
+        neighbors = index.neighbors[number, :k]
+        similarity = index.similarity[number, :k]
+        found = neighbors >= 0
+
+        return list(zip(index.cafe_ids[neighbors[found]].tolist(),
+                        similarity[found].tolist()))
+
+    def for_user(self, user_id, k):
+        """[(cafe id, score), ...] of k cafes this user may like (and
+        doesn't yet), best first."""
+
+        index = self._index
+        number = index and index.user_numbers.get(user_id)
+        if number is None:
+            return []
+
+        liked = index.likes.liked_by(number)
+
+        neighbors = index.neighbors[liked].ravel()
+        similarity = index.similarity[liked].ravel()
+        keep = (neighbors >= 0) & ~np.isin(neighbors, liked)
+
+        cafes, which = np.unique(neighbors[keep], return_inverse=True)
+        scores = np.bincount(which, weights=similarity[keep])
+        cafe_ids = index.cafe_ids[cafes]
+        best = np.lexsort((cafe_ids, -scores))[:k]
+
+        return list(zip(cafe_ids[best].tolist(), scores[best].tolist()))
+
+    ##########################################################################
+    # building and syncing
+
+    def clear(self):
+        """Forget everything; the next sync rebuilds."""
+
+        with self._sync_lock:
+            self._index = self._snapshot = self._cursor = None
+
+    def rebuild(self):
+        """Build the index from the likes table."""
+
+        with self._sync_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        # one snapshot for the likes and the position in the event log:
+        # events from transactions it saw are already in the matrix
+        conn = db.engine.connect().execution_options(
+            isolation_level="REPEATABLE READ")
+        with conn, conn.begin():
+            snapshot = conn.execute(db.text(
+                "SELECT pg_current_snapshot()::text")).scalar()
+
+            # a server-side cursor, so the likes aren't all in memory twice
+            cursor = conn.connection.cursor("recommender_likes")
+            cursor.execute("SELECT cafe_id, user_id FROM likes")
+
+            chunks = [np.empty((0, 2), dtype=np.int64)]
+            while True:
+                rows = cursor.fetchmany(READ_BATCH)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.int64))
+            cursor.close()
+
+        likes = np.concatenate(chunks)
+
+        cafe_ids, cafes = np.unique(likes[:, 0], return_inverse=True)
+        user_ids, users = np.unique(likes[:, 1], return_inverse=True)
+
+        likes = LikeMatrix(sparse.csr_matrix(
+            (np.ones(len(likes), dtype=np.float32), (cafes, users)),
+            shape=(len(cafe_ids), len(user_ids))))
+
+        neighbors, similarity = cosine_neighbors(
+            likes, np.arange(len(cafe_ids)), self.n_neighbors)
+
+        snapshot = Snapshot.parse(snapshot)
+
+        self._index = Index(
+            cafe_ids=cafe_ids,
+            cafe_numbers=dict(zip(cafe_ids.tolist(), range(len(cafe_ids)))),
+            user_numbers=dict(zip(user_ids.tolist(), range(len(user_ids)))),
+            likes=likes,
+            neighbors=neighbors,
+            similarity=similarity,
+        )
+        self._snapshot = snapshot
+        self._cursor = LikeEvent.cursor_before(snapshot.xmin)
+
+    def sync(self):
+        """Apply every like event since the last sync (building the index
+        first if there isn't one)."""
+
+        with self._sync_lock:
+            if self._index is None:
+                self._rebuild()
+                return
+
+            while True:
+                events, cursor = LikeEvent.tail(
+                    self._cursor, limit=SYNC_BATCH)
+                self._apply(events)
+                self._cursor = cursor
+
+                if len(events) < SYNC_BATCH:
+                    break
+
+    def _apply(self, events):
+        """Add these likes (and take away unlikes), then recompute the
+        neighbors of every cafe that could have changed."""
+
+        events = [event for event in events
+                  if not self._snapshot.sees(event.txid)]
+        if not events:
+            return
+
+        index = self._index
+        cafe_ids = index.cafe_ids
+        cafe_numbers = index.cafe_numbers
+        user_numbers = index.user_numbers
+
+        # number the cafes and users we haven't seen (copies, since readers
+        # may be using the old ones)
+        new_cafes = sorted(
+            {event.cafe_id for event in events} - cafe_numbers.keys())
+        if new_cafes:
+            cafe_numbers = dict(cafe_numbers)
+            cafe_numbers.update(
+                (cafe_id, number)
+                for number, cafe_id in enumerate(new_cafes, len(cafe_ids)))
+            cafe_ids = np.concatenate([cafe_ids, new_cafes])
+
+        new_users = sorted(
+            {event.user_id for event in events} - user_numbers.keys())
+        if new_users:
+            user_numbers = dict(user_numbers)
+            user_numbers.update(
+                (user_id, number)
+                for number, user_id in enumerate(new_users, len(user_numbers)))
+
+        shape = (len(cafe_ids), len(user_numbers))
+        cafes = np.array(
+            [cafe_numbers[event.cafe_id] for event in events], dtype=np.int64)
+        users = np.array(
+            [user_numbers[event.user_id] for event in events], dtype=np.int64)
+        changes = np.array(
+            [1 if event.kind == "like" else -1 for event in events],
+            dtype=np.float32)
+
+        likes = index.likes.changed(cafes, users, changes, shape)
+        if likes.delta.nnz > MERGE_FRACTION * likes.base.nnz:
+            likes = likes.merged()
+
+        extra = len(cafe_ids) - len(index.neighbors)
+        neighbors = np.concatenate([
+            index.neighbors,
+            np.full((extra, self.n_neighbors), -1, dtype=np.int32)])
+        similarity = np.concatenate([
+            index.similarity,
+            np.zeros((extra, self.n_neighbors), dtype=np.float32)])
+
+        # A like only changes similarities to the liked cafe, so another
+        # cafe's neighbors change only if the liked cafe was one of them,
+        # or is now more similar than the least similar of them.
+        touched = np.unique(cafes)
+        stale = np.isin(neighbors, touched).any(axis=1)
+        stale[touched] = True
+
+        least = similarity[:, -1]
+        for start in range(0, len(touched), BATCH_SIZE):
+            block = co_likes(likes, touched[start:start + BATCH_SIZE])
+            stale[block.indices[block.data > least[block.indices]]] = True
+
+        stale = np.flatnonzero(stale)
+        neighbors[stale], similarity[stale] = cosine_neighbors(
+            likes, stale, self.n_neighbors)
+
+        self._index = Index(
+            cafe_ids=cafe_ids,
+            cafe_numbers=cafe_numbers,
+            user_numbers=user_numbers,
+            likes=likes,
+            neighbors=neighbors,
+            similarity=similarity,
+        )
+
+    ##########################################################################
+    # background thread
+
+    def start(self):
+        """Start the background thread (once), unless
+        RECOMMENDER_REFRESH_INTERVAL is 0 (then call sync() yourself)."""
+
+        if self._thread is not None or not self.refresh_interval:
+            return
+
+        with self._sync_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="recommender", daemon=True)
+                self._thread.start()
+
+    def mark_stale(self):
+        """Likes changed: sync now rather than at the next interval."""
+
+        self._wake.set()
+
+    def _run(self):
+        """Background thread: build, then sync whenever woken, forever."""
+
+        while True:
+            self._wake.clear()
+
+            try:
+                with self.app.app_context():
+                    self.sync()
+            except Exception:
+                logger.warning("Recommender sync failed", exc_info=True)
+
+            self._wake.wait(self.refresh_interval)
@@ -1,98 +1,422 @@
-"""Initial data."""
+"""Initial data.
 
-from models import City, Cafe, db, connect_db, User
-from flask import Flask
+    python seed.py                  # a few hand-written cafes and users
+    python seed.py --synthetic --cities 20 --cafes 10000 \
+                   --users 5000 --likes 100000
 
-app = Flask(__name__)
+Both wipe the database first. --synthetic makes made-up data (for the
+benchmarks, see benchmarks/routes.py), the same every time for the same
+sizes and --random-seed, loaded with COPY (see seed_synthetic); it prints
+rows/second for each table. Every synthetic user is user<N> (1-based) with
+password SYNTHETIC_PASSWORD.
+"""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///flaskcafe'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import datetime, timedelta
 
-connect_db(app)
+from models import (
+    City, Cafe, Like, db, User, DEFAULT_CAFE_IMAGE_URL, DEFAULT_USER_IMAGE_URL)
+from passwords import passwords
+from app import create_app
+import migrations
 
-db.drop_all()
-db.create_all()
+SYNTHETIC_PASSWORD = "secret"
 
+CAFE_ADJECTIVES = ["Blue", "Golden", "Little", "Sunny", "Quiet", "Urban",
+                   "Rustic", "Velvet", "Corner", "Morning", "Roasted", "Wild"]
+CAFE_NOUNS = ["Bean", "Cup", "Kettle", "Grind", "Roastery", "Espresso",
+              "Latte", "Mug", "Brew", "Press", "Crema", "Pour"]
+STREETS = ["Main", "Oak", "Pine", "Market", "Mission", "Valencia", "Grand",
+           "Broadway", "College", "Shattuck", "Telegraph", "Castro"]
+STATES = ["CA", "OR", "WA", "NY", "TX", "IL", "MA", "CO"]
 
-#######################################
-# add cities
+# synthetic cafes are up to this many degrees from their city's center
+CITY_SPREAD = 0.05
 
-sf = City(code='sf', name='San Francisco', state='CA')
-berk = City(code='berk', name='Berkeley', state='CA')
-oak = City(code='oak', name='Oakland', state='CA')
+# synthetic likes were made at some time in this long before seeding
+LIKE_SPAN = timedelta(days=365)
 
-db.session.add_all([sf, berk, oak])
-db.session.commit()
+# triggers on likes that are off during a bulk load: the like counts are
+# set in one go afterwards, and loaded likes aren't news, so they aren't
+# logged to like_events
+LIKE_TRIGGERS = ["likes_like_count", "likes_user_like_count",
+                 "likes_like_event"]
 
+# bytes handed to COPY per read, and memory for building each index after
+COPY_CHUNK_SIZE = 256 * 1024
+INDEX_BUILD_MEMORY = "256MB"
 
-#######################################
-# add cafes
 
-c1 = Cafe(
-    name="Bernie's Cafe",
-    description='Serving locals in Noe Valley. A great place to sit and write'
-        ' and write Rithm exercises.',
-    address="3966 24th St",
-    city_code='sf',
-    url='https://www.yelp.com/biz/bernies-san-francisco',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
-)
+def reset_db():
+    """Drop and recreate every table, and mark the schema fully migrated."""
 
-c2 = Cafe(
-    name='Perch Coffee',
-    description='Hip and sleek place to get cardamom lattés when biking'
-        ' around Oakland.',
-    address='440 Grand Ave',
-    city_code='oak',
-    url='https://perchoffee.com',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
-)
+    db.drop_all()
+    db.create_all()
+    migrations.stamp()
 
-db.session.add_all([c1, c2])
-db.session.commit()
 
+def seed_demo():
+    """Add a few hand-written cities, cafes, users and likes."""
 
-#######################################
-# add users
+    #######################################
+    # add cities
 
-ua = User.register(
-    username="admin",
-    first_name="Addie",
-    last_name="MacAdmin",
-    description="I am the very model of the modern model administrator.",
-    email="admin@test.com",
-    password="secret",
-    admin=True,
-)
+    sf = City(code='sf', name='San Francisco', state='CA')
+    berk = City(code='berk', name='Berkeley', state='CA')
+    oak = City(code='oak', name='Oakland', state='CA')
 
-u1 = User.register(
-    username="test",
-    first_name="Testy",
-    last_name="MacTest",
-    description="I am the ultimate representative user.",
-    email="test@test.com",
-    password="secret",
-)
+    db.session.add_all([sf, berk, oak])
+    db.session.commit()
 
-db.session.add_all([u1])
-db.session.commit()
 
+    #######################################
+    # add cafes
 
-#######################################
-# add likes
+    c1 = Cafe(
+        name="Bernie's Cafe",
+        description='Serving locals in Noe Valley. A great place to sit and write'
+            ' and write Rithm exercises.',
+        address="3966 24th St",
+        city_code='sf',
+        url='https://www.yelp.com/biz/bernies-san-francisco',
+        image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
+    )
 
-u1.liked_cafes.append(c1)
-u1.liked_cafes.append(c2)
-ua.liked_cafes.append(c1)
+    c2 = Cafe(
+        name='Perch Coffee',
+        description='Hip and sleek place to get cardamom lattés when biking'
+            ' around Oakland.',
+        address='440 Grand Ave',
+        city_code='oak',
+        url='https://perchoffee.com',
+        image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
+    )
 
-db.session.commit()
+    db.session.add_all([c1, c2])
+    db.session.commit()
 
 
-#######################################
-# cafe maps
+    #######################################
+    # add users
 
-c1.save_map()
-c2.save_map()
+    ua = User.register(
+        username="admin",
+        first_name="Addie",
+        last_name="MacAdmin",
+        description="I am the very model of the modern model administrator.",
+        email="admin@test.com",
+        password="secret",
+        admin=True,
+    )
 
-db.session.commit()
+    u1 = User.register(
+        username="test",
+        first_name="Testy",
+        last_name="MacTest",
+        description="I am the ultimate representative user.",
+        email="test@test.com",
+        password="secret",
+    )
+
+    db.session.add_all([u1])
+    db.session.commit()
+
+
+    #######################################
+    # add likes
+
+    u1.liked_cafes.append(c1)
+    u1.liked_cafes.append(c2)
+    ua.liked_cafes.append(c1)
+
+    db.session.commit()
+
+
+    #######################################
+    # cafe maps
+
+    c1.save_map()
+    c2.save_map()
+
+    db.session.commit()
+
+
+##############################################################################
+# synthetic data
+
+
+def synthetic_cities(n, rng):
+    """Yield rows for n cities (codes c1, c2, ...), with a made-up center
+    (lat, lng) for each."""
+
+    for i in range(1, n + 1):
+        yield dict(
+            code=f"c{i}",
+            name=f"City {i}",
+            state=rng.choice(STATES),
+        ), (rng.uniform(25, 48), rng.uniform(-123, -71))
+
+
+def synthetic_cafes(n, centers, rng):
+    """Yield rows for n cafes spread over cities {code: (lat, lng)}."""
+
+    codes = sorted(centers, key=lambda code: int(code[1:]))
+
+    for i in range(1, n + 1):
+        code = rng.choice(codes)
+        lat, lng = centers[code]
+        name = f"{rng.choice(CAFE_ADJECTIVES)} {rng.choice(CAFE_NOUNS)} {i}"
+
+        yield dict(
+            id=i,
+            name=name,
+            description=f"{name} serves coffee on {rng.choice(STREETS)} St.",
+            url=f"https://cafe{i}.example.com/",
+            address=f"{rng.randint(1, 9999)} {rng.choice(STREETS)} St",
+            city_code=code,
+            image_url=DEFAULT_CAFE_IMAGE_URL,
+            latitude=lat + rng.uniform(-CITY_SPREAD, CITY_SPREAD),
+            longitude=lng + rng.uniform(-CITY_SPREAD, CITY_SPREAD),
+        )
+
+
+def synthetic_users(n, hashed_password):
+    """Yield rows for n users, user1 ... user<n>, all with the same
+    (already hashed) password."""
+
+    for i in range(1, n + 1):
+        yield dict(
+            id=i,
+            username=f"user{i}",
+            email=f"user{i}@example.com",
+            first_name="User",
+            last_name=str(i),
+            description=f"Synthetic user {i}.",
+            password=hashed_password,
+            admin=False,
+            # (the column's default is Python-side, so COPY needs it spelled out)
+            image_url=DEFAULT_USER_IMAGE_URL,
+        )
+
+
+def synthetic_likes(n, n_users, n_cafes, rng, now=None):
+    """Yield up to n distinct (user_id, cafe_id) likes, spread evenly over
+    users and made at random times in the LIKE_SPAN before `now`.
+    Popularity is skewed: low cafe ids get far more likes than high ones,
+    like real cafes do.
+
+    Works one user at a time, so memory doesn't grow with n.
+    """
+
+    n = min(n, n_users * n_cafes)
+    now = now or datetime.now()
+    span = int(LIKE_SPAN.total_seconds())
+
+    for user_id in range(1, n_users + 1):
+        k = n // n_users + (user_id <= n % n_users)
+
+        if k > n_cafes // 2:
+            cafe_ids = rng.sample(range(1, n_cafes + 1), k)
+        else:
+            cafe_ids = set()
+            while len(cafe_ids) < k:
+                cafe_ids.add(1 + int(n_cafes * rng.random() ** 3))
+
+        for cafe_id in sorted(cafe_ids):
+            yield dict(user_id=user_id, cafe_id=cafe_id,
+                       created_at=now - timedelta(seconds=rng.randrange(span)))
+
+
+class _CsvStream:
+    """File-like object reading rows (dicts) as CSV lines, made as COPY
+    asks for them, so a table of any size streams through in small reads."""
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.count = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator="\n")
+        self._pending = ""
+
+    def read(self, size=-1):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(self._pending)
+
+        while size < 0 or self._buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self._writer.writerow([row[column] for column in self.columns])
+            self.count += 1
+
+        data = self._buffer.getvalue()
+        if size < 0:
+            size = len(data)
+
+        self._pending = data[size:]
+        return data[:size]
+
+
+def copy_rows(table, rows, columns):
+    """Stream rows (dicts) into table with COPY, in the session's
+    transaction. Returns number of rows copied."""
+
+    stream = _CsvStream(rows, columns)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        stream, size=COPY_CHUNK_SIZE)
+
+    return stream.count
+
+
+def _drop_constraints(tables):
+    """Drop primary key, unique and foreign key constraints of tables;
+    return [(table name, constraint name, definition)] to add them back
+    with, in a workable order (keys before the foreign keys using them)."""
+
+    rows = db.session.execute(db.text("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid),
+               contype
+        FROM pg_constraint
+        WHERE conrelid = ANY(CAST(:tables AS regclass[]))
+          AND contype IN ('p', 'u', 'f')
+    """), {"tables": [table.name for table in tables]}).all()
+
+    rows.sort(key=lambda row: row.contype != "f")
+    for table, name, _, _ in rows:
+        db.session.execute(db.text(
+            f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+
+    return [(table, name, definition)
+            for table, name, definition, _ in reversed(rows)]
+
+
+def seed_synthetic(n_cities, n_cafes, n_users, n_likes, random_seed=0,
+                   progress=None):
+    """Add made-up cities, cafes, users and likes to empty tables.
+
+    Cafes get ids 1..n_cafes and users 1..n_users, so callers can pick rows
+    without asking the database. The password is hashed once and shared by
+    every user, so this doesn't spend minutes in bcrypt.
+
+    Built for millions of rows: rows stream in through COPY; indexes and
+    key constraints are dropped first and built (and checked) once at the
+    end; the triggers on likes are off during the load (see LIKE_TRIGGERS)
+    and the like counts are set in one UPDATE each.
+
+    `progress` is called with (step, rows, seconds) after each table and
+    after building keys and indexes (rows None).
+    """
+
+    rng = random.Random(random_seed)
+
+    def timed(step, fn, *args):
+        start = time.perf_counter()
+        rows = fn(*args)
+        if progress:
+            progress(step, rows, time.perf_counter() - start)
+
+    cities = list(synthetic_cities(n_cities, rng))
+    centers = {city["code"]: center for city, center in cities}
+
+    tables = [City.__table__, Cafe.__table__, User.__table__, Like.__table__]
+    indexes = [index for table in tables for index in table.indexes]
+
+    db.session.execute(db.text("SET LOCAL synchronous_commit = off"))
+    db.session.execute(db.text(
+        f"SET LOCAL maintenance_work_mem = '{INDEX_BUILD_MEMORY}'"))
+    db.session.execute(db.text("SET LOCAL statement_timeout = 0"))
+
+    conn = db.session.connection()
+    for index in indexes:
+        index.drop(conn, checkfirst=True)
+    constraints = _drop_constraints(tables)
+    for trigger in LIKE_TRIGGERS:
+        db.session.execute(db.text(
+            f"ALTER TABLE likes DISABLE TRIGGER {trigger}"))
+
+    timed("cities", copy_rows, City.__table__,
+          (city for city, _ in cities), ["code", "name", "state"])
+    timed("cafes", copy_rows, Cafe.__table__,
+          synthetic_cafes(n_cafes, centers, rng),
+          ["id", "name", "description", "url", "address", "city_code",
+           "image_url", "latitude", "longitude"])
+    timed("users", copy_rows, User.__table__,
+          synthetic_users(n_users, passwords.hash(SYNTHETIC_PASSWORD)),
+          ["id", "username", "email", "first_name", "last_name",
+           "description", "password", "admin", "image_url"])
+    timed("likes", copy_rows, Like.__table__,
+          synthetic_likes(n_likes, n_users, n_cafes, rng),
+          ["user_id", "cafe_id", "created_at"])
+
+    def finish():
+        for table, name, definition in constraints:
+            db.session.execute(db.text(
+                f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'))
+
+        for trigger in LIKE_TRIGGERS:
+            db.session.execute(db.text(
+                f"ALTER TABLE likes ENABLE TRIGGER {trigger}"))
+        Cafe.reconcile_like_counts()
+        User.reconcile_like_counts()
+
+        for index in indexes:
+            index.create(conn)
+
+        # ids were given explicitly; move the sequences past them
+        for table in (Cafe.__table__, User.__table__):
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT COALESCE(max(id), 0) + 1 FROM {table.name}), false)"))
+
+    timed("keys, like counts and indexes", finish)
+
+    db.session.commit()
+
+    # fresh planner statistics, as a long-running database would have
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT") \
+            .exec_driver_sql("ANALYZE")
+
+
+def report(step, rows, seconds):
+    if rows is None:
+        print(f"{step}: {seconds:.1f}s")
+    else:
+        print(f"{step}: {rows} rows in {seconds:.1f}s "
+              f"({rows / max(seconds, 1e-9):,.0f} rows/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wipe and seed the database.")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="make made-up data of the sizes below")
+    parser.add_argument("--cities", type=int, default=20)
+    parser.add_argument("--cafes", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--likes", type=int, default=100000)
+    parser.add_argument("--random-seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+
+    reset_db()
+
+    if args.synthetic:
+        seed_synthetic(args.cities, args.cafes, args.users, args.likes,
+                       random_seed=args.random_seed, progress=report)
+    else:
+        seed_demo()
+
+
+if __name__ == "__main__":
+    main()
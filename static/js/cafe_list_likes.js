@@ -0,0 +1,26 @@
+"use strict";
+
+// Marks every liked cafe on the list page using a single batched request,
+// instead of one /api/likes call per card. The request carries this page's
+// own sort/after/before, and the server works out which cafes are on it.
+
+const $cafeCards = $(".card[data-cafe-id]");
+
+$(async function () {
+  if ($cafeCards.length === 0) return;
+
+  const response = await axios({
+    url: "/api/likes/batch" + window.location.search,
+    method: "GET",
+  });
+
+  showLikedCafes(response.data.likes || {});
+});
+
+function showLikedCafes(likes) {
+  $cafeCards.each(function () {
+    if (likes[this.dataset.cafeId] === true) {
+      $(this).find(".cafe-liked").show();
+    }
+  });
+}
@@ -0,0 +1,52 @@
+"use strict";
+
+// Infinite scroll for the profile's liked cafes: when the "More" link comes
+// into view, fetch the next page from /api/profile/likes and append it.
+// Without JS the link still works as a plain next-page link.
+
+const $likedCafes = $("#liked-cafes");
+const $moreLikedCafes = $("#more-liked-cafes");
+
+let nextLikedCursor = $moreLikedCafes.data("next") || null;
+let loadingLikedCafes = false;
+
+$(function () {
+  if (!nextLikedCursor || !("IntersectionObserver" in window)) return;
+
+  const observer = new IntersectionObserver(async function (entries) {
+    if (!entries.some(entry => entry.isIntersecting)) return;
+
+    await loadMoreLikedCafes();
+    if (!nextLikedCursor) observer.disconnect();
+  });
+
+  observer.observe($moreLikedCafes[0]);
+});
+
+async function loadMoreLikedCafes() {
+  if (loadingLikedCafes || !nextLikedCursor) return;
+  loadingLikedCafes = true;
+
+  try {
+    const response = await axios({
+      url: "/api/profile/likes",
+      method: "GET",
+      params: { after: nextLikedCursor },
+    });
+
+    for (const cafe of response.data.cafes || []) {
+      const $link = $("<a>").attr("href", cafe.url).text(cafe.name);
+      const $city = $("<small>").addClass("text-muted").text(cafe.city);
+      $likedCafes.append($("<li>").append($link, " ", $city));
+    }
+
+    nextLikedCursor = response.data.next;
+    if (nextLikedCursor) {
+      $moreLikedCafes.attr("href", `/profile?after=${nextLikedCursor}`);
+    } else {
+      $moreLikedCafes.remove();
+    }
+  } finally {
+    loadingLikedCafes = false;
+  }
+}
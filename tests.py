@@ -3,34 +3,59 @@
 # NOTE: HOW TO CHECK FOR redirect PATH: "response.request.path"
 
 # import re
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
-
-from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
+from unittest.mock import patch
+
+from flask import Flask, session
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from app import (
+    create_app, CURR_USER_KEY, map_queue, principals, fragments, trending,
+    recommender)
+from models import (
+    db, Cafe, City, User, Like, LikeEvent, city_registry, to_prefix_tsquery)
 import re
 from helpers import get_choices_vocab
-
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe_test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
-
-connect_db(app)
+from map_jobs import MapJobQueue, backfill_maps
+from pagination import coerce_cursor, decode_cursor, encode_cursor
+import mapping
+from principal import PrincipalCache, TTLCache
+from passwords import (
+    passwords, hash_cost, PasswordHasher, PasswordCheckBusy)
+from fragment_cache import FragmentCache, FileBackend, MemoryBackend
+from geocoding import bounding_box, geocode_mapquest, geocode_stub, haversine
+import migrations
+from config import load_config
+from seed import seed_synthetic, SYNTHETIC_PASSWORD
+from benchmarks.routes import (
+    SCENARIOS, compare, load_dataset, percentile, run_scenario)
+from trending import Leaderboard, Snapshot
+from recommend import Recommender, LikeMatrix, cosine_neighbors
+import numpy as np
+from scipy import sparse
+from instrumentation import (
+    check_query_budget, current_stats, record_requests, track_upstream,
+    metrics, QueryBudgetExceeded, RequestStats)
+
+# The "test" profile (see config.py) uses the test database, doesn't
+# clutter tests with SQL, makes Flask errors be real errors, has no CSRF or
+# debug toolbar, uses the cheapest bcrypt cost and doesn't call MapQuest.
+# Keep maps and map jobs out of the app directory, too.
+app = create_app("test", {"MAP_JOBS_DIR": tempfile.mkdtemp()})
+mapping.MAPS_DIR = tempfile.mkdtemp()
+
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
+migrations.stamp()
 
 
 #######################################
@@ -58,6 +83,20 @@ def logout_for_test(client):
         session[CURR_USER_KEY] = ""
 
 
+def assert_query_budget(client, url, method="get", **kwargs):
+    """Request url; fail if its route has no query budget or goes over it
+    (see instrumentation.query_budget). Returns the response."""
+
+    with record_requests() as requests:
+        resp = getattr(client, method)(url, **kwargs)
+
+    stats = requests[-1]
+    assert stats.budget is not None, f"{stats.endpoint} has no query budget"
+    check_query_budget(stats)
+
+    return resp
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -146,6 +185,64 @@ TEST_LIKE_DATA_2 = dict(
 
 
 
+#######################################
+# configuration
+
+
+class ConfigTestCase(TestCase):
+    """Tests for config profiles."""
+
+    def load(self, profile, **environ):
+        config_app = Flask(__name__)
+        with patch.dict(os.environ, environ):
+            load_config(config_app, profile)
+        return config_app.config
+
+    def test_test_app(self):
+        self.assertEqual(app.config['PROFILE'], "test")
+        self.assertFalse(app.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn("debugtoolbar", app.blueprints)
+
+    def test_dev(self):
+        config = self.load("dev")
+        self.assertTrue(config['SQLALCHEMY_ECHO'])
+        self.assertTrue(config['DEBUG_TB_ENABLED'])
+
+    def test_prod(self):
+        config = self.load(
+            "prod", FLASK_SECRET_KEY="very secret", DB_POOL_SIZE="3",
+            DATABASE_URL="postgresql:///elsewhere", RELEASE_ID="v42")
+
+        self.assertFalse(config['SQLALCHEMY_ECHO'])
+        self.assertFalse(config['DEBUG_TB_ENABLED'])
+        self.assertEqual(config['SECRET_KEY'], "very secret")
+        self.assertEqual(
+            config['SQLALCHEMY_DATABASE_URI'], "postgresql:///elsewhere")
+
+        options = config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(options['pool_size'], 3)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(
+            options['connect_args'], {"options": "-c statement_timeout=5000"})
+        self.assertEqual(config['ETAG_SALT'], "v42")
+        self.assertFalse(config['SERVER_TIMING'])
+        self.assertFalse(config['METRICS_ENABLED'])
+
+    def test_prod_needs_secret_key(self):
+        with patch.dict(os.environ, {"FLASK_SECRET_KEY": ""}):
+            with self.assertRaises(RuntimeError):
+                self.load("prod")
+
+    def test_prod_needs_release_id(self):
+        with patch.dict(os.environ, {"RELEASE_ID": ""}):
+            with self.assertRaises(RuntimeError):
+                self.load("prod", FLASK_SECRET_KEY="very secret")
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            self.load("staging")
+
+
 #######################################
 # homepage
 
@@ -175,7 +272,7 @@ class CityModelTestCase(TestCase):
         sf = City(**CITY_DATA)
         db.session.add(sf)
 
-        cafe = Cafe(CAFE_DATA_1)
+        cafe = Cafe(**CAFE_DATA_1)
         db.session.add(cafe)
 
         db.session.commit()
@@ -191,8 +288,62 @@ class CityModelTestCase(TestCase):
         # City.query.delete()
         # db.session.commit()
 
-    # depending on how you solve exercise, you may have things to test on
-    # the City model, so here's a good place to put that stuff.
+    def count_city_queries(self, fn):
+        """Call fn; return how many queries it sent that read cities."""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            fn()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+
+        return len([s for s in statements if "cities" in s])
+
+    def test_registry_loads_once(self):
+        city_registry.choices()
+
+        def lookups():
+            get_choices_vocab()
+            self.cafe.get_city_state()
+            city_registry.is_valid("sf")
+
+        self.assertEqual(self.count_city_queries(lookups), 0)
+        self.assertEqual(city_registry.get("sf").name, "San Francisco")
+        self.assertIsNone(city_registry.get("nope"))
+
+    def test_registry_sees_new_city(self):
+        version = city_registry.version
+        self.assertFalse(city_registry.is_valid("oak"))
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+
+        self.assertGreater(city_registry.version, version)
+        self.assertEqual(
+            get_choices_vocab(), [("oak", "Oakland"), ("sf", "San Francisco")])
+
+    def test_registry_sees_edits(self):
+        City.query.filter_by(code="sf").update({"name": "San Fran"})
+        db.session.commit()
+        self.assertEqual(self.cafe.get_city_state(), "San Fran, CA")
+
+        city = City.query.get("sf")
+        city.state = "ZZ"
+        db.session.commit()
+        self.assertEqual(self.cafe.get_city_state(), "San Fran, ZZ")
+
+    def test_registry_forgets_rolled_back_city(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        self.assertTrue(city_registry.is_valid("oak"))
+
+        db.session.rollback()
+        self.assertFalse(city_registry.is_valid("oak"))
 
 
 #######################################
@@ -266,6 +417,98 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_pagination(self):
+        """tests paging through the cafe list with keyset cursors"""
+
+        cafe2 = Cafe(**CAFE_DATA_2)
+        db.session.add(cafe2)
+        db.session.commit()
+
+        per_page = app.config['CAFES_PER_PAGE']
+        app.config['CAFES_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                resp = client.get("/cafes")
+                html = resp.data.decode('utf8')
+                self.assertIn("Test Cafe", html)
+                self.assertNotIn("Test2 Cafe", html)
+                self.assertNotIn("Previous", html)
+
+                next_url = re.search(r'href="(/cafes\?sort=name&after=[^"]+)"', html).group(1)
+                resp = client.get(next_url)
+                html = resp.data.decode('utf8')
+                self.assertIn("Test2 Cafe", html)
+                self.assertNotIn('alt="Test Cafe"', html)
+                self.assertNotIn("Next", html)
+
+                prev_url = re.search(r'href="(/cafes\?sort=name&before=[^"]+)"', html).group(1)
+                resp = client.get(prev_url)
+                self.assertIn(b"Test Cafe", resp.data)
+                self.assertNotIn(b"Test2 Cafe", resp.data)
+        finally:
+            app.config['CAFES_PER_PAGE'] = per_page
+
+    def test_list_bad_cursor(self):
+        """a garbled cursor just shows the first page"""
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_list_mistyped_cursor(self):
+        """a well-formed cursor holding the wrong types (hand-edited) also
+        just shows the first page"""
+
+        with app.test_client() as client:
+            for values in [[0, 6], ["Test Cafe", "6"], [{"a": 1}, 6],
+                           ["Test Cafe", True], ["Test Cafe", None]]:
+                with self.subTest(values=values):
+                    cursor = encode_cursor(values, sort="name")
+
+                    resp = client.get(f"/cafes?after={cursor}")
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn(b"Test Cafe", resp.data)
+
+                    resp = client.get(f"/cafes?before={cursor}")
+                    self.assertEqual(resp.status_code, 200)
+
+    def test_list_cursor_from_other_sort(self):
+        """a cursor from one sort, reused with the other, shows the first
+        page of the other sort"""
+
+        db.session.add(Cafe(**CAFE_DATA_2))
+        db.session.commit()
+
+        per_page = app.config['CAFES_PER_PAGE']
+        app.config['CAFES_PER_PAGE'] = 1
+        try:
+            with app.test_client() as client:
+                html = client.get("/cafes?sort=name").data.decode('utf8')
+                name_cursor = re.search(r'after=([^"]+)"', html).group(1)
+
+                html = client.get("/cafes?sort=popular").data.decode('utf8')
+                popular_cursor = re.search(r'after=([^"]+)"', html).group(1)
+
+                for sort, cursor in [("popular", name_cursor),
+                                     ("name", popular_cursor)]:
+                    for direction in ["after", "before"]:
+                        with self.subTest(sort=sort, direction=direction):
+                            resp = client.get(
+                                f"/cafes?sort={sort}&{direction}={cursor}")
+                            self.assertEqual(resp.status_code, 200)
+                            self.assertNotIn('Previous',
+                                             resp.data.decode('utf8'))
+
+                self.assertEqual(
+                    decode_cursor(name_cursor, sort="name"),
+                    ["Test Cafe", self.cafe_id])
+                self.assertIsNone(decode_cursor(name_cursor, sort="popular"))
+                self.assertIsNone(decode_cursor(name_cursor))
+        finally:
+            app.config['CAFES_PER_PAGE'] = per_page
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -273,6 +516,101 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b"Test Cafe", resp.data)
             self.assertIn(b'testcafe.com', resp.data)
 
+    def test_detail_conditional_get(self):
+        """anonymous detail pages are public, with an ETag that changes when
+        the cafe does"""
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            etag = resp.get_etag()[0]
+            self.assertTrue(etag)
+            self.assertTrue(resp.cache_control.public)
+            self.assertNotIn("Set-Cookie", resp.headers)
+            self.assertNotIn(b"X-CSRFToken", resp.data)
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            cafe = Cafe.query.get(self.cafe_id)
+            revision = cafe.revision
+            cafe.description = "Changed"
+            db.session.commit()
+            self.assertEqual(cafe.revision, revision + 1)
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Changed", resp.data)
+            self.assertNotEqual(resp.get_etag()[0], etag)
+
+    def test_public_with_csrf_enabled(self):
+        """anonymous pages stay public (no CSRF token in a session cookie)
+        with CSRF protection on, as in prod"""
+
+        with patch.dict(app.config, {"WTF_CSRF_ENABLED": True}), \
+                app.test_client() as client:
+            for url in [f"/cafes/{self.cafe_id}", "/cafes"]:
+                with self.subTest(url=url):
+                    resp = client.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertTrue(resp.cache_control.public)
+                    self.assertNotIn("Set-Cookie", resp.headers)
+                    etag = resp.get_etag()[0]
+                    self.assertTrue(etag)
+
+                    resp = client.get(
+                        url, headers={"If-None-Match": f'"{etag}"'})
+                    self.assertEqual(resp.status_code, 304)
+
+    def test_list_conditional_get(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            etag = resp.get_etag()[0]
+
+            resp = client.get("/cafes", headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get(
+                "/cafes?sort=popular", headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_detail_private_when_logged_in(self):
+        user = User.register(**TEST_USER_DATA_NEW)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, user.id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.private)
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertFalse(resp.cache_control.public)
+            self.assertIsNone(resp.get_etag()[0])
+
+        User.query.filter_by(id=user.id).delete()
+        db.session.commit()
+
+    def test_detail_with_flash_not_public(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["_flashes"] = [("message", "Hello there")]
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Hello there", resp.data)
+            self.assertFalse(resp.cache_control.public)
+
+    def test_static_images_immutable(self):
+        with app.test_client() as client:
+            resp = client.get("/static/images/default-cafe.jpg")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertTrue(resp.cache_control.public)
+            self.assertEqual(resp.cache_control.max_age, 365 * 86400)
+            resp.close()
+
 
 class CafeAdminViewsTestCase(TestCase):
     """Tests for add/edit views on cafes."""
@@ -340,6 +678,65 @@ class CafeAdminViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'added', resp.data)
 
+    def test_cafe_add_queues_map(self):
+        """Adding a cafe fetches its map in the background"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_user.id)
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+
+        cafe = Cafe.query.filter_by(name="new-name").one()
+        self.assertTrue(map_queue.join(timeout=5))
+        self.assertTrue(cafe.has_map())
+
+    def test_edit_address_requeues_map(self):
+        """Editing a cafe's address fetches a new map; other edits don't"""
+
+        cafe = Cafe.query.get(self.cafe_id)
+        new_address = f"{self.cafe_id} Edited St"
+
+        with app.test_client() as client:
+            client.post(f"/cafes/{self.cafe_id}/edit", data=CAFE_DATA_EDIT)
+            self.assertEqual(map_queue.pending(), [])
+
+            client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data={**CAFE_DATA_EDIT, "address": new_address})
+            self.assertTrue(map_queue.join(timeout=5))
+
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.address, new_address)
+            self.assertTrue(cafe.has_map())
+
+    def test_move_drops_legacy_map(self):
+        """A map saved per cafe id is used until the cafe moves, then
+        deleted (it shows the old location)"""
+
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.address = f"{self.cafe_id} Legacy St"
+        db.session.commit()
+
+        path = mapping.legacy_map_path(self.cafe_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"\xff\xd8\xff old map")
+
+        cafe.description = "Same place"
+        db.session.commit()
+        self.assertEqual(cafe.map_url(), f"/static/maps/{self.cafe_id}.jpg")
+
+        cafe.address = f"{self.cafe_id} Moved St"
+        db.session.rollback()
+        self.assertTrue(os.path.exists(path))
+
+        cafe.address = f"{self.cafe_id} Moved St"
+        db.session.commit()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(cafe.map_url())
+
     def test_dynamic_cities_vocab(self):
         """tests for dynamically added values"""
         id = self.cafe_id
@@ -385,10 +782,388 @@ class CafeAdminViewsTestCase(TestCase):
         self.assertIn(('sf', 'San Francisco'), get_choices_vocab())
 
 
+class CafeSearchTestCase(TestCase):
+    """Tests for full-text cafe search."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+
+        sansome = Cafe(**CAFE_DATA_1)
+        roasters = Cafe(
+            name="Blue Bottle Roasters",
+            description="Pour over coffee",
+            url="http://bluebottle.com/",
+            address="300 Webster St",
+            city_code="oak",
+        )
+        pour = Cafe(
+            name="Pour House",
+            description="Drip coffee and blue plates",
+            url="http://pourhouse.com/",
+            address="12 Mission St",
+            city_code="sf",
+        )
+        db.session.add_all([sansome, roasters, pour])
+        db.session.commit()
+
+        self.sansome_id = sansome.id
+        self.roasters_id = roasters.id
+        self.pour_id = pour.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def search_ids(self, text, **kwargs):
+        return [cafe.id for cafe in Cafe.search(text, **kwargs)]
+
+    def test_prefix_tsquery(self):
+        self.assertEqual(to_prefix_tsquery("blue bott"), "blue:* & bott:*")
+        self.assertEqual(to_prefix_tsquery("a&b | !c:*"), "a:* & b:* & c:*")
+        self.assertIsNone(to_prefix_tsquery(" &! "))
+        self.assertIsNone(to_prefix_tsquery(None))
+
+    def test_search_fields(self):
+        self.assertEqual(self.search_ids("Sansom"), [self.sansome_id])
+        self.assertEqual(self.search_ids("oakl"), [self.roasters_id])
+        self.assertEqual(self.search_ids("roast"), [self.roasters_id])
+        self.assertEqual(self.search_ids("webster"), [self.roasters_id])
+        self.assertEqual(self.search_ids("nothing like this"), [])
+        self.assertEqual(self.search_ids(""), [])
+
+    def test_search_ranks_name_first(self):
+        # "pour" is in one cafe's name and another's description
+        self.assertEqual(
+            self.search_ids("pour"), [self.pour_id, self.roasters_id])
+        self.assertEqual(
+            self.search_ids("blue"), [self.roasters_id, self.pour_id])
+
+    def test_search_city_filter(self):
+        self.assertEqual(
+            self.search_ids("coffee", city_code="sf"), [self.pour_id])
+
+    def test_search_sees_edits(self):
+        cafe = Cafe.query.get(self.sansome_id)
+        cafe.name = "Espresso Bar"
+        db.session.commit()
+        self.assertEqual(self.search_ids("espresso"), [self.sansome_id])
+
+        City.query.filter_by(code="oak").update({"name": "Oaktown"})
+        db.session.commit()
+        self.assertEqual(self.search_ids("oaktown"), [self.roasters_id])
+
+    def test_search_uses_index(self):
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+        plan = db.session.execute(db.text(
+            "EXPLAIN SELECT id FROM cafes "
+            "WHERE search_vector @@ to_tsquery('english', 'blue:*')"
+        )).scalars().all()
+        db.session.rollback()
+
+        self.assertIn("ix_cafes_search_vector", "\n".join(plan))
+
+    def test_search_page(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/search?q=blue&city_code=oak")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Blue Bottle Roasters", resp.data)
+            self.assertNotIn(b"Pour House", resp.data)
+
+    def test_search_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/search?q=pou&limit=1")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["cafes"][0]["id"], self.pour_id)
+            self.assertEqual(resp.json["cafes"][0]["city"], "San Francisco, CA")
+            self.assertEqual(len(resp.json["cafes"]), 1)
+
+            resp = client.get("/api/cafes/search?q=pou&limit=lots")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/cafes/search?q=pou&limit=1000")
+            self.assertEqual(resp.status_code, 400)
+
+
+class NearbyCafesTestCase(TestCase):
+    """Tests for geocoding and nearby cafe queries."""
+
+    # Union Square, SF
+    LAT, LNG = 37.7880, -122.4075
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+
+        # ~0.1km, ~1.1km and ~11km north of LAT, LNG, and one not geocoded
+        cafes = [
+            Cafe(**dict(CAFE_DATA_1, name="Close",
+                        latitude=self.LAT + 0.001, longitude=self.LNG)),
+            Cafe(**dict(CAFE_DATA_1, name="Near",
+                        latitude=self.LAT + 0.01, longitude=self.LNG)),
+            Cafe(**dict(CAFE_DATA_1, name="Far",
+                        latitude=self.LAT + 0.1, longitude=self.LNG)),
+            Cafe(**dict(CAFE_DATA_2, name="Nowhere")),
+        ]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.ids = {cafe.name: cafe.id for cafe in cafes}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_haversine(self):
+        # SF to LA is about 559km
+        self.assertAlmostEqual(
+            haversine(37.7749, -122.4194, 34.0522, -118.2437), 559, delta=2)
+        self.assertEqual(haversine(self.LAT, self.LNG, self.LAT, self.LNG), 0)
+
+    def test_bounding_box(self):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(self.LAT, self.LNG, 1)
+        self.assertLess(min_lat, self.LAT)
+        self.assertGreater(max_lng, self.LNG)
+        self.assertAlmostEqual(
+            haversine(self.LAT, self.LNG, max_lat, self.LNG), 1, places=6)
+
+        self.assertIsNone(bounding_box(0, 179.99, 10)[2])
+        self.assertIsNone(bounding_box(89.99, 0, 10)[2])
+
+    def test_nearby(self):
+        nearest = Cafe.nearby(self.LAT, self.LNG, 2)
+        self.assertEqual([cafe.name for cafe, _ in nearest], ["Close", "Near"])
+        self.assertAlmostEqual(nearest[0][1], 0.111, places=2)
+
+        nearest = Cafe.nearby(self.LAT, self.LNG, 20, limit=1)
+        self.assertEqual([cafe.name for cafe, _ in nearest], ["Close"])
+
+    def test_nearby_endpoint(self):
+        with app.test_client() as client:
+            resp = client.get(
+                f"/cafes/nearby?lat={self.LAT}&lng={self.LNG}&radius=20")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [cafe["name"] for cafe in resp.json["cafes"]],
+                ["Close", "Near", "Far"])
+            self.assertIn("distance_km", resp.json["cafes"][0])
+
+            for query in ["lat=1", "lat=x&lng=1", "lat=100&lng=0",
+                          "lat=1&lng=1&radius=0", "lat=1&lng=1&limit=500"]:
+                resp = client.get(f"/cafes/nearby?{query}")
+                self.assertEqual(resp.status_code, 400, query)
+
+    def test_geocode_stub(self):
+        location = geocode_stub("500 Sansome St", "San Francisco", "CA")
+        self.assertEqual(
+            location, geocode_stub("500  sansome st", "San Francisco", "CA"))
+        self.assertLess(haversine(*location, 37.7749, -122.4194), 10)
+
+    def test_geocode_mapquest_reads_current_settings(self):
+        # settings changed after import (mapping.configure) must be used
+        with patch.object(mapping, "get_session") as get_session, \
+                patch.object(mapping, "API_KEY", "new-key"), \
+                patch.object(mapping, "HTTP_CONNECT_TIMEOUT", 1.5), \
+                patch.object(mapping, "HTTP_READ_TIMEOUT", 2.5):
+            resp = get_session.return_value.get.return_value
+            resp.status_code = 200
+            resp.json.return_value = {"results": [{"locations": [
+                {"latLng": {"lat": 1.0, "lng": 2.0}}]}]}
+
+            location = geocode_mapquest("500 Sansome St", "San Francisco", "CA")
+
+        self.assertEqual(location, (1.0, 2.0))
+        kwargs = get_session.return_value.get.call_args.kwargs
+        self.assertEqual(kwargs["params"]["key"], "new-key")
+        self.assertEqual(kwargs["timeout"], (1.5, 2.5))
+
+    def test_geocode_command(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["geocode-cafes"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("1 cafe(s) geocoded", result.output)
+
+        cafe = Cafe.query.get(self.ids["Nowhere"])
+        self.assertEqual(
+            (cafe.latitude, cafe.longitude),
+            geocode_stub(cafe.address, "San Francisco", "CA"))
+
+        # already geocoded cafes are left alone
+        cafe = Cafe.query.get(self.ids["Far"])
+        self.assertEqual(cafe.latitude, self.LAT + 0.1)
+
+    def test_edit_address_clears_location(self):
+        admin = User.register(**dict(ADMIN_USER_DATA, username="geo-admin"))
+        db.session.commit()
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, admin.id)
+                client.post(
+                    f"/cafes/{self.ids['Close']}/edit",
+                    data=dict(CAFE_DATA_EDIT, address="1 Market St"))
+
+            cafe = Cafe.query.get(self.ids["Close"])
+            self.assertEqual(cafe.address, "1 Market St")
+            self.assertIsNone(cafe.latitude)
+            self.assertIsNone(cafe.longitude)
+        finally:
+            User.query.filter_by(id=admin.id).delete()
+            db.session.commit()
+
+
+class FragmentCacheTestCase(TestCase):
+    """Tests for the rendered cafe fragment cache."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA_1)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe = cafe
+        self.cache = FragmentCache(backend=MemoryBackend())
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_render_cached(self):
+        with app.test_request_context():
+            html = self.cache.render("cafe/_card.html", self.cafe)
+            self.assertIn("Test Cafe", html)
+            self.assertIn("San Francisco, CA", html)
+
+            # a hit comes straight from the backend
+            key = f"cafe/_card.html:{self.cafe.id}"
+            stamp, _, _ = self.cache.backend.get(key).partition("\n")
+            self.cache.backend.set(key, f"{stamp}\nfrom cache")
+            self.assertEqual(
+                self.cache.render("cafe/_card.html", self.cafe), "from cache")
+
+    def test_new_revision_rerenders(self):
+        with app.test_request_context():
+            self.cache.render("cafe/_detail_body.html", self.cafe)
+
+            self.cafe.name = "Renamed Cafe"
+            db.session.commit()
+
+            html = self.cache.render("cafe/_detail_body.html", self.cafe)
+            self.assertIn("Renamed Cafe", html)
+
+    def test_invalidate(self):
+        with app.test_request_context():
+            self.cache.render("cafe/_card.html", self.cafe)
+            self.cache.render("cafe/_detail_body.html", self.cafe)
+
+            self.cache.invalidate(self.cafe.id)
+
+            for template in FragmentCache.TEMPLATES:
+                self.assertIsNone(
+                    self.cache.backend.get(f"{template}:{self.cafe.id}"))
+
+    def test_memory_backend_lru(self):
+        backend = MemoryBackend(maxsize=2)
+        backend.set("a", "1")
+        backend.set("b", "2")
+        backend.get("a")
+        backend.set("c", "3")
+
+        self.assertEqual(backend.get("a"), "1")
+        self.assertIsNone(backend.get("b"))
+
+    def test_file_backend_shared(self):
+        directory = tempfile.mkdtemp()
+        one = FragmentCache(backend=FileBackend(directory))
+        two = FragmentCache(backend=FileBackend(directory))
+
+        with app.test_request_context():
+            one.render("cafe/_card.html", self.cafe)
+            key = f"cafe/_card.html:{self.cafe.id}"
+            self.assertEqual(two.backend.get(key), one.backend.get(key))
+
+            two.invalidate(self.cafe.id)
+            self.assertIsNone(one.backend.get(key))
+
+    def test_file_backend_prune(self):
+        directory = tempfile.mkdtemp()
+        backend = FileBackend(directory, max_entries=2, max_age=3600)
+
+        for i, age in enumerate([7200, 30, 20, 10]):
+            backend.set(f"key{i}", str(i))
+            past = time.time() - age
+            os.utime(backend._path(f"key{i}"), (past, past))
+
+        # too old, then the oldest of the rest
+        self.assertEqual(backend.prune(), 2)
+        self.assertEqual([backend.get(f"key{i}") for i in range(4)],
+                         [None, None, "2", "3"])
+        self.assertEqual(backend.prune(), 0)
+
+    def test_prune_command(self):
+        directory = tempfile.mkdtemp()
+        backend = FileBackend(directory, max_entries=0)
+        backend.set("key", "value")
+
+        with patch.object(fragments, "backend", backend):
+            result = app.test_cli_runner().invoke(args=["prune-fragments"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pruned 1 fragment(s)", result.output)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_list_and_detail_use_fragments(self):
+        fragments.clear()
+
+        with app.test_client() as client:
+            client.get("/cafes")
+            client.get(f"/cafes/{self.cafe.id}")
+
+        for template in FragmentCache.TEMPLATES:
+            self.assertIsNotNone(
+                fragments.backend.get(f"{template}:{self.cafe.id}"))
+
+
 #######################################
 # users
 
 
+class PasswordHasherTestCase(TestCase):
+    """Tests for the bounded bcrypt pool."""
+
+    def test_busy_only_while_waiting_for_a_worker(self):
+        hasher = PasswordHasher(max_workers=1, queue_timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "done"
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(hasher._run(slow)))
+        thread.start()
+        started.wait(5)
+
+        # the only worker is busy: give up after queue_timeout
+        with self.assertRaises(PasswordCheckBusy):
+            hasher._run(lambda: "never")
+
+        release.set()
+        thread.join(5)
+        self.assertEqual(results, ["done"])
+
+        # work that takes longer than queue_timeout, once it has a worker,
+        # isn't cut off
+        self.assertEqual(hasher._run(time.sleep, 0.1), None)
+
+
 class UserModelTestCase(TestCase):
     """Tests for the user model."""
 
@@ -423,6 +1198,23 @@ class UserModelTestCase(TestCase):
         rez = User.authenticate("test", "password")
         self.assertFalse(rez)
 
+    def test_authenticate_rehashes_at_new_cost(self):
+        self.assertEqual(hash_cost(self.user.password), 4)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        passwords.init_app(app)
+        try:
+            rez = User.authenticate("test", "secret")
+            self.assertEqual(hash_cost(rez.password), 5)
+            db.session.commit()
+
+            # and the upgraded hash still works
+            self.assertEqual(User.authenticate("test", "secret"), self.user)
+            self.assertFalse(User.authenticate("test", "password"))
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            passwords.init_app(app)
+
     def test_full_name(self):
         self.assertEqual(self.user.get_full_name(), "Testy MacTest")
 
@@ -487,6 +1279,45 @@ class AuthViewsTestCase(TestCase):
 
             self.assertIn(b"Username already taken", resp.data)
 
+    def fill_password_pool(self):
+        """Take every bcrypt worker for the rest of the test, so password
+        hashing and checking give up (quickly) as busy."""
+
+        slots = passwords._slots
+        for _ in range(passwords.max_workers):
+            slots.acquire()
+        self.addCleanup(
+            lambda: [slots.release() for _ in range(passwords.max_workers)])
+
+        timeout = patch.object(passwords, "queue_timeout", 0.01)
+        timeout.start()
+        self.addCleanup(timeout.stop)
+
+    def test_signup_busy(self):
+        self.fill_password_pool()
+
+        with app.test_client() as client:
+            resp = client.post("/signup", data=TEST_USER_DATA_NEW)
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn(b"please try again", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+        self.assertIsNone(User.query.filter_by(
+            username=TEST_USER_DATA_NEW["username"]).first())
+
+    def test_login_busy(self):
+        self.fill_password_pool()
+
+        with app.test_client() as client:
+            resp = client.post("/login", data={
+                "username": TEST_USER_DATA["username"],
+                "password": TEST_USER_DATA["password"]})
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn(b"please try again", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
     def test_login(self):
         with app.test_client() as client:
             resp = client.get("/login")
@@ -637,51 +1468,945 @@ class ProfileViewsTestCase(TestCase):
             self.assertIn(b"TestyEdited", resp.data)
 
 
-#######################################
-# likes
-
-
-class LikeViewsTestCase(TestCase):
-    """Tests for views on cafes."""
+class LikedCafesTestCase(TestCase):
+    """Tests for the profile's paginated liked cafes."""
 
     def setUp(self):
-        """Before each test, add sample user."""
-
+        Like.query.delete()
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
-        Like.query.delete()
 
+        db.session.add(City(**CITY_DATA))
         user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        cafes = [Cafe(**dict(CAFE_DATA_1, name=f"Liked Cafe {i}"))
+                 for i in range(5)]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        # liked in order: cafe 0 first, cafe 4 most recently
+        for i, cafe in enumerate(cafes):
+            db.session.add(Like(user_id=user.id, cafe_id=cafe.id,
+                                created_at=datetime(2023, 1, 1, 12, i)))
         db.session.commit()
 
         self.user_id = user.id
-        self.user = user
+        self.cafe_ids = [cafe.id for cafe in cafes]
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
+    def tearDown(self):
+        db.session.rollback()
 
-        cafe1 = Cafe(**CAFE_DATA_1)
-        cafe2 = Cafe(**CAFE_DATA_2)
-        db.session.add(cafe1)
-        db.session.add(cafe2)
+    def test_like_count(self):
+        self.assertEqual(User.query.get(self.user_id).like_count, 5)
+
+        Like.remove(self.user_id, self.cafe_ids[0])
         db.session.commit()
+        self.assertEqual(User.query.get(self.user_id).like_count, 4)
+
+    def test_pages(self):
+        page = Like.liked_cafes_page(self.user_id, 2)
+        self.assertEqual([cafe.id for cafe in page],
+                         self.cafe_ids[::-1][:2])
+        self.assertEqual(page.items[0].city, "San Francisco, CA")
+        self.assertEqual(page.items[0].liked_at, datetime(2023, 1, 1, 12, 4))
+
+        seen = [cafe.id for cafe in page]
+        while page.next_cursor:
+            page = Like.liked_cafes_page(
+                self.user_id, 2, after=decode_cursor(page.next_cursor))
+            seen += [cafe.id for cafe in page]
+
+        self.assertEqual(seen, self.cafe_ids[::-1])
+
+    def test_bad_cursor(self):
+        for after in [["nope", "x"], ["2020-01-01T00:00:00", "x"], [1, 2]]:
+            page = Like.liked_cafes_page(self.user_id, 2, after=after)
+            self.assertEqual(
+                [cafe.id for cafe in page], self.cafe_ids[::-1][:2])
+
+    def test_coerce_cursor(self):
+        columns = [Like.created_at, Like.cafe_id]
+
+        self.assertEqual(
+            coerce_cursor(["2020-01-02T03:04:05", 7], columns),
+            [datetime(2020, 1, 2, 3, 4, 5), 7])
+        self.assertIsNone(coerce_cursor([7], columns))
+        self.assertIsNone(coerce_cursor(["2020-01-02", 7.5], columns))
+        self.assertIsNone(coerce_cursor([None, 7], columns))
+
+    def test_profile(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-        self.cafe1 = cafe1
-        self.cafe2 = cafe2
+            with patch.dict(app.config, {"LIKED_CAFES_PER_PAGE": 3}):
+                resp = client.get("/profile")
+                html = resp.get_data(as_text=True)
 
+                self.assertIn("Liked Cafes (5)", html)
+                self.assertIn("Liked Cafe 4", html)
+                self.assertNotIn("Liked Cafe 1", html)
 
-    def tearDown(self):
-        """After each test, remove all users, cities, cafes, and likes."""
+                next_cursor = re.search(r'data-next="([^"]+)"', html).group(1)
+                resp = client.get(f"/profile?after={next_cursor}")
+                html = resp.get_data(as_text=True)
 
-        db.session.rollback()
+                self.assertIn("Liked Cafe 1", html)
+                self.assertNotIn("Liked Cafe 4", html)
+                self.assertNotIn("data-next", html)
 
-        # Like.query.delete()
-        # db.session.commit()
+    def test_api(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-        # User.query.delete()
-        # db.session.commit()
+            resp = client.get("/api/profile/likes?limit=3")
+            data = resp.json
+            self.assertEqual([cafe["id"] for cafe in data["cafes"]],
+                             self.cafe_ids[::-1][:3])
+            self.assertEqual(data["cafes"][0]["liked_at"],
+                             "2023-01-01T12:04:00")
+
+            resp = client.get(
+                f"/api/profile/likes?limit=3&after={data['next']}")
+            self.assertEqual([cafe["id"] for cafe in resp.json["cafes"]],
+                             self.cafe_ids[::-1][3:])
+            self.assertIsNone(resp.json["next"])
+
+            resp = client.get("/api/profile/likes?limit=1000")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_anon(self):
+        with app.test_client() as client:
+            resp = client.get("/api/profile/likes")
+            self.assertEqual(resp.json, {"error": "Not logged in"})
+
+
+class LikeEventTestCase(TestCase):
+    """Tests for the like event log."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        LikeEvent.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        users = [User.register(**dict(TEST_USER_DATA, username=f"events{i}"))
+                 for i in range(2)]
+        cafes = [Cafe(**CAFE_DATA_1), Cafe(**CAFE_DATA_2)]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_toggle_logs_events(self):
+        user_id, cafe_id = self.user_ids[0], self.cafe_ids[0]
+
+        with app.test_client() as client:
+            login_for_test(client, user_id)
+            client.post(f"/api/toggle_like/{cafe_id}")
+            client.post(f"/api/toggle_like/{cafe_id}")
+
+        events, _ = LikeEvent.tail()
+        self.assertEqual([(e.kind, e.user_id, e.cafe_id) for e in events],
+                         [("like", user_id, cafe_id),
+                          ("unlike", user_id, cafe_id)])
+
+        # the unlike says when the like it undid was made
+        self.assertIsNotNone(events[1].like_created_at)
+        self.assertEqual(events[0].like_created_at, events[1].like_created_at)
+
+    def test_tail_cursor(self):
+        for cafe_id in self.cafe_ids:
+            Like.add(self.user_ids[0], cafe_id)
+            db.session.commit()
+
+        events, cursor = LikeEvent.tail(limit=1)
+        self.assertEqual([e.cafe_id for e in events], self.cafe_ids[:1])
+
+        events, cursor = LikeEvent.tail(cursor, limit=1)
+        self.assertEqual([e.cafe_id for e in events], self.cafe_ids[1:])
+
+        # nothing new: same cursor back
+        events, same_cursor = LikeEvent.tail(cursor)
+        self.assertEqual(events, [])
+        self.assertEqual(same_cursor, cursor)
+
+        Like.remove(self.user_ids[0], self.cafe_ids[0])
+        db.session.commit()
+
+        events, _ = LikeEvent.tail(cursor)
+        self.assertEqual([e.kind for e in events], ["unlike"])
+
+    def test_tail_waits_for_running_transactions(self):
+        """an event committed after a later one isn't skipped"""
+
+        slow = db.engine.connect()
+        slow_transaction = slow.begin()
+        try:
+            slow.execute(Like.__table__.insert().values(
+                user_id=self.user_ids[0], cafe_id=self.cafe_ids[0]))
+
+            Like.add(self.user_ids[1], self.cafe_ids[1])
+            db.session.commit()
+
+            # held back until the older transaction is done
+            events, cursor = LikeEvent.tail()
+            self.assertEqual(events, [])
+            db.session.commit()
+
+            slow_transaction.commit()
+        finally:
+            slow.close()
+
+        events, cursor = LikeEvent.tail(cursor)
+        self.assertEqual([e.user_id for e in events], self.user_ids)
+
+    def test_partitions(self):
+        Like.add(self.user_ids[0], self.cafe_ids[0])
+        db.session.commit()
+
+        made = LikeEvent.create_partitions(months_ahead=1)
+        db.session.commit()
+        self.assertEqual(len(made), 2)
+        self.assertEqual(LikeEvent.create_partitions(months_ahead=1), [])
+
+        # moved out of the default partition, and still there
+        self.assertEqual(db.session.execute(db.text(
+            "SELECT COUNT(*) FROM like_events_default")).scalar(), 0)
+        self.assertEqual(len(LikeEvent.tail()[0]), 1)
+
+        LikeEvent.create_partitions(months_ahead=0, today=date(2020, 1, 15))
+        db.session.add(LikeEvent(kind="like", user_id=1, cafe_id=1,
+                                 created_at=datetime(2020, 1, 20)))
+        db.session.commit()
+
+        dropped = LikeEvent.drop_partitions(date(2020, 2, 1))
+        db.session.commit()
+        self.assertEqual(dropped, ["like_events_2020_01"])
+        self.assertEqual(LikeEvent.query.count(), 1)
+
+        for name in made:
+            db.session.execute(db.text(f"DROP TABLE {name}"))
+        db.session.commit()
+
+    def test_tail_command(self):
+        Like.add(self.user_ids[0], self.cafe_ids[0])
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["like-events", "tail"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        event = json.loads(result.stdout.splitlines()[0])
+        self.assertEqual(event["kind"], "like")
+        self.assertEqual(event["cafe_id"], self.cafe_ids[0])
+        self.assertIn("cursor: ", result.stderr)
+
+
+class TrendingTestCase(TestCase):
+    """Tests for the trending leaderboards."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        LikeEvent.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        users = [User.register(**dict(TEST_USER_DATA, username=f"trend{i}"))
+                 for i in range(3)]
+        cafes = [Cafe(**CAFE_DATA_1), Cafe(**CAFE_DATA_2),
+                 Cafe(**dict(CAFE_DATA_2, name="Oak Cafe", city_code="oak"))]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+        trending.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        trending.clear()
+
+    def like(self, user_index, cafe_index, days_ago=0):
+        db.session.add(Like(
+            user_id=self.user_ids[user_index],
+            cafe_id=self.cafe_ids[cafe_index],
+            created_at=datetime.now() - timedelta(days=days_ago)))
+        db.session.commit()
+
+    def test_leaderboard(self):
+        board = Leaderboard({1: 2.0, 2: 5.0})
+        board.add(3, 3.0)
+        self.assertEqual(board.top(2), [(2, 5.0), (3, 3.0)])
+
+        board.add(1, 4.0)
+        self.assertEqual(board.top(5), [(1, 6.0), (2, 5.0), (3, 3.0)])
+
+        # at or under the floor: dropped
+        board.add(2, -4.5, floor=0.5)
+        self.assertEqual(board.score(2), 0.0)
+        self.assertEqual(len(board), 2)
+
+        board.scale(0.5)
+        self.assertEqual(board.top(5), [(1, 3.0), (3, 1.5)])
+        self.assertEqual(board.remove(1), 3.0)
+        self.assertEqual(board.top(5), [(3, 1.5)])
+
+    def test_snapshot(self):
+        snapshot = Snapshot.parse("10:15:12,14")
+
+        self.assertTrue(snapshot.sees(9))
+        self.assertTrue(snapshot.sees(13))
+        self.assertFalse(snapshot.sees(12))
+        self.assertFalse(snapshot.sees(15))
+
+    def test_recent_likes_count_more(self):
+        # three likes from ten days (five half-lives) ago lose to one today
+        for user_index in range(3):
+            self.like(user_index, 0, days_ago=10)
+        self.like(0, 1)
+
+        (first, first_score), (second, second_score) = trending.top(5)
+
+        self.assertEqual((first, second), (self.cafe_ids[1], self.cafe_ids[0]))
+        self.assertAlmostEqual(first_score, 1, places=2)
+        self.assertAlmostEqual(second_score, 3 / 32, places=2)
+
+    def test_rebuild_not_counted_twice(self):
+        """likes the rebuild counted aren't added again from the event log"""
+
+        self.like(0, 0)
+        self.like(1, 0)
+
+        trending.rebuild()
+        trending.sync()
+
+        [(cafe_id, score)] = trending.top(5)
+        self.assertEqual(cafe_id, self.cafe_ids[0])
+        self.assertAlmostEqual(score, 2, places=2)
+
+    def test_follows_likes(self):
+        trending.rebuild()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_ids[0])
+            client.post(f"/api/toggle_like/{self.cafe_ids[2]}")
+
+            self.assertEqual(
+                [cafe_id for cafe_id, _ in trending.top(5)], self.cafe_ids[2:])
+            self.assertEqual(
+                [cafe_id for cafe_id, _ in trending.top(5, city_code="oak")],
+                self.cafe_ids[2:])
+            self.assertEqual(trending.top(5, city_code="sf"), [])
+
+            client.post(f"/api/toggle_like/{self.cafe_ids[2]}")
+            self.assertEqual(trending.top(5), [])
+
+        # likes from elsewhere (other processes) are picked up on sync
+        self.like(1, 1)
+        trending.sync()
+        self.assertEqual(
+            [cafe_id for cafe_id, _ in trending.top(5)], self.cafe_ids[1:2])
+
+    def test_move_cafe(self):
+        self.like(0, 0)
+        trending.rebuild()
+
+        trending.move_cafe(self.cafe_ids[0], "oak")
+
+        self.assertEqual(trending.top(5, city_code="sf"), [])
+        self.assertEqual(
+            [cafe_id for cafe_id, _ in trending.top(5, city_code="oak")],
+            self.cafe_ids[:1])
+
+    def test_trending_page(self):
+        self.like(0, 0)
+        self.like(1, 2)
+        trending.rebuild()
+
+        with app.test_client() as client:
+            resp = assert_query_budget(client, "/cafes/trending")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Test Cafe", html)
+            self.assertIn("Oak Cafe", html)
+
+            html = client.get("/cafes/trending?city_code=oak").get_data(
+                as_text=True)
+            self.assertIn("Oak Cafe", html)
+            self.assertNotIn("Test Cafe", html)
+
+    def test_trending_api(self):
+        self.like(0, 0)
+        self.like(1, 0)
+        self.like(1, 1)
+        trending.rebuild()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_ids[0])
+            resp = assert_query_budget(client, "/api/cafes/trending?limit=1")
+            self.assertEqual(resp.status_code, 200)
+
+            [cafe] = resp.json["cafes"]
+            self.assertEqual(cafe["id"], self.cafe_ids[0])
+            self.assertEqual(cafe["city"], "San Francisco, CA")
+            self.assertAlmostEqual(cafe["score"], 2, places=2)
+
+            resp = client.get("/api/cafes/trending?limit=0")
+            self.assertEqual(resp.status_code, 400)
+
+
+class RecommenderTestCase(TestCase):
+    """Tests for similar cafes and suggestions."""
+
+    N_CAFES = 8
+    N_USERS = 10
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        LikeEvent.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        users = [User.register(**dict(TEST_USER_DATA, username=f"rec{i}"))
+                 for i in range(self.N_USERS)]
+        cafes = [Cafe(**dict(CAFE_DATA_1, name=f"Rec Cafe {i}"))
+                 for i in range(self.N_CAFES)]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+        recommender.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        recommender.clear()
+
+    def like(self, user_index, cafe_index):
+        Like.add(self.user_ids[user_index], self.cafe_ids[cafe_index])
+        db.session.commit()
+
+    def test_cosine_neighbors(self):
+        """same as working out every pair, brute force"""
+
+        rng = np.random.default_rng(0)
+        dense = (rng.random((30, 40)) < 0.2).astype(np.float32)
+        likes = LikeMatrix(sparse.csr_matrix(dense))
+
+        neighbors, similarity = cosine_neighbors(
+            likes, np.arange(30), 5, batch_size=7)
+
+        norms = np.sqrt(dense.sum(axis=1))
+        for cafe in range(30):
+            expected = sorted(
+                ((dense[cafe] @ dense[other]) / (norms[cafe] * norms[other]),
+                 other)
+                for other in range(30)
+                if other != cafe and dense[cafe] @ dense[other])
+            expected = sorted(expected, key=lambda pair: (-pair[0], pair[1]))[:5]
+
+            found = [(score, other) for score, other
+                     in zip(similarity[cafe], neighbors[cafe]) if other >= 0]
+            self.assertEqual([other for _, other in found],
+                             [other for _, other in expected])
+            np.testing.assert_allclose(
+                [score for score, _ in found],
+                [score for score, _ in expected], rtol=1e-5)
+
+    def test_like_matrix_changes(self):
+        """changes go in the delta (leaving the base alone) and read back
+        the same as a matrix built from scratch"""
+
+        rng = np.random.default_rng(1)
+        dense = (rng.random((6, 7)) < 0.4).astype(np.float32)
+        likes = LikeMatrix(sparse.csr_matrix(dense))
+
+        # likes and unlikes, some of them no-ops, and a new cafe and user
+        cafes = np.array([0, 1, 2, 6, 3, 3])
+        users = np.array([0, 1, 7, 2, 4, 4])
+        changes = np.array([1, -1, 1, 1, -1, -1], dtype=np.float32)
+        changed = likes.changed(cafes, users, changes, (7, 8))
+
+        expected = np.zeros((7, 8), dtype=np.float32)
+        expected[:6, :7] = dense
+        np.add.at(expected, (cafes, users), changes)
+        expected = np.clip(expected, 0, 1)
+
+        self.assertTrue(np.shares_memory(changed.base.data, likes.base.data))
+        self.assertTrue(
+            np.shares_memory(changed.base_t.indices, likes.base_t.indices))
+        self.assertLessEqual(changed.delta.nnz, len(cafes))
+
+        for matrix in (changed, changed.merged()):
+            np.testing.assert_array_equal(
+                matrix.rows(np.arange(7)).toarray(), expected)
+            np.testing.assert_array_equal(matrix.counts, expected.sum(axis=1))
+            np.testing.assert_array_equal(
+                matrix.co_counts(np.arange(7)).toarray(),
+                expected @ expected.T)
+            for user in range(8):
+                np.testing.assert_array_equal(
+                    matrix.liked_by(user), np.flatnonzero(expected[:, user]))
+
+        self.assertEqual(changed.merged().delta.nnz, 0)
+
+    def test_similar_and_suggestions(self):
+        # users 0-2 like cafes 0 and 1; user 3 likes cafes 1 and 2
+        for user_index in range(3):
+            self.like(user_index, 0)
+            self.like(user_index, 1)
+        self.like(3, 1)
+        self.like(3, 2)
+
+        recommender.rebuild()
+
+        similar = recommender.similar(self.cafe_ids[0], 5)
+        self.assertEqual([cafe_id for cafe_id, _ in similar],
+                         [self.cafe_ids[1]])
+        self.assertAlmostEqual(similar[0][1], 3 / (3 * 4) ** 0.5, places=5)
+
+        # user 3 doesn't like cafe 0 yet, but likes what its fans like
+        self.assertEqual(
+            [cafe_id for cafe_id, _ in recommender.for_user(
+                self.user_ids[3], 5)],
+            [self.cafe_ids[0]])
+
+        self.assertEqual(recommender.similar(self.cafe_ids[7], 5), [])
+        self.assertEqual(recommender.for_user(self.user_ids[9], 5), [])
+
+    def test_sync_matches_rebuild(self):
+        """following the event log ends up where a rebuild would"""
+
+        # merging the like matrix's changes on every sync, and never
+        for fraction in (0, 100):
+            with self.subTest(merge_fraction=fraction), \
+                    patch("recommend.MERGE_FRACTION", fraction):
+                self.check_sync_matches_rebuild(random.Random(fraction))
+
+    def check_sync_matches_rebuild(self, rng):
+        for _ in range(30):
+            self.like(rng.randrange(self.N_USERS - 2),
+                      rng.randrange(self.N_CAFES - 2))
+
+        small = Recommender(app)
+        small.n_neighbors = 2
+        for rec in (recommender, small):
+            rec.rebuild()
+            rec.sync()
+
+        # likes, unlikes, and cafes and users it hasn't seen
+        for _ in range(40):
+            user_id = self.user_ids[rng.randrange(self.N_USERS)]
+            cafe_id = self.cafe_ids[rng.randrange(self.N_CAFES)]
+            if not Like.remove(user_id, cafe_id):
+                Like.add(user_id, cafe_id)
+            db.session.commit()
+
+            if rng.random() < 0.3:
+                recommender.sync()
+                small.sync()
+
+        recommender.sync()
+        small.sync()
+
+        fresh = Recommender(app)
+        fresh.rebuild()
+        fresh_small = Recommender(app)
+        fresh_small.n_neighbors = 2
+        fresh_small.rebuild()
+
+        def scores(rec, cafe_id):
+            return sorted(round(score, 5) for _, score
+                          in rec.similar(cafe_id, rec.n_neighbors))
+
+        for cafe_id in self.cafe_ids:
+            with self.subTest(cafe_id=cafe_id):
+                self.assertEqual(
+                    {other: round(score, 5) for other, score
+                     in recommender.similar(cafe_id, self.N_CAFES)},
+                    {other: round(score, 5) for other, score
+                     in fresh.similar(cafe_id, self.N_CAFES)})
+
+                # (which of two equally similar cafes is kept can differ)
+                self.assertEqual(scores(small, cafe_id),
+                                 scores(fresh_small, cafe_id))
+
+        for user_id in self.user_ids:
+            self.assertEqual(
+                {cafe_id: round(score, 5) for cafe_id, score
+                 in recommender.for_user(user_id, self.N_CAFES)},
+                {cafe_id: round(score, 5) for cafe_id, score
+                 in fresh.for_user(user_id, self.N_CAFES)})
+
+    def test_rebuild_not_counted_twice(self):
+        self.like(0, 0)
+        self.like(0, 1)
+        self.like(1, 1)
+
+        recommender.rebuild()
+        recommender.sync()
+
+        [(cafe_id, score)] = recommender.similar(self.cafe_ids[0], 5)
+        self.assertEqual(cafe_id, self.cafe_ids[1])
+        self.assertAlmostEqual(score, 1 / 2 ** 0.5, places=5)
+
+    def test_pages(self):
+        for user_index in range(2):
+            self.like(user_index, 0)
+            self.like(user_index, 1)
+        self.like(2, 1)
+        recommender.rebuild()
+
+        with app.test_client() as client:
+            resp = assert_query_budget(client, f"/cafes/{self.cafe_ids[0]}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('id="similar-cafes"', html)
+            self.assertIn("Rec Cafe 1", html)
+
+            login_for_test(client, self.user_ids[2])
+            resp = assert_query_budget(client, "/profile")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Cafes You May Like", html)
+            self.assertIn('<a href="/cafes/%d">Rec Cafe 0</a>'
+                          % self.cafe_ids[0], html)
+
+    def test_no_index_yet(self):
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{self.cafe_ids[0]}").get_data(
+                as_text=True)
+            self.assertNotIn('id="similar-cafes"', html)
+
+
+class ApiV1TestCase(TestCase):
+    """Tests for the /api/v1 JSON API."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        user = User.register(**TEST_USER_DATA)
+        cafes = [Cafe(**dict(CAFE_DATA_1, name=f"Api Cafe {i}"))
+                 for i in range(5)]
+        cafes.append(Cafe(**dict(CAFE_DATA_2, name="Oak Cafe",
+                                 city_code="oak")))
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_list_cafes(self):
+        with app.test_client() as client:
+            resp = assert_query_budget(client, "/api/v1/cafes?limit=4")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/json")
+
+            body = resp.json
+            self.assertEqual([cafe["name"] for cafe in body["data"]],
+                             [f"Api Cafe {i}" for i in range(4)])
+            self.assertEqual(body["data"][0]["city"], "San Francisco, CA")
+            self.assertEqual(body["data"][0]["website"], CAFE_DATA_1["url"])
+
+            body = client.get(
+                f"/api/v1/cafes?limit=4&after={body['next']}").json
+            self.assertEqual([cafe["name"] for cafe in body["data"]],
+                             ["Api Cafe 4", "Oak Cafe"])
+            self.assertIsNone(body["next"])
+
+            body = client.get("/api/v1/cafes?city_code=oak").json
+            self.assertEqual([cafe["id"] for cafe in body["data"]],
+                             self.cafe_ids[5:])
+
+    def test_sparse_fields(self):
+        with app.test_client() as client:
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            db.event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.get("/api/v1/cafes?fields=id,name&limit=1")
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", record)
+
+            self.assertEqual(resp.json["data"],
+                             [{"id": self.cafe_ids[0], "name": "Api Cafe 0"}])
+            # only the columns asked for are read
+            self.assertNotIn("description", statements[-1])
+
+            resp = client.get(
+                f"/api/v1/cafes/{self.cafe_ids[5]}?fields=city,url")
+            self.assertEqual(resp.json, {"data": {
+                "city": "Oakland, CA", "url": f"/cafes/{self.cafe_ids[5]}"}})
+
+            resp = client.get("/api/v1/cafes?fields=id,secret")
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["error"]["code"], "bad_request")
+            self.assertIn("secret", resp.json["error"]["message"])
+
+    def test_long_list_streams(self):
+        with app.test_client() as client:
+            resp = client.get("/api/v1/cafes?limit=1000")
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(len(json.loads(resp.get_data())["data"]), 6)
+
+    def test_bad_cursor(self):
+        with app.test_client() as client:
+            name_cursor = client.get("/api/v1/cafes?limit=1").json["next"]
+
+            for url in ["/api/v1/cafes?after=not-a-cursor",
+                        f"/api/v1/cafes?sort=popular&after={name_cursor}",
+                        f"/api/v1/cafes?after={encode_cursor([0, 6])}",
+                        "/api/v1/cafes?after="
+                        + encode_cursor([{"a": 1}, 6], sort="name")]:
+                with self.subTest(url=url):
+                    resp = client.get(url)
+                    self.assertEqual(resp.status_code, 400)
+                    self.assertEqual(resp.json["error"]["message"],
+                                     "bad cursor")
+
+            resp = client.get(f"/api/v1/cafes?sort=name&after={name_cursor}")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_search(self):
+        with app.test_client() as client:
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            db.event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = assert_query_budget(
+                    client, "/api/v1/cafes/search?q=oak&fields=name")
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", record)
+
+            self.assertEqual(resp.json["data"], [{"name": "Oak Cafe"}])
+            # only the columns asked for are read
+            self.assertNotIn("description", statements[-1])
+
+            resp = assert_query_budget(client, "/api/v1/cities/search?q=OAK")
+            self.assertEqual(resp.json["data"], [
+                {"code": "oak", "name": "Oakland", "state": "CA"}])
+
+    def test_cities(self):
+        with app.test_client() as client:
+            resp = assert_query_budget(client, "/api/v1/cities?fields=code")
+            self.assertEqual(resp.json["data"],
+                             [{"code": "oak"}, {"code": "sf"}])
+
+            resp = assert_query_budget(client, "/api/v1/cities/sf")
+            self.assertEqual(resp.json["data"]["name"], "San Francisco")
+
+    def test_errors(self):
+        with app.test_client() as client:
+            for url, status, code in [
+                    ("/api/v1/cafes/0", 404, "not_found"),
+                    ("/api/v1/cities/nope", 404, "not_found"),
+                    ("/api/v1/no-such-thing", 404, "not_found"),
+                    ("/api/v1/cafes?limit=0", 400, "bad_request"),
+                    ("/api/v1/cafes?sort=random", 400, "bad_request"),
+                    ("/api/v1/likes?cafe_ids=1", 401, "unauthorized")]:
+                with self.subTest(url=url):
+                    resp = client.get(url)
+                    self.assertEqual(resp.status_code, status)
+                    self.assertEqual(resp.json["error"]["status"], status)
+                    self.assertEqual(resp.json["error"]["code"], code)
+
+            resp = client.delete("/api/v1/cafes")
+            self.assertEqual(resp.status_code, 405)
+            self.assertEqual(resp.json["error"]["code"], "method_not_allowed")
+
+            # the site's own pages still get HTML
+            self.assertIn(b"<html", client.get("/no-such-page").data.lower())
+
+    def test_csrf_error_is_json(self):
+        with patch.dict(app.config, {"WTF_CSRF_ENABLED": True}), \
+                app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/api/v1/likes", json={"like": [1]})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("CSRF", resp.json["error"]["message"])
+
+    def test_bulk_likes(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = assert_query_budget(
+                client, "/api/v1/likes", method="post",
+                json={"like": self.cafe_ids[:3] + [0]})
+            self.assertEqual(resp.json["data"],
+                             {"liked": self.cafe_ids[:3], "unliked": []})
+
+            resp = client.post("/api/v1/likes", json={
+                "like": self.cafe_ids[:2], "unlike": self.cafe_ids[2:4]})
+            self.assertEqual(resp.json["data"],
+                             {"liked": [], "unliked": self.cafe_ids[2:3]})
+
+            ids = ",".join(str(cafe_id) for cafe_id in self.cafe_ids[:3])
+            resp = assert_query_budget(client, f"/api/v1/likes?cafe_ids={ids}")
+            self.assertEqual(resp.json["data"], {
+                str(self.cafe_ids[0]): True,
+                str(self.cafe_ids[1]): True,
+                str(self.cafe_ids[2]): False,
+            })
+
+            self.assertEqual(
+                Cafe.query.get(self.cafe_ids[0]).like_count, 1)
+            self.assertEqual(User.query.get(self.user_id).like_count, 2)
+
+            for body in [None, {"like": "1"}, {"like": [True]},
+                         {"like": [1], "unlike": [1]},
+                         {"like": list(range(101))}]:
+                with self.subTest(body=body):
+                    resp = client.post("/api/v1/likes", json=body)
+                    self.assertEqual(resp.status_code, 400)
+
+
+class PrincipalCacheTestCase(TestCase):
+    """Tests for the cached current-user lookup."""
+
+    def setUp(self):
+        """Before each test, add sample user and start counting queries."""
+
+        User.query.delete()
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.queries = []
+        db.event.listen(db.engine, "before_cursor_execute", self.count_query)
+
+    def tearDown(self):
+        db.event.remove(db.engine, "before_cursor_execute", self.count_query)
+        db.session.rollback()
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def test_get_is_cached(self):
+        cache = PrincipalCache()
+
+        principal = cache.get(self.user_id)
+        self.assertEqual(principal.username, "test")
+        self.assertEqual(principal.get_full_name(), "Testy MacTest")
+        self.assertNotIn("password", self.queries[0])
+
+        cache.get(self.user_id)
+        self.assertEqual(len(self.queries), 1)
+
+        cache.invalidate(self.user_id)
+        cache.get(self.user_id)
+        self.assertEqual(len(self.queries), 2)
+
+        self.assertIsNone(cache.get(""))
+        self.assertIsNone(cache.get(999999))
+
+    def test_requests_skip_user_query(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/cafes")
+            self.queries.clear()
+
+            client.get("/")
+            self.assertEqual(self.queries, [])
+
+    def test_profile_edit_invalidates(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/")
+
+            resp = client.post(
+                "/profile/edit",
+                data={**TEST_USER_DATA_EDIT, "first_name": "Renamed"},
+                follow_redirects=True)
+            self.assertIn(b"Renamed new-ln</a>", resp.data)
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+
+        # least recently used goes first
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), "one")
+        self.assertEqual(len(cache), 2)
+
+        cache = TTLCache(maxsize=2, ttl=-1)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+
+
+#######################################
+# likes
+
+
+class LikeViewsTestCase(TestCase):
+    """Tests for views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample user."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        Like.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.user = user
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe1 = Cafe(**CAFE_DATA_1)
+        cafe2 = Cafe(**CAFE_DATA_2)
+        db.session.add(cafe1)
+        db.session.add(cafe2)
+        db.session.commit()
+
+        self.cafe1 = cafe1
+        self.cafe2 = cafe2
+
+
+    def tearDown(self):
+        """After each test, remove all users, cities, cafes, and likes."""
+
+        db.session.rollback()
+
+        # Like.query.delete()
+        # db.session.commit()
+
+        # User.query.delete()
+        # db.session.commit()
 
         # Cafe.query.delete()
         # City.query.delete()
@@ -723,6 +2448,81 @@ class LikeViewsTestCase(TestCase):
 
         self.assertEqual(like_count, 2)
 
+    def test_like_unlike_model(self):
+        """Liking/unliking goes straight to the likes table and is idempotent"""
+
+        self.assertTrue(Like.add(self.user_id, self.cafe1.id))
+        self.assertFalse(Like.add(self.user_id, self.cafe1.id))
+        db.session.commit()
+        self.assertTrue(self.cafe1.is_liking_cafe(self.user))
+        self.assertTrue(self.user.currently_likes(self.cafe1))
+
+        self.assertTrue(Like.remove(self.user_id, self.cafe1.id))
+        self.assertFalse(Like.remove(self.user_id, self.cafe1.id))
+        db.session.commit()
+        self.assertFalse(self.cafe1.is_liking_cafe(self.user))
+
+        self.cafe2.like_cafe(self.user)
+        self.cafe2.like_cafe(self.user)
+        db.session.commit()
+        self.assertEqual(self.cafe2.liking_users, [self.user])
+
+        self.cafe2.unlike_cafe(self.user)
+        db.session.commit()
+        self.assertEqual(self.cafe2.liking_users, [])
+
+    def test_toggle_model(self):
+        self.assertIs(Like.toggle(self.user_id, self.cafe1.id), True)
+        self.assertTrue(self.user.currently_likes(self.cafe1))
+        self.assertIs(Like.toggle(self.user_id, self.cafe1.id), False)
+        self.assertFalse(self.user.currently_likes(self.cafe1))
+        self.assertIsNone(Like.toggle(self.user_id, 999999))
+
+    def test_like_count(self):
+        """like_count follows likes however they're added or removed"""
+
+        Like.add(self.user_id, self.cafe1.id)
+        self.user.liked_cafes.append(self.cafe2)
+        db.session.commit()
+        db.session.refresh(self.cafe1)
+        db.session.refresh(self.cafe2)
+        self.assertEqual(self.cafe1.like_count, 1)
+        self.assertEqual(self.cafe2.like_count, 1)
+
+        Like.remove(self.user_id, self.cafe1.id)
+        db.session.commit()
+        db.session.refresh(self.cafe1)
+        self.assertEqual(self.cafe1.like_count, 0)
+
+    def test_reconcile_like_counts(self):
+        """reconcile command repairs drifted like counts"""
+
+        Like.add(self.user_id, self.cafe1.id)
+        db.session.commit()
+        Cafe.query.update({"like_count": 7})
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["reconcile-like-counts"])
+        self.assertIn("2 cafe(s) corrected", result.output)
+
+        db.session.refresh(self.cafe1)
+        db.session.refresh(self.cafe2)
+        self.assertEqual(self.cafe1.like_count, 1)
+        self.assertEqual(self.cafe2.like_count, 0)
+
+    def test_list_sort_popular(self):
+        """cafes can be listed most-liked first"""
+
+        Like.add(self.user_id, self.cafe2.id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?sort=popular")
+            html = resp.data.decode('utf8')
+            self.assertLess(html.index("Test2 Cafe"), html.index("Test Cafe"))
+            self.assertIn("1 like<", html)
+
     ## likes tests for views
     def test_api_likes(self):
         """Checks likes"""
@@ -738,6 +2538,55 @@ class LikeViewsTestCase(TestCase):
             resp = client.get(f"/api/likes?cafe_id={self.cafe1.id}")
             self.assertEqual(resp.json, {'likes': True})
 
+    def test_api_likes_batch(self):
+        """Checks likes for many cafes in one request"""
+
+        ids = f"{self.cafe1.id},{self.cafe2.id}"
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/likes/batch?cafe_ids={ids}")
+            self.assertEqual(resp.json, {"error": "Not logged in"})
+
+            login_for_test(client, self.user_id)
+            self.user.liked_cafes.append(self.cafe1)
+            db.session.commit()
+
+            resp = client.get(f"/api/likes/batch?cafe_ids={ids}")
+            self.assertEqual(resp.json, {"likes": {
+                str(self.cafe1.id): True,
+                str(self.cafe2.id): False,
+            }})
+
+            resp = client.get("/api/likes/batch?cafe_ids=1,nope")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_likes_batch_page(self):
+        """Checks likes for every cafe on a /cafes page"""
+
+        self.user.liked_cafes.append(self.cafe1)
+        db.session.commit()
+
+        per_page = app.config['CAFES_PER_PAGE']
+        app.config['CAFES_PER_PAGE'] = 1
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+
+                resp = assert_query_budget(
+                    client, "/api/likes/batch?sort=popular")
+                self.assertEqual(resp.json, {"likes": {
+                    str(self.cafe1.id): True}})
+
+                html = client.get("/cafes?sort=popular").data.decode('utf8')
+                after = re.search(r'after=([^"]+)"', html).group(1)
+
+                resp = client.get(
+                    f"/api/likes/batch?sort=popular&after={after}")
+                self.assertEqual(resp.json, {"likes": {
+                    str(self.cafe2.id): False}})
+        finally:
+            app.config['CAFES_PER_PAGE'] = per_page
+
     def test_api_like(self):
         """tests when a user likes a cafe"""
 
@@ -750,6 +2599,16 @@ class LikeViewsTestCase(TestCase):
             resp = client.post(f"/api/toggle_like/{self.cafe1.id}")
             self.assertEqual(resp.json, {'liked': self.cafe1.id})
 
+    def test_api_like_missing_cafe(self):
+        """tests liking a cafe that doesn't exist"""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.post("/api/toggle_like/999999")
+            self.assertIn(b"404", resp.data)
+            self.assertEqual(Like.query.count(), 0)
+
 
     def test_api_unlike(self):
         """tests when a user unlikes a cafe"""
@@ -767,3 +2626,836 @@ class LikeViewsTestCase(TestCase):
 
 
 
+
+
+#######################################
+# map jobs
+
+
+class MapJobQueueTestCase(TestCase):
+    """Tests for the background map fetch queue."""
+
+    def setUp(self):
+        """Before each test, make an empty journal and a stub fetcher."""
+
+        self.journal_dir = tempfile.mkdtemp()
+        self.fetched = []
+
+    def fetch(self, address, city, state):
+        self.fetched.append(address)
+
+    def test_fetches_in_background(self):
+        queue = MapJobQueue(fetch=self.fetch, journal_dir=self.journal_dir,
+                            workers=2, max_attempts=3, backoff=0.01)
+
+        queue.enqueue("500 Sansome St", "San Francisco", "CA")
+        queue.enqueue("502 Sansome St", "San Francisco", "CA")
+
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(sorted(self.fetched),
+                         ["500 Sansome St", "502 Sansome St"])
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+    def test_dedupes_pending_jobs(self):
+        release = threading.Event()
+
+        def slow_fetch(*args):
+            release.wait(5)
+            self.fetch(*args)
+
+        queue = MapJobQueue(fetch=slow_fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=3, backoff=0.01)
+
+        self.assertTrue(queue.enqueue("500 Sansome St", "San Francisco", "CA"))
+        self.assertFalse(queue.enqueue("500  sansome st", "San Francisco", "CA"))
+        self.assertTrue(queue.enqueue("1 Market St", "San Francisco", "CA"))
+        self.assertEqual(len(queue.pending()), 2)
+
+        release.set()
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(sorted(self.fetched), ["1 Market St", "500 Sansome St"])
+
+    def test_retries_with_backoff(self):
+        failures = [RuntimeError("upstream down")] * 2
+
+        def flaky_fetch(*args):
+            if failures:
+                raise failures.pop()
+            self.fetch(*args)
+
+        queue = MapJobQueue(fetch=flaky_fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=3, backoff=0.01)
+        queue.enqueue("500 Sansome St", "San Francisco", "CA")
+
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(self.fetched, ["500 Sansome St"])
+
+    def test_gives_up(self):
+        def broken_fetch(*args):
+            raise RuntimeError("upstream down")
+
+        queue = MapJobQueue(fetch=broken_fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=2, backoff=0.01)
+        queue.enqueue("500 Sansome St", "San Francisco", "CA")
+
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+    def test_given_up_not_fetched_again(self):
+        attempts = []
+
+        def broken_fetch(address, *args):
+            attempts.append(address)
+            raise RuntimeError("bad address")
+
+        queue = MapJobQueue(fetch=broken_fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=2, backoff=0.01,
+                            failure_ttl=0.5)
+        self.assertTrue(queue.enqueue("0 Nowhere", "San Francisco", "CA"))
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(len(attempts), 2)
+
+        # page views asking again don't fetch it again...
+        for _ in range(3):
+            self.assertFalse(queue.enqueue("0 Nowhere", "San Francisco", "CA"))
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(len(attempts), 2)
+
+        # ...until the TTL runs out
+        time.sleep(0.5)
+        self.assertTrue(queue.enqueue("0 Nowhere", "San Francisco", "CA"))
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(len(attempts), 4)
+
+    def test_resumes_from_journal(self):
+        def broken_fetch(*args):
+            raise RuntimeError("upstream down")
+
+        # first "process" can't fetch, and leaves the job in its journal
+        queue = MapJobQueue(fetch=broken_fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=100, backoff=60)
+        queue.enqueue("500 Sansome St", "San Francisco", "CA")
+        self.assertFalse(queue.join(timeout=0.2))
+        self.assertEqual(len(os.listdir(self.journal_dir)), 1)
+
+        # after a "restart", the job gets done
+        queue = MapJobQueue(fetch=self.fetch, journal_dir=self.journal_dir,
+                            workers=1, max_attempts=3, backoff=0.01)
+        queue.start()
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(self.fetched, ["500 Sansome St"])
+
+
+class MapCacheTestCase(TestCase):
+    """Tests for the content-addressed map cache."""
+
+    def setUp(self):
+        """Before each test, point the cache at an empty directory."""
+
+        self.maps_dir = mapping.MAPS_DIR
+        mapping.MAPS_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        mapping.MAPS_DIR = self.maps_dir
+
+    def test_map_key_normalizes(self):
+        self.assertEqual(
+            mapping.map_key("500 Sansome St", "San Francisco", "CA"),
+            mapping.map_key(" 500  sansome st", "san francisco", "ca"))
+        self.assertNotEqual(
+            mapping.map_key("500 Sansome St", "San Francisco", "CA"),
+            mapping.map_key("502 Sansome St", "San Francisco", "CA"))
+
+    def test_cached_map_is_reused(self):
+        key = mapping.save_stub_map("500 Sansome St", "San Francisco", "CA")
+        self.assertTrue(mapping.get_cached_map(key))
+
+        # a fresh cached copy means no upstream call at all
+        old_url = mapping.STATIC_MAP_URL
+        mapping.STATIC_MAP_URL = "http://upstream.invalid/map"
+        try:
+            self.assertEqual(
+                mapping.save_map("500 Sansome St", "San Francisco", "CA"), key)
+        finally:
+            mapping.STATIC_MAP_URL = old_url
+
+    def test_detects_bad_and_stale_maps(self):
+        key = mapping.save_stub_map("500 Sansome St", "San Francisco", "CA")
+        path = mapping.cached_map_path(key)
+
+        os.utime(path, (0, 0))
+        self.assertTrue(mapping.get_cached_map(key))
+        self.assertIsNone(mapping.get_cached_map(key, max_age=60))
+
+        with open(path, "wb") as f:
+            f.write(b"<html>502 Bad Gateway</html>")
+        self.assertIsNone(mapping.get_cached_map(key))
+
+        self.assertIsNone(mapping.get_cached_map("no-such-key"))
+
+    def test_evict_maps(self):
+        old = mapping.save_stub_map("500 Sansome St", "San Francisco", "CA")
+        mid = mapping.save_stub_map("502 Sansome St", "San Francisco", "CA")
+        new = mapping.save_stub_map("504 Sansome St", "San Francisco", "CA")
+        size = os.path.getsize(mapping.cached_map_path(new))
+
+        os.utime(mapping.cached_map_path(old), (0, 0))
+        os.utime(mapping.cached_map_path(mid), (1000, 1000))
+
+        removed, freed = mapping.evict_maps(max_bytes=None, max_age=10**12)
+        self.assertEqual(removed, 0)
+
+        # by size: oldest goes first
+        removed, freed = mapping.evict_maps(max_bytes=2 * size, max_age=None)
+        self.assertEqual((removed, freed), (1, size))
+        self.assertIsNone(mapping.get_cached_map(old))
+        self.assertTrue(mapping.get_cached_map(mid))
+
+        # by age
+        removed, freed = mapping.evict_maps(max_bytes=None, max_age=3600)
+        self.assertEqual(removed, 1)
+        self.assertIsNone(mapping.get_cached_map(mid))
+        self.assertTrue(mapping.get_cached_map(new))
+
+
+class MapBackfillTestCase(TestCase):
+    """Tests for bulk map backfill."""
+
+    def setUp(self):
+        """Before each test, point the cache at an empty directory."""
+
+        self.maps_dir = mapping.MAPS_DIR
+        mapping.MAPS_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        mapping.MAPS_DIR = self.maps_dir
+
+    def test_backfill_maps(self):
+        fetched = []
+
+        def fetch(address, city, state):
+            if address == "1 Broken St":
+                raise RuntimeError("upstream down")
+            fetched.append(address)
+            return mapping.save_stub_map(address, city, state)
+
+        mapping.save_stub_map("1 Cached St", "San Francisco", "CA")
+
+        batches = [
+            [(1, "1 Main St", "San Francisco", "CA"),
+             (2, "1 Main St", "San Francisco", "CA"),
+             (3, "1 Cached St", "San Francisco", "CA")],
+            [(4, "1 Broken St", "San Francisco", "CA"),
+             (5, "2 Main St", "San Francisco", "CA")],
+        ]
+        progress = []
+
+        stats = backfill_maps(iter(batches), fetch, workers=4,
+                              progress=lambda stats: progress.append(stats.last_id))
+
+        self.assertEqual(sorted(fetched), ["1 Main St", "2 Main St"])
+        self.assertEqual(stats.scanned, 5)
+        self.assertEqual(stats.cached, 1)
+        self.assertEqual(stats.fetched, 2)
+        self.assertEqual([cafe_id for cafe_id, _ in stats.failed], [4])
+        self.assertEqual(progress, [3, 5])
+
+        # running again only retries what's still missing
+        fetched.clear()
+        stats = backfill_maps(iter(batches), fetch, workers=4)
+        self.assertEqual(fetched, [])
+        self.assertEqual(stats.cached, 4)
+
+    def test_backfill_maps_command(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all([Cafe(**CAFE_DATA_1), Cafe(**CAFE_DATA_2)])
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["backfill-maps", "--batch-size", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 fetched, 0 failed", result.output)
+
+        for cafe in Cafe.query.all():
+            self.assertTrue(cafe.has_map())
+
+
+class StubMapQuestHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the MapQuest static map API."""
+
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_GET(self):
+        StubMapQuestHandler.connections.add(self.client_address)
+
+        if "Broken" in self.path:
+            status, content_type, body = 500, "text/plain", b"oops"
+        elif "Html" in self.path:
+            status, content_type, body = 200, "text/html", b"<html></html>"
+        else:
+            with open(mapping.STUB_MAP_IMAGE, "rb") as f:
+                status, content_type, body = 200, "image/jpeg", f.read()
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MapFetchTestCase(TestCase):
+    """Tests for fetching maps through the pooled HTTP session."""
+
+    def setUp(self):
+        """Before each test, start a stub MapQuest and empty the cache."""
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubMapQuestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubMapQuestHandler.connections = set()
+
+        self.maps_dir = mapping.MAPS_DIR
+        self.map_url = mapping.STATIC_MAP_URL
+        mapping.MAPS_DIR = tempfile.mkdtemp()
+        mapping.STATIC_MAP_URL = f"http://127.0.0.1:{self.server.server_port}/map"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        mapping.MAPS_DIR = self.maps_dir
+        mapping.STATIC_MAP_URL = self.map_url
+
+    def test_fetch_reuses_connection(self):
+        for n in range(3):
+            key = mapping.save_map(f"{n} Main St", "San Francisco", "CA")
+            self.assertTrue(mapping.get_cached_map(key))
+
+        self.assertEqual(len(StubMapQuestHandler.connections), 1)
+
+    def test_fetch_rejects_errors(self):
+        with self.assertRaises(mapping.MapFetchError):
+            mapping.save_map("1 Broken St", "San Francisco", "CA")
+
+        with self.assertRaises(mapping.MapFetchError):
+            mapping.save_map("1 Html St", "San Francisco", "CA")
+
+        self.assertIsNone(mapping.get_cached_map(
+            mapping.map_key("1 Html St", "San Francisco", "CA")))
+
+
+#######################################
+# schema and query plans
+
+
+class MigrationsTestCase(TestCase):
+    """Tests for the schema migration runner."""
+
+    def setUp(self):
+        db.session.commit()
+
+    def test_fresh_database_stamped(self):
+        self.assertEqual(migrations.pending_migrations(), [])
+
+    def test_upgrade_old_schema(self):
+        """migrations bring back indexes, columns and triggers an older
+        database wouldn't have, and record themselves"""
+
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("""
+                DROP INDEX ix_cafes_name_id;
+                DROP INDEX ix_likes_cafe_id_user_id;
+                DROP TRIGGER likes_like_count ON likes;
+                DROP TRIGGER likes_user_like_count ON likes;
+                DROP TRIGGER likes_like_event ON likes;
+                DROP TABLE like_events;
+                ALTER TABLE cafes DROP COLUMN latitude, DROP COLUMN longitude;
+                ALTER TABLE likes DROP COLUMN created_at;
+                ALTER TABLE users DROP COLUMN like_count;
+                DELETE FROM schema_migrations;
+            """)
+
+        try:
+            ran = migrations.upgrade()
+        finally:
+            # whatever happened, leave the schema usable for other tests
+            migrations.upgrade()
+
+        self.assertEqual(ran, migrations.MIGRATIONS)
+        self.assertEqual(migrations.pending_migrations(), [])
+
+        indexes = db.session.execute(db.text(
+            "SELECT indexname FROM pg_indexes WHERE tablename IN "
+            "('cafes', 'likes')")).scalars().all()
+        for index in ["ix_cafes_name_id", "ix_likes_cafe_id_user_id",
+                      "ix_cafes_latitude_longitude", "ix_cafes_city_code",
+                      "ix_likes_user_id_created_at"]:
+            self.assertIn(index, indexes)
+
+        triggers = db.session.execute(db.text(
+            "SELECT tgname FROM pg_trigger WHERE NOT tgisinternal"
+        )).scalars().all()
+        self.assertIn("likes_like_count", triggers)
+        self.assertIn("likes_user_like_count", triggers)
+        self.assertIn("likes_like_event", triggers)
+        self.assertEqual(LikeEvent.tail(), ([], None))
+
+        db.session.commit()
+
+    def test_status_command(self):
+        result = app.test_cli_runner().invoke(args=["db", "status"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("0007  applied", result.output)
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests for per-request timings, /metrics and query budgets."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**dict(CAFE_DATA_1, name=f"Cafe {i}"))
+                 for i in range(30)]
+        db.session.add_all(cafes)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        for cafe in cafes[:10]:
+            db.session.add(Like(user_id=user.id, cafe_id=cafe.id))
+        db.session.commit()
+
+        self.cafe_id = cafes[0].id
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def clear_caches(self):
+        principals.cache.clear()
+        city_registry.invalidate()
+        fragments.clear()
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+
+        timing = resp.headers["Server-Timing"]
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r"tpl;dur=[\d.]+")
+        self.assertRegex(timing, r"total;dur=[\d.]+")
+
+    def test_stats(self):
+        self.clear_caches()
+
+        with app.test_client() as client:
+            with record_requests() as requests:
+                client.get("/cafes")
+
+        stats = requests[-1]
+        self.assertEqual(stats.endpoint, "cafe.cafe_list")
+        self.assertEqual(stats.queries, len(stats.statements))
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.template_seconds, 0)
+        self.assertLessEqual(stats.template_seconds, stats.total_seconds)
+
+    def test_upstream(self):
+        with app.test_request_context("/"):
+            app.preprocess_request()
+
+            with track_upstream("test"):
+                pass
+            with track_upstream("test"):
+                pass
+
+            self.assertEqual(current_stats().upstream_calls, 2)
+
+        self.assertIsNone(current_stats())
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+
+        text = resp.get_data(as_text=True)
+        self.assertRegex(
+            text, r'flaskcafe_requests_total\{endpoint="cafe.cafe_list",'
+                  r'method="GET",status="200"\} \d+')
+        self.assertIn('flaskcafe_request_duration_seconds_bucket'
+                      '{endpoint="cafe.cafe_list",le="+Inf"}', text)
+        self.assertIn('flaskcafe_db_queries_total{endpoint="cafe.cafe_list"}',
+                      text)
+
+    def test_unhandled_error_counted(self):
+        def boom():
+            raise RuntimeError("boom")
+
+        key = ("cafe.cafe_list", "GET", 500)
+        before = metrics.requests[key]
+
+        with patch.dict(app.view_functions, {"cafe.cafe_list": boom}), \
+                app.test_client() as client:
+            with self.assertRaises(RuntimeError):
+                client.get("/cafes")
+
+        self.assertEqual(metrics.requests[key], before + 1)
+
+    def test_failed_statement_timing_dropped(self):
+        with db.engine.connect() as conn:
+            with self.assertRaises(DBAPIError):
+                conn.execute(db.text("SELECT no_such_column FROM cafes"))
+            self.assertEqual(conn.info.get("query_started"), [])
+
+            conn.execute(db.text("SELECT 1"))
+            self.assertEqual(conn.info.get("query_started"), [])
+
+    def test_check_query_budget(self):
+        stats = RequestStats()
+        stats.endpoint = "cafe.cafe_list"
+        stats.budget = 1
+        stats.statements = ["SELECT 1", "SELECT 2"]
+
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            check_query_budget(stats)
+        self.assertIn("SELECT 2", str(cm.exception))
+
+        stats.budget = 2
+        check_query_budget(stats)
+
+    def test_budgets(self):
+        """Hot routes stay within budget with cold caches (no N+1)."""
+
+        urls = [
+            ("get", "/"),
+            ("get", "/cafes"),
+            ("get", "/cafes?sort=popular"),
+            ("get", f"/cafes/{self.cafe_id}"),
+            ("get", "/cafes/search?q=cafe"),
+            ("get", "/api/cafes/search?q=cafe&limit=50"),
+            ("get", "/cafes/nearby?lat=37.77&lng=-122.42&radius=50"),
+            ("get", f"/api/likes?cafe_id={self.cafe_id}"),
+            ("get", f"/api/likes/batch?cafe_ids={self.cafe_id},{self.cafe_id + 1}"),
+            ("post", f"/api/toggle_like/{self.cafe_id}"),
+            ("post", f"/api/toggle_like/{self.cafe_id}"),
+            ("get", "/profile"),
+            ("get", "/api/profile/likes"),
+        ]
+
+        for logged_in in (False, True):
+            for method, url in urls:
+                with self.subTest(url=url, method=method, logged_in=logged_in):
+                    self.clear_caches()
+
+                    with app.test_client() as client:
+                        if logged_in:
+                            login_for_test(client, self.user_id)
+                        assert_query_budget(client, url, method)
+
+
+class BenchmarkTestCase(TestCase):
+    """Tests for synthetic seeding and the route benchmarks."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_seed_synthetic(self):
+        seed_synthetic(3, 40, 10, 60, random_seed=7)
+
+        self.assertEqual(City.query.count(), 3)
+        self.assertEqual(Cafe.query.count(), 40)
+        self.assertEqual(Like.query.count(), 60)
+        self.assertEqual(load_dataset(), (40, 10))
+        self.assertEqual(
+            db.session.query(db.func.sum(Cafe.like_count)).scalar(), 60)
+
+        self.assertTrue(User.authenticate("user3", SYNTHETIC_PASSWORD))
+        self.assertEqual(
+            User.query.filter(User.image_url.is_(None)).count(), 0)
+
+        # same seed, same data
+        cafes = [(c.name, c.city_code, c.latitude)
+                 for c in Cafe.query.order_by(Cafe.id)]
+        likes = db.session.query(Like.user_id, Like.cafe_id).order_by(
+            Like.user_id, Like.cafe_id).all()
+
+        self.setUp()
+        seed_synthetic(3, 40, 10, 60, random_seed=7)
+
+        self.assertEqual(cafes, [(c.name, c.city_code, c.latitude)
+                                 for c in Cafe.query.order_by(Cafe.id)])
+        self.assertEqual(likes, db.session.query(Like.user_id, Like.cafe_id)
+                         .order_by(Like.user_id, Like.cafe_id).all())
+
+        # sequences moved past the explicit ids
+        db.session.add(Cafe(**dict(CAFE_DATA_1, city_code="c1")))
+        db.session.commit()
+
+    def test_seed_synthetic_restores_schema(self):
+        """Keys, indexes and the like count trigger are back after a load."""
+
+        def schema():
+            return db.session.execute(db.text("""
+                SELECT conname FROM pg_constraint
+                WHERE conrelid IN ('cafes'::regclass, 'likes'::regclass,
+                                   'users'::regclass, 'cities'::regclass)
+                UNION ALL
+                SELECT indexname FROM pg_indexes
+                WHERE tablename IN ('cafes', 'likes', 'users', 'cities')
+                ORDER BY 1
+            """)).scalars().all()
+
+        before = schema()
+        seed_synthetic(2, 20, 5, 10)
+        self.assertEqual(schema(), before)
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(Like(user_id=1, cafe_id=999))
+            db.session.commit()
+        db.session.rollback()
+
+        db.session.execute(db.delete(Like).where(Like.cafe_id == 20))
+        db.session.commit()
+        self.assertTrue(Like.add(1, 20))
+        self.assertFalse(Like.add(1, 20))
+        db.session.commit()
+        self.assertEqual(Cafe.query.get(20).like_count, 1)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([5], 95), 5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_compare(self):
+        baseline = {"scenarios": {
+            "cafe_list": {"p95_ms": 10.0, "rps": 100.0},
+            "login": {"p95_ms": 100.0, "rps": 10.0},
+        }}
+        results = {"scenarios": {
+            "cafe_list": {"p95_ms": 11.0, "rps": 70.0},
+            "login": {"p95_ms": 50.0, "rps": 10.0},
+            "likes": {"p95_ms": 5.0, "rps": 200.0},
+        }}
+
+        regressed = {(name, metric): bad for name, metric, *_, bad
+                     in compare(results, baseline, threshold=0.2)}
+
+        self.assertEqual(regressed, {
+            ("cafe_list", "p95_ms"): False,
+            ("cafe_list", "rps"): True,
+            ("login", "p95_ms"): False,
+            ("login", "rps"): False,
+        })
+
+    def test_run_scenarios(self):
+        seed_synthetic(1, 20, 5, 20)
+        dataset = load_dataset()
+
+        for name, scenario in SCENARIOS.items():
+            with self.subTest(scenario=name):
+                stats = run_scenario(app, scenario, dataset, requests=6,
+                                     concurrency=2, warmup=1)
+
+                self.assertEqual(stats["requests"], 6)
+                self.assertEqual(stats["errors"], 0)
+                self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+
+
+class QueryPlanTestCase(TestCase):
+    """Each route's queries should use indexes, not read whole tables.
+
+    Loads enough rows that Postgres would rather use an index than scan,
+    runs each route while recording its SELECTs, then EXPLAINs them.
+    """
+
+    N_CAFES = 20000
+    N_USERS = 5000
+    N_LIKES = 20000
+
+    # fine to scan these: they stay small
+    SMALL_TABLES = {"cities"}
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.rollback()
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        db.session.execute(db.text("""
+            INSERT INTO cafes (name, description, url, address, city_code,
+                               image_url, latitude, longitude)
+            SELECT 'Cafe ' || i, 'Coffee number ' || i, 'http://cafe.com/',
+                   i || ' Main St', 'sf', '/static/images/default-cafe.jpg',
+                   37.7 + (i % 100) / 1000.0, -122.5 + (i / 100) / 1000.0
+            FROM generate_series(1, :n) AS i
+        """), {"n": cls.N_CAFES})
+
+        db.session.execute(db.text("""
+            INSERT INTO users (username, email, first_name, last_name,
+                               description, password)
+            SELECT 'user' || i, 'user' || i || '@test.com', 'First', 'Last',
+                   'Description', 'not a hash'
+            FROM generate_series(1, :n) AS i
+        """), {"n": cls.N_USERS})
+
+        # so the foreign key checks on likes use the primary key indexes,
+        # not plans made back when the tables were tiny
+        db.session.execute(db.text("ANALYZE cafes, users"))
+
+        # N_LIKES likes, spread over users and cafes
+        db.session.execute(db.text("""
+            INSERT INTO likes (user_id, cafe_id)
+            SELECT (SELECT min(id) FROM users) + i % :n_users,
+                   (SELECT min(id) FROM cafes) + (i * 7919) % :n_cafes
+            FROM generate_series(1, :n_likes) AS i
+            ON CONFLICT DO NOTHING
+        """), {"n_users": cls.N_USERS, "n_cafes": cls.N_CAFES,
+               "n_likes": cls.N_LIKES})
+
+        db.session.commit()
+
+        with db.engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT") \
+                .exec_driver_sql("ANALYZE cafes, users, likes")
+
+        cls.cafe_id = db.session.query(db.func.min(Cafe.id)).scalar() + 1234
+        cls.user_id = db.session.query(db.func.min(User.id)).scalar()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def record_selects(self, fn):
+        """Call fn; return [(statement, parameters), ...] of its SELECTs."""
+
+        selects = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                selects.append((statement, parameters))
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            fn()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+
+        return selects
+
+    def table_scans(self, statement, parameters):
+        """Return names of tables this query reads with a Seq Scan."""
+
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plan = cursor.fetchone()[0][0]["Plan"]
+        finally:
+            conn.close()
+
+        scans = []
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            if node["Node Type"] == "Seq Scan":
+                scans.append(node["Relation Name"])
+            nodes.extend(node.get("Plans", []))
+
+        return scans
+
+    def assert_uses_indexes(self, fn):
+        selects = self.record_selects(fn)
+        self.assertTrue(selects)
+
+        for statement, parameters in selects:
+            scans = set(self.table_scans(statement, parameters))
+            self.assertLessEqual(scans, self.SMALL_TABLES, statement)
+
+    def get(self, url, logged_in=False):
+        def fetch():
+            with app.test_client() as client:
+                if logged_in:
+                    login_for_test(client, self.user_id)
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200, url)
+
+        return fetch
+
+    def test_cafe_list(self):
+        self.assert_uses_indexes(self.get("/cafes"))
+        self.assert_uses_indexes(self.get("/cafes?sort=popular"))
+
+        with app.test_client() as client:
+            html = client.get("/cafes").data.decode("utf8")
+        next_url = re.search(r'href="(/cafes\?sort=name&after=[^"]+)"', html)
+        self.assert_uses_indexes(self.get(next_url.group(1)))
+
+    def test_cafe_detail(self):
+        self.assert_uses_indexes(self.get(f"/cafes/{self.cafe_id}"))
+        self.assert_uses_indexes(
+            self.get(f"/cafes/{self.cafe_id}", logged_in=True))
+
+    def test_search(self):
+        self.assert_uses_indexes(self.get("/cafes/search?q=cafe+1234"))
+        self.assert_uses_indexes(
+            self.get("/api/cafes/search?q=coffee+99&city_code=sf"))
+
+    def test_nearby(self):
+        self.assert_uses_indexes(
+            self.get("/cafes/nearby?lat=37.75&lng=-122.45&radius=0.3"))
+
+    def test_likes(self):
+        ids = ",".join(str(self.cafe_id + i) for i in range(10))
+        self.assert_uses_indexes(
+            self.get(f"/api/likes/batch?cafe_ids={ids}", logged_in=True))
+        self.assert_uses_indexes(self.get("/profile", logged_in=True))
+        self.assert_uses_indexes(
+            self.get("/api/profile/likes", logged_in=True))
+
+    def test_trending(self):
+        trending.rebuild()
+        trending.mark_stale()   # so it reads the event log, too
+        self.assert_uses_indexes(self.get("/cafes/trending"))
+        self.assert_uses_indexes(self.get("/api/cafes/trending?city_code=sf"))
+
+    def test_api_v1(self):
+        self.assert_uses_indexes(self.get("/api/v1/cafes?fields=id,name"))
+        self.assert_uses_indexes(self.get("/api/v1/cafes?sort=popular"))
+        self.assert_uses_indexes(self.get(f"/api/v1/cafes/{self.cafe_id}"))
+
+    def test_cafe_likers(self):
+        """the reverse lookup (likes by cafe) uses ix_likes_cafe_id_user_id"""
+
+        def likers():
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.liking_users
+
+        self.assert_uses_indexes(likers)
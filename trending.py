@@ -0,0 +1,350 @@
+"""Trending cafes: which cafes are being liked lately, kept in memory.
+
+A cafe's trending score is its likes, each counted for less the older it
+is: a like is worth 1 when it's made, and half that every
+TRENDING_HALF_LIFE seconds after. Scores use forward decay: a like made at
+time t adds exp(decay * (t - landmark)) for a fixed landmark time, so a
+score only changes when a like comes or goes -- never just because time
+passed -- and cafes can be kept ranked by it. (The score as of now is that
+times exp(-decay * (now - landmark)), the same factor for every cafe.)
+
+Trending holds a Leaderboard of every cafe, and one per city. It's built
+from the likes table the first time it's used (one aggregate query per
+process), then kept current from the like event log (models.LikeEvent):
+after toggle_like commits (see mark_stale), and otherwise at most every
+TRENDING_SYNC_INTERVAL seconds, to pick up likes made by other processes.
+Reading the top k is O(k) and never queries likes.
+"""
+
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from datetime import datetime
+
+from models import db, Cafe, LikeEvent
+
+# likes older than this many half-lives are worth under a millionth of a new
+# one; they're left out of the rebuild, and scores below that are dropped
+WINDOW_HALF_LIVES = 20
+
+# move the landmark up when new likes would be worth more than e**this, so
+# scores stay well inside the range of a float
+RESCALE_EXPONENT = 100
+
+# events read per query while syncing
+SYNC_BATCH = 1000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def epoch_seconds(when):
+    """Seconds since 1970 of a (naive, database-local) datetime; matches
+    Postgres' EXTRACT(EPOCH FROM timestamp)."""
+
+    return (when - EPOCH).total_seconds()
+
+
+class Snapshot(namedtuple("Snapshot", ["xmin", "xmax", "running"])):
+    """A Postgres snapshot (pg_current_snapshot()): which transactions had
+    finished when it was taken."""
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        """Parse the text form, "xmin:xmax:running,running,..."."""
+
+        xmin, xmax, running = text.split(":")
+        return cls(int(xmin), int(xmax),
+                   frozenset(int(txid) for txid in running.split(",") if txid))
+
+    def sees(self, txid):
+        """Were this transaction's changes visible in the snapshot?"""
+
+        return txid < self.xmin or (
+            txid < self.xmax and txid not in self.running)
+
+
+class Leaderboard:
+    """Cafe scores, kept sorted so the top k can be read in O(k).
+
+    Changing a score is O(log n) to find it plus a list insert/delete.
+    Not thread-safe on its own: Trending locks around it.
+    """
+
+    def __init__(self, scores=None):
+        self._scores = dict(scores or {})       # cafe id -> score
+        self._ranked = sorted(                   # (-score, cafe id), best first
+            (-score, cafe_id) for cafe_id, score in self._scores.items())
+
+    def __len__(self):
+        return len(self._scores)
+
+    def score(self, cafe_id):
+        """This cafe's score (0 if it has none)."""
+
+        return self._scores.get(cafe_id, 0.0)
+
+    def add(self, cafe_id, delta, floor=0.0):
+        """Add delta (which may be negative) to this cafe's score; drop the
+        cafe if that leaves it at or under floor."""
+
+        old = self.remove(cafe_id)
+        score = old + delta
+
+        if score > floor:
+            self._scores[cafe_id] = score
+            insort(self._ranked, (-score, cafe_id))
+
+    def remove(self, cafe_id):
+        """Drop this cafe; return the score it had (0 if none)."""
+
+        score = self._scores.pop(cafe_id, None)
+        if score is None:
+            return 0.0
+
+        del self._ranked[bisect_left(self._ranked, (-score, cafe_id))]
+        return score
+
+    def top(self, k):
+        """[(cafe id, score), ...] of the k highest scores, best first."""
+
+        return [(cafe_id, -score) for score, cafe_id in self._ranked[:k]]
+
+    def scale(self, factor):
+        """Multiply every score by factor (> 0); ranks don't change."""
+
+        self._scores = {
+            cafe_id: score * factor for cafe_id, score in self._scores.items()}
+        self._ranked = [
+            (score * factor, cafe_id) for score, cafe_id in self._ranked]
+
+
+class Trending:
+    """Per-process trending leaderboards (every cafe, and each city)."""
+
+    def __init__(self, app=None):
+        self.app = app
+        self.half_life = None
+        self.sync_interval = None
+
+        self._lock = threading.Lock()           # guards the boards
+        self._sync_lock = threading.Lock()      # one rebuild/sync at a time
+        self._reset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["trending"] = self
+        self.half_life = app.config['TRENDING_HALF_LIFE']
+        self.sync_interval = app.config['TRENDING_SYNC_INTERVAL']
+
+    def _reset(self):
+        self._boards = None         # city code (None: every cafe) -> Leaderboard
+        self._cities = {}           # cafe id -> city code, for scored cafes
+        self._landmark = 0.0        # epoch seconds
+        self._clock_offset = 0.0    # database's epoch seconds - time.time()
+        self._snapshot = None       # what the rebuild saw (see _apply)
+        self._cursor = None         # LikeEvent.tail cursor
+        self._synced_at = 0.0
+        self._stale = False
+
+    @property
+    def decay(self):
+        return math.log(2) / self.half_life
+
+    def _now(self):
+        """Epoch seconds now, on the database's clock."""
+
+        return time.time() + self._clock_offset
+
+    def _weight(self, seconds):
+        """Forward-decayed weight of a like made at these epoch seconds."""
+
+        return math.exp(self.decay * (seconds - self._landmark))
+
+    def clear(self):
+        """Forget everything; the next read rebuilds."""
+
+        with self._sync_lock, self._lock:
+            self._reset()
+
+    def rebuild(self):
+        """Build the leaderboards from the likes table."""
+
+        with self._sync_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        window = self.half_life * WINDOW_HALF_LIVES
+
+        # one snapshot for the aggregate and the position in the event log:
+        # events from transactions it saw are already counted
+        conn = db.engine.connect().execution_options(
+            isolation_level="REPEATABLE READ")
+        with conn, conn.begin():
+            snapshot, now = conn.execute(db.text(
+                "SELECT pg_current_snapshot()::text, "
+                "EXTRACT(EPOCH FROM LOCALTIMESTAMP)::float8")).one()
+
+            rows = conn.execute(db.text("""
+                SELECT likes.cafe_id, cafes.city_code,
+                       SUM(EXP(:decay * (
+                           EXTRACT(EPOCH FROM likes.created_at)::float8
+                           - :landmark)))
+                FROM likes
+                JOIN cafes ON cafes.id = likes.cafe_id
+                WHERE likes.created_at > LOCALTIMESTAMP
+                                         - make_interval(secs => :window)
+                GROUP BY likes.cafe_id, cafes.city_code
+            """), {"decay": self.decay, "landmark": now,
+                   "window": window}).all()
+
+        scores = {None: {}}
+        cities = {}
+        for cafe_id, city_code, score in rows:
+            scores[None][cafe_id] = score
+            scores.setdefault(city_code, {})[cafe_id] = score
+            cities[cafe_id] = city_code
+
+        snapshot = Snapshot.parse(snapshot)
+
+        with self._lock:
+            self._boards = {
+                city_code: Leaderboard(city_scores)
+                for city_code, city_scores in scores.items()}
+            self._cities = cities
+            self._landmark = now
+            self._clock_offset = now - time.time()
+            self._snapshot = snapshot
+            self._cursor = LikeEvent.cursor_before(snapshot.xmin)
+            self._synced_at = time.monotonic()
+            self._stale = False
+
+    def mark_stale(self):
+        """Likes changed: sync on the next read, whatever the interval."""
+
+        self._stale = True
+
+    def refresh(self):
+        """Bring the leaderboards up to date if they're due: build them on
+        first use, then apply new like events when marked stale or every
+        TRENDING_SYNC_INTERVAL seconds.
+
+        If another thread is already syncing, this doesn't wait for it.
+        """
+
+        if self._boards is None:
+            with self._sync_lock:
+                if self._boards is None:
+                    self._rebuild()
+            return
+
+        due = (self._stale or
+               time.monotonic() - self._synced_at >= self.sync_interval)
+
+        if due and self._sync_lock.acquire(blocking=False):
+            try:
+                self._sync()
+            finally:
+                self._sync_lock.release()
+
+    def sync(self):
+        """Apply every like event since the last sync (or the rebuild)."""
+
+        with self._sync_lock:
+            if self._boards is None:
+                self._rebuild()
+            else:
+                self._sync()
+
+    def _sync(self):
+        # before reading, so a like committed while we read marks it again
+        self._stale = False
+
+        while True:
+            events, cursor = LikeEvent.tail(self._cursor, limit=SYNC_BATCH)
+            self._apply(events)
+            self._cursor = cursor
+
+            if len(events) < SYNC_BATCH:
+                break
+
+        self._synced_at = time.monotonic()
+
+    def _apply(self, events):
+        """Add likes and take away unlikes from the leaderboards."""
+
+        events = [
+            event for event in events
+            if event.like_created_at is not None
+            and not self._snapshot.sees(event.txid)]
+        if not events:
+            return
+
+        new_cafes = {event.cafe_id for event in events} - self._cities.keys()
+        cities = dict(
+            db.session.query(Cafe.id, Cafe.city_code)
+            .filter(Cafe.id.in_(new_cafes))
+            .all()
+        ) if new_cafes else {}
+
+        with self._lock:
+            self._cities.update(cities)
+
+            now = self._now()
+            if self.decay * (now - self._landmark) > RESCALE_EXPONENT:
+                self._rescale(now)
+
+            floor = self._weight(now - self.half_life * WINDOW_HALF_LIVES)
+
+            for event in events:
+                weight = self._weight(epoch_seconds(event.like_created_at))
+                if event.kind == "unlike":
+                    weight = -weight
+
+                self._boards[None].add(event.cafe_id, weight, floor)
+
+                city_code = self._cities.get(event.cafe_id)
+                if city_code is not None:
+                    self._boards.setdefault(city_code, Leaderboard()).add(
+                        event.cafe_id, weight, floor)
+
+    def _rescale(self, landmark):
+        factor = math.exp(-self.decay * (landmark - self._landmark))
+        for board in self._boards.values():
+            board.scale(factor)
+        self._landmark = landmark
+
+    def move_cafe(self, cafe_id, city_code):
+        """This cafe is now in another city: move it to that city's board."""
+
+        with self._lock:
+            old_city_code = self._cities.get(cafe_id)
+            if self._boards is None or old_city_code in (None, city_code):
+                return
+
+            score = self._boards[old_city_code].remove(cafe_id)
+            self._boards.setdefault(city_code, Leaderboard()).add(
+                cafe_id, score)
+            self._cities[cafe_id] = city_code
+
+    def top(self, k, city_code=None):
+        """[(cafe id, score as of now), ...] of the k most-trending cafes
+        (in this city, if given), best first."""
+
+        self.refresh()
+
+        with self._lock:
+            board = self._boards.get(city_code)
+            if board is None:
+                return []
+
+            top = board.top(k)
+            factor = math.exp(-self.decay * (self._now() - self._landmark))
+
+        return [(cafe_id, score * factor) for cafe_id, score in top]